@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+import os
+from zipfile import ZIP_STORED, ZipFile
+
+# Synthetic Sentinel-1 products used by the benchmarks
+
+MANIFEST_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1" xmlns:safe="http://www.esa.int/safe/sentinel-1.0" \
+xmlns:s1sarl1="http://www.esa.int/safe/sentinel-1.0/sentinel-1/sar/level-1">
+<metadataSection>
+<metadataObject ID="platform"><metadataWrap><xmlData><safe:platform><safe:familyName>SENTINEL-1</safe:familyName>\
+<safe:number>A</safe:number><safe:instrument><safe:extension><s1sarl1:instrumentMode><s1sarl1:mode>IW</s1sarl1:mode>\
+<s1sarl1:swath>IW1</s1sarl1:swath><s1sarl1:swath>IW2</s1sarl1:swath><s1sarl1:swath>IW3</s1sarl1:swath>\
+</s1sarl1:instrumentMode></safe:extension></safe:instrument></safe:platform></xmlData></metadataWrap></metadataObject>
+<metadataObject ID="measurementOrbitReference"><metadataWrap><xmlData><safe:orbitReference>\
+<safe:orbitNumber type="start">{orbit}</safe:orbitNumber><safe:relativeOrbitNumber type="start">{relative_orbit}\
+</safe:relativeOrbitNumber></safe:orbitReference></xmlData></metadataWrap></metadataObject>
+<metadataObject ID="acquisitionPeriod"><metadataWrap><xmlData><safe:acquisitionPeriod>\
+<safe:startTime>{start}</safe:startTime><safe:stopTime>{stop}</safe:stopTime></safe:acquisitionPeriod></xmlData>\
+</metadataWrap></metadataObject>
+<metadataObject ID="generalProductInformation"><metadataWrap><xmlData><s1sarl1:standAloneProductInformation>\
+<s1sarl1:transmitterReceiverPolarisation>VV</s1sarl1:transmitterReceiverPolarisation>\
+<s1sarl1:transmitterReceiverPolarisation>VH</s1sarl1:transmitterReceiverPolarisation>\
+</s1sarl1:standAloneProductInformation></xmlData></metadataWrap></metadataObject>
+</metadataSection>
+<dataObjectSection>
+{data_objects}
+</dataObjectSection>
+</xfdu:XFDU>
+"""
+
+ANNOTATION_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<product>
+<adsHeader><missionId>S1A</missionId><productType>SLC</productType><polarisation>{polarisation}</polarisation>\
+<mode>IW</mode><swath>{swath}</swath></adsHeader>
+<swathTiming><linesPerBurst>{lines_per_burst}</linesPerBurst><samplesPerBurst>{samples}</samplesPerBurst>
+<burstList count="{bursts}">
+{burst_list}
+</burstList></swathTiming>
+<geolocationGrid><geolocationGridPointList count="{points}">
+{grid}
+</geolocationGridPointList></geolocationGrid>
+</product>
+"""
+
+# Footprint of the synthetic scenes. Subswath IW<n> covers one degree of
+# longitude east of the previous one and bursts are stacked northwards.
+SCENE_LON = 10.0
+SCENE_LAT = 45.0
+SUBSWATH_WIDTH = 1.0
+BURST_HEIGHT = 0.2
+BURSTS = 9
+LINES_PER_BURST = 1500
+SAMPLES = 20000
+
+def annotation_xml(swath: int, polarisation: str) -> str:
+    """
+    Get a synthetic annotation XML with the burst list and geolocation grid
+    of a subswath.
+    """
+    grid = []
+    for row in range(BURSTS + 1):
+        for column in range(3):
+            lon = SCENE_LON + (swath - 1 + column / 2) * SUBSWATH_WIDTH
+            lat = SCENE_LAT + row * BURST_HEIGHT
+            grid.append(f"<geolocationGridPoint><line>{row * LINES_PER_BURST}</line><pixel>{column * SAMPLES // 2}"
+                        f"</pixel><latitude>{lat}</latitude><longitude>{lon}</longitude></geolocationGridPoint>")
+    return ANNOTATION_TEMPLATE.format(
+        polarisation=polarisation, swath=f"IW{swath}", lines_per_burst=LINES_PER_BURST, samples=SAMPLES,
+        bursts=BURSTS, burst_list="\n".join(f"<burst><byteOffset>{i}</byteOffset></burst>" for i in range(BURSTS)),
+        points=len(grid), grid="\n".join(grid),
+    )
+
+def scene_name(start: datetime, orbit: int) -> str:
+    stop = start + timedelta(seconds=27)
+    return (f"S1A_IW_SLC__1SDV_{start:%Y%m%dT%H%M%S}_{stop:%Y%m%dT%H%M%S}_{orbit:06d}_"
+            f"{orbit % 0xFFFFFF:06X}_{orbit % 0xFFFF:04X}")
+
+def write_safe_zip(directory: str, start: datetime, orbit: int, measurement_size: int = 0,
+                   data_objects: int = 40) -> str:
+    """
+    Write a synthetic Sentinel-1 SLC SAFE zip file.
+
+    Parameters
+    ----------
+    directory: str
+        Directory where the zip file is written.
+    start: datetime
+        Start time of the scene.
+    orbit: int
+        Absolute orbit number of the scene.
+    measurement_size: int
+        Size in bytes of the measurement member, which makes the zip file as
+        large as a real scene without storing real data.
+    data_objects: int
+        Number of entries in the data object section of the manifest.
+    """
+    name = scene_name(start, orbit)
+    manifest = MANIFEST_TEMPLATE.format(
+        orbit=orbit,
+        relative_orbit=(orbit - 73) % 175 + 1,
+        start=f"{start:%Y-%m-%dT%H:%M:%S.%f}",
+        stop=f"{start + timedelta(seconds=27):%Y-%m-%dT%H:%M:%S.%f}",
+        data_objects="\n".join(f'<dataObject ID="object{i}"><byteStream size="1"/></dataObject>'
+                               for i in range(data_objects)),
+    )
+    path = os.path.join(directory, name + ".zip")
+    with ZipFile(path, "w", ZIP_STORED) as archive:
+        archive.writestr(f"{name}.SAFE/manifest.safe", manifest)
+        for i in range(3):
+            for polarisation in ["vv", "vh"]:
+                member = f"s1a-iw{i + 1}-slc-{polarisation}-{start:%Y%m%dt%H%M%S}-00{i + 1}.xml"
+                archive.writestr(f"{name}.SAFE/annotation/{member}", annotation_xml(i + 1, polarisation.upper()))
+                archive.writestr(f"{name}.SAFE/annotation/calibration/calibration-{member}", "<calibration/>")
+        archive.writestr(f"{name}.SAFE/measurement/s1a-iw1-slc-vv.tiff", b"\0" * measurement_size)
+    return path
+
+def write_dim(path: str, start: datetime) -> str:
+    """
+    Write a synthetic BEAM-DIMAP header with the metadata read by pysnap-toolbox.
+    """
+    attributes = {"MISSION": "SENTINEL-1A", "ABS_ORBIT": "41234", "REL_ORBIT": "62", "SWATH": "IW2",
+                  "mds1_tx_rx_polar": "VV", "mds2_tx_rx_polar": "-"}
+    with open(path, "w") as f:
+        f.write("<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<Dimap_Document name=\"product.dim\">\n")
+        start_time = f"{start:%d-%b-%Y %H:%M:%S.%f}".upper()
+        f.write(f"<PRODUCT_SCENE_RASTER_START_TIME>{start_time}</PRODUCT_SCENE_RASTER_START_TIME>\n")
+        f.write("<Dataset_Sources><MDElem name=\"metadata\"><MDElem name=\"Abstracted_Metadata\">\n")
+        for name, value in attributes.items():
+            f.write(f"<MDATTR name=\"{name}\" type=\"ascii\">{value}</MDATTR>\n")
+        f.write("</MDElem></MDElem></Dataset_Sources>\n</Dimap_Document>\n")
+    return path
+
+def generate_scenes(directory: str, n: int, measurement_size: int = 0, interval_days: int = 12) -> list:
+    """
+    Write n synthetic scenes of the same track acquired every interval_days.
+    """
+    os.makedirs(directory, exist_ok=True)
+    start = datetime(2022, 1, 1, 10, 0, 0, 123456)
+    return [write_safe_zip(directory, start + timedelta(days=i * interval_days), 41234 + i * 175 * interval_days // 12,
+                           measurement_size) for i in range(n)]
+
+if __name__ == "__main__":
+    pass
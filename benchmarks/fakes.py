@@ -0,0 +1,272 @@
+import os
+import re
+import stat
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+# Stand-in gpt and snaphu executables used to benchmark the orchestration
+# code without SNAP. Their behaviour is set with environment variables:
+#
+#   FAKE_GPT_SLEEP, FAKE_SNAPHU_SLEEP            Seconds to sleep
+#   FAKE_GPT_CPU, FAKE_SNAPHU_CPU                Seconds of CPU to burn
+#   FAKE_GPT_OUTPUT_SIZE, FAKE_SNAPHU_OUTPUT_SIZE  Bytes of output to write
+#   FAKE_GPT_FAIL                                Fail when a source contains this text
+
+DEFAULT_START_TIME = "01-JAN-2022 10:00:00.000000"
+# Corners of the synthetic scenes of benchmarks/data.py written to the
+# abstracted metadata of every product
+DEFAULT_CORNERS = {
+    "first_near_lat": 46.8, "first_near_long": 10.0, "first_far_lat": 46.8, "first_far_long": 13.0,
+    "last_near_lat": 45.0, "last_near_long": 10.0, "last_far_lat": 45.0, "last_far_long": 13.0,
+}
+# Raster width and height in pixels of products read from scenes
+DEFAULT_RASTER_SIZE = (25000, 13500)
+
+HELP_TEMPLATE = """Usage:
+  gpt {operator} [options]
+
+Source Options:
+  -Ssource=<file>    Sets source 'source' to <filepath>.
+                     This is a mandatory source.
+
+Parameter Options:
+  -PselectedPolarisations=<string>    Sets parameter 'selectedPolarisations' to <string>.
+  -Psubswath=<string>    Sets parameter 'subswath' to <string>.
+                         Default value is 'IW1'.
+
+Graph XML Format:
+  <graph id="someGraphId">
+    <node id="someNodeId">
+      <operator>{operator}</operator>
+      <sources>
+        <source>${{source}}</source>
+      </sources>
+    </node>
+  </graph>
+"""
+
+# Help of operators reading an array of source products, which only take
+# their sources as positional arguments
+MULTI_SOURCE_HELP_TEMPLATE = """Usage:
+  gpt {operator} [options] <source-file-1> <source-file-2> ...
+
+Parameter Options:
+  -PselectedPolarisations=<string>    Sets parameter 'selectedPolarisations' to <string>.
+
+Graph XML Format:
+  <graph id="someGraphId">
+    <node id="someNodeId">
+      <operator>{operator}</operator>
+      <sources>
+        <sourceProducts>${{sourceProducts}}</sourceProducts>
+      </sources>
+    </node>
+  </graph>
+"""
+
+MULTI_SOURCE_OPERATORS = ["Back-Geocoding", "SAR-Mosaic", "TOPSAR-Merge"]
+
+OPERATORS = [
+    "Apply-Orbit-File", "Back-Geocoding", "Interferogram", "SAR-Mosaic", "SnaphuExport", "SnaphuImport", "Subset",
+    "TOPSAR-Deburst", "TOPSAR-Merge", "TOPSAR-Split", "Terrain-Correction", "TopoPhaseRemoval", "Write",
+]
+
+def install_fakes(bin_dir: str) -> None:
+    """
+    Write gpt and snaphu executables to bin_dir which run this module with
+    the current Python interpreter.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    for name in ["gpt", "snaphu"]:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" {name} "$@"\n')
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH)
+
+def simulate_work(prefix: str) -> None:
+    """
+    Sleep and burn CPU according to the environment variables of a stand-in.
+    """
+    cpu = float(os.environ.get(f"{prefix}_CPU", 0))
+    end = time.process_time() + cpu
+    while time.process_time() < end:
+        pass
+    time.sleep(float(os.environ.get(f"{prefix}_SLEEP", 0)))
+
+def get_start_time(source: str) -> str:
+    """
+    Get the start time to write to an output product from its source.
+    """
+    if source and source.endswith(".dim") and os.path.isfile(source):
+        with open(source) as f:
+            match = re.search(r"<PRODUCT_SCENE_RASTER_START_TIME>(.*?)<", f.read())
+        if match:
+            return match.group(1)
+    match = re.search(r"_(\d{8}T\d{6})_", os.path.basename(source or ""))
+    if match:
+        return time.strftime("%d-%b-%Y %H:%M:%S.000000", time.strptime(match.group(1), "%Y%m%dT%H%M%S")).upper()
+    return DEFAULT_START_TIME
+
+def get_corners(source: str) -> dict:
+    """
+    Get the corner coordinates to write to an output product from its source.
+    """
+    corners = dict(DEFAULT_CORNERS)
+    if source and source.endswith(".dim") and os.path.isfile(source):
+        with open(source) as f:
+            for name, value in re.findall(r'<MDATTR name="(\w+)"[^>]*>([^<]*)<', f.read()):
+                if name in corners:
+                    corners[name] = float(value)
+    return corners
+
+def get_raster_size(source: str, region: str = None) -> tuple:
+    """
+    Get the raster size to write to an output product from its source or the
+    x,y,w,h region of a Subset.
+    """
+    if region:
+        return tuple(int(x) for x in region.split(",")[2:4])
+    if source and source.endswith(".dim") and os.path.isfile(source):
+        with open(source) as f:
+            text = f.read()
+        match = re.search(r"<NCOLS>(\d+)</NCOLS>\s*<NROWS>(\d+)</NROWS>", text)
+        if match:
+            return int(match.group(1)), int(match.group(2))
+    return DEFAULT_RASTER_SIZE
+
+def write_product(target: str, source: str, size: int, region: str = None) -> None:
+    """
+    Write a BEAM-DIMAP product with a header and a single band of size bytes.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    corners = "".join(f'<MDATTR name="{name}" type="float64">{value}</MDATTR>\n'
+                      for name, value in get_corners(source).items())
+    width, height = get_raster_size(source, region)
+    with open(target, "w") as f:
+        f.write("<Dimap_Document>\n"
+                f"<Raster_Dimensions>\n<NCOLS>{width}</NCOLS>\n<NROWS>{height}</NROWS>\n</Raster_Dimensions>\n"
+                f"<PRODUCT_SCENE_RASTER_START_TIME>{get_start_time(source)}</PRODUCT_SCENE_RASTER_START_TIME>\n"
+                f"<Dataset_Sources>\n{corners}</Dataset_Sources>\n"
+                "</Dimap_Document>\n")
+    data_dir = os.path.splitext(target)[0] + ".data"
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(data_dir, "band.img"), "wb") as f:
+        f.truncate(size)
+
+def get_help(operator: str) -> str:
+    """
+    Get the help text of an operator as printed by gpt <operator> -h.
+    """
+    template = MULTI_SOURCE_HELP_TEMPLATE if operator in MULTI_SOURCE_OPERATORS else HELP_TEMPLATE
+    return template.format(operator=operator)
+
+def get_positional_args(args: list) -> list:
+    """
+    Get the arguments after the operator that are not options or their values.
+    """
+    positional = []
+    skip = False
+    for arg in args[1:]:
+        if skip:
+            skip = False
+        elif arg in ["-t", "-c", "-q", "-f", "-e", "-x"]:
+            skip = arg not in ["-e", "-x"]
+        elif not arg.startswith("-"):
+            positional.append(arg.strip('"'))
+    return positional
+
+def get_option(args: list, prefix: str) -> str:
+    values = [x.split("=", 1)[1].strip('"') for x in args if x.startswith(prefix) and "=" in x]
+    return values[0] if values else None
+
+def fake_gpt(args: list) -> int:
+    if not args or args[0] == "-h":
+        print("Usage:\n  gpt <op> [options] [<source-file-1> <source-file-2> ...]\n\nOperators:")
+        for operator in OPERATORS:
+            print(f"  {operator:<30}Stand-in operator")
+        return 0
+    if "-h" in args[1:]:
+        if args[0] not in OPERATORS:
+            print(f"Error: Unknown operator '{args[0]}'")
+            return 1
+        print(get_help(args[0]))
+        return 0
+    if args[0] in OPERATORS:
+        # Source options the operator does not have are rejected like GPT does
+        accepted = re.findall(r"-S(\w+)=", get_help(args[0]))
+        for arg in args[1:]:
+            match = re.match(r"-S(\w+)=", arg)
+            if match and match.group(1) not in accepted:
+                print(f"Error: Unknown source option '-S{match.group(1)}' of operator {args[0]}")
+                return 1
+
+    simulate_work("FAKE_GPT")
+    size = int(os.environ.get("FAKE_GPT_OUTPUT_SIZE", 1024))
+    positional = get_positional_args(args)
+    source = get_option(args, "-S") or get_option(args, "-PwrappedPhase") or (positional[0] if positional else None)
+
+    fail = os.environ.get("FAKE_GPT_FAIL")
+    if args[0].endswith(".xml") and os.path.isfile(args[0]):
+        nodes = {x.get("id"): x for x in ET.parse(args[0]).getroot().iter("node")}
+        writes = {}
+        for node_id, node in nodes.items():
+            if node.findtext("operator") != "Write":
+                continue
+            # Follow the first source of every node back to the Read node
+            read = node
+            while read.findtext("operator") != "Read":
+                read = nodes[read.find("sources")[0].get("refid")]
+            read_file = read.findtext("parameters/file")
+            if fail and fail in read_file:
+                print(f"Error: [NodeId: {read.get('id')}] Cannot read {read_file}")
+                return 1
+            writes[node.findtext("parameters/file")] = source or read_file
+        for target, read_file in writes.items():
+            write_product(target, read_file, size)
+    elif fail and source and fail in source:
+        print(f"Error: Cannot read {source}")
+        return 1
+    elif args[0] == "SnaphuExport":
+        target_folder = get_option(args, "-PtargetFolder")
+        name = os.path.splitext(os.path.basename(source))[0]
+        write_snaphu_export(os.path.join(target_folder, name), size)
+
+    target = get_option(args, "-PoutputFile")
+    if "-t" in args:
+        target = args[args.index("-t") + 1].strip('"')
+    if target is not None:
+        write_product(target, source, size, get_option(args, "-Pregion"))
+    return 0
+
+def write_snaphu_export(data_dir: str, size: int, lines: int = 1500, samples: int = 2556) -> None:
+    """
+    Write the files created by SnaphuExport.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    for name in ["Phase_ifg_VV.snaphu", "coh_VV.snaphu", "UnwPhase_ifg_VV.snaphu"]:
+        with open(os.path.join(data_dir, name + ".hdr"), "w") as f:
+            f.write(f"ENVI\nsamples = {samples}\nlines = {lines}\nbands = 1\ndata type = 4\n")
+    for name in ["Phase_ifg_VV.snaphu.img", "coh_VV.snaphu.img"]:
+        with open(os.path.join(data_dir, name), "wb") as f:
+            f.truncate(size)
+    with open(os.path.join(data_dir, "snaphu.conf"), "w") as f:
+        f.write("# CONFIG FOR SNAPHU\n# ---------------------------------------------------------------\n"
+                "# Created by SNAP software\n#\n# Command to call snaphu:\n#\n"
+                f"#       snaphu -f snaphu.conf Phase_ifg_VV.snaphu.img {samples}\n#\n\n"
+                "STATCOSTMODE\tDEFO\nINITMETHOD\tMCF\n\nCORRFILE\tcoh_VV.snaphu.img\n"
+                "OUTFILE\tUnwPhase_ifg_VV.snaphu.img\nLOGFILE\tsnaphu.log\n")
+
+def fake_snaphu(args: list) -> int:
+    simulate_work("FAKE_SNAPHU")
+    conf_file = args[args.index("-f") + 1]
+    with open(conf_file) as f:
+        outfile = [x.split()[1] for x in f if x.startswith("OUTFILE")][0]
+    with open(outfile, "wb") as f:
+        f.truncate(int(os.environ.get("FAKE_SNAPHU_OUTPUT_SIZE", 1024)))
+    return 0
+
+if __name__ == "__main__":
+    if sys.argv[1] == "gpt":
+        sys.exit(fake_gpt(sys.argv[2:]))
+    sys.exit(fake_snaphu(sys.argv[2:]))
@@ -0,0 +1,479 @@
+import argparse
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timedelta
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.data import generate_scenes, write_dim
+from benchmarks.fakes import OPERATORS, install_fakes, write_snaphu_export
+
+# Benchmarks of the orchestration code using stand-in gpt and snaphu
+# executables. Run with python benchmarks/run.py
+
+BATCH_TEMPLATE = """
+[[workflow.image1]]
+source = "x"
+operator = "TOPSAR-Split"
+parameters = {subswath="IW2", selectedPolarisations="VV"}
+
+[[workflow.image2]]
+source = "x"
+operator = "TOPSAR-Split"
+parameters = {subswath="IW2", selectedPolarisations="VV"}
+
+[[workflow.pair]]
+source = ["$image1", "$image2"]
+operator = "Back-Geocoding"
+
+[[workflow.pair]]
+operator = "Interferogram"
+"""
+
+SUBSET_TEMPLATE = """
+[[workflow.image1]]
+source = "x"
+operator = "TOPSAR-Split"
+parameters = {subswath="IW2", selectedPolarisations="VV"}
+
+[[workflow.image1]]
+operator = "TOPSAR-Deburst"
+"""
+
+# Single subtable chain where every step writes an intermediate product that
+# cleanup can remove once the next step has read it
+CHAIN_TEMPLATE = SUBSET_TEMPLATE + """
+[[workflow.image1]]
+operator = "Apply-Orbit-File"
+
+[[workflow.image1]]
+operator = "Terrain-Correction"
+"""
+
+@contextmanager
+def fake_environment(work_dir: str, **settings):
+    """
+    Put the stand-in executables first in the PATH, use a separate operator
+    registry cache, and set the FAKE_* settings of the stand-ins.
+    """
+    bin_dir = os.path.join(work_dir, "bin")
+    install_fakes(bin_dir)
+    old_environ = dict(os.environ)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    os.environ["XDG_CACHE_HOME"] = os.path.join(work_dir, "cache")
+    for key, value in settings.items():
+        os.environ[f"FAKE_{key.upper()}"] = str(value)
+    try:
+        yield bin_dir
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environ)
+
+@contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        yield
+
+def timed(func, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+def measure_gpt_startup(runs: int = 10) -> float:
+    """
+    Get the mean wall time of a stand-in gpt call, which is subtracted from
+    the batch time to get the orchestration overhead.
+    """
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run(["gpt", "Interferogram", "-q", "1"], check=True)
+    return (time.perf_counter() - start) / runs
+
+def read_gpt_records(trace_dir: str) -> list:
+    """
+    Read the trace records of the gpt calls of a batch.
+    """
+    from pysnaptoolbox.profiling import read_trace
+    records = [x for root, _, files in os.walk(trace_dir) for name in files
+               for x in read_trace(os.path.join(root, name))]
+    return [x for x in records if x["stage"] == "gpt"]
+
+def run_batch(work_dir: str, scenes_dir: str, jobs: int = 1, cleanup: bool = False, template: str = BATCH_TEMPLATE,
+              batch_subtables: str = "image1,image2", **kwargs) -> dict:
+    """
+    Run batch processing of all scenes in scenes_dir using the pair workflow
+    or the given workflow template.
+    """
+    from pysnaptoolbox.pysnap import run_batch_processing
+
+    output_dir = tempfile.mkdtemp(dir=work_dir)
+    config = os.path.join(work_dir, "batch.toml")
+    with open(config, "w") as f:
+        f.write(template)
+    with quiet():
+        start = time.perf_counter()
+        results = run_batch_processing(config=config, batch=scenes_dir, batch_subtables=batch_subtables,
+                                       platform="sentinel-1", output_dir=output_dir, pattern="*.zip",
+                                       cleanup=cleanup, batch_step=1, jobs=jobs, profile=True, **kwargs)
+        elapsed = time.perf_counter() - start
+    failed = [x for x in results if x.error is not None]
+    if failed:
+        raise RuntimeError(f"{len(failed)} batch items failed:\n{failed[0].error}")
+    records = read_gpt_records(os.path.join(output_dir, "traces"))
+    peak = max((x.peak_scratch or 0 for x in results), default=0)
+    shutil.rmtree(output_dir)
+    return {"items": len(results), "gpt_calls": len(records), "wall_s": elapsed,
+            "gpt_wall_s": sum(x["wall_time"] for x in records), "peak_scratch_bytes": peak}
+
+def bench_metadata(work_dir: str, n: int) -> dict:
+    """
+    Metadata extraction throughput of SAFE zips and BEAM-DIMAP headers.
+    """
+    from pysnaptoolbox.dates import get_datetime
+    from pysnaptoolbox.metadata import SceneIndex, read_scene_metadata
+
+    scenes = generate_scenes(os.path.join(work_dir, f"metadata_{n}"), n)
+    dims = [write_dim(os.path.join(work_dir, f"metadata_{n}", f"product_{i}.dim"),
+                      datetime(2022, 1, 1) + timedelta(days=i)) for i in range(n)]
+    index_file = os.path.join(work_dir, f"scenes_{n}.json")
+
+    cold = timed(SceneIndex(index_file).scan, scenes)
+    warm = timed(SceneIndex(index_file).scan, scenes)
+    datetimes = timed(lambda: [get_datetime("sentinel-1", x) for x in scenes])
+    dim_time = timed(lambda: [read_scene_metadata(x) for x in dims])
+    return {
+        "cold_scan_s": cold,
+        "warm_scan_s": warm,
+        "get_datetime_s": datetimes,
+        "dim_read_s": dim_time,
+        "scenes_per_s": n / cold,
+    }
+
+def bench_registry(work_dir: str, n: int) -> dict:
+    """
+    Cost of building the operator registry and of looking up operators.
+    """
+    from pysnaptoolbox.registry import OperatorRegistry
+
+    cache_file = os.path.join(work_dir, "registry", "operators.json")
+    if os.path.isfile(cache_file):
+        os.remove(cache_file)
+    # Without a cache file the registry introspects all operators at once
+    cold = timed(lambda: OperatorRegistry(cache_file))
+    loaded = OperatorRegistry(cache_file)
+    warm = timed(lambda: [loaded.get(OPERATORS[i % len(OPERATORS)]) for i in range(n * 100)])
+    return {"cold_introspection_s": cold, "warm_lookups_s": warm, "lookups_per_s": n * 100 / warm}
+
+def bench_batch(work_dir: str, n: int) -> dict:
+    """
+    Orchestration overhead of batch processing with instant stand-ins, which
+    is the wall time of the batch that is not spent in gpt calls. A single
+    job runs the gpt calls one after the other.
+    """
+    scenes_dir = os.path.join(work_dir, f"batch_{n}")
+    generate_scenes(scenes_dir, n)
+    result = run_batch(work_dir, scenes_dir)
+    overhead = result["wall_s"] - result["gpt_wall_s"]
+    result.update({
+        "overhead_s": overhead,
+        "overhead_per_call_s": overhead / max(result["gpt_calls"], 1),
+    })
+    return result
+
+def bench_scaling(work_dir: str, n: int, jobs_list: list = (1, 2, 4), sleep: float = 0.2) -> dict:
+    """
+    Scaling of batch processing with the number of jobs when every gpt call
+    takes `sleep` seconds.
+    """
+    scenes_dir = os.path.join(work_dir, f"scaling_{n}")
+    generate_scenes(scenes_dir, n)
+    os.environ["FAKE_GPT_SLEEP"] = str(sleep)
+    try:
+        results = {}
+        for jobs in jobs_list:
+            results[f"jobs_{jobs}_wall_s"] = run_batch(work_dir, scenes_dir, jobs=jobs)["wall_s"]
+    finally:
+        os.environ["FAKE_GPT_SLEEP"] = "0"
+    for jobs in jobs_list[1:]:
+        results[f"jobs_{jobs}_speedup"] = results[f"jobs_{jobs_list[0]}_wall_s"] / results[f"jobs_{jobs}_wall_s"]
+    return results
+
+def bench_graph_batch(work_dir: str, n: int, graph_batch: int = 8, sleep: float = 0.5) -> dict:
+    """
+    Gain of packing single scene items into graphs of graph_batch branches
+    when every gpt call has a startup time of `sleep` seconds. Both runs fuse
+    the steps of an item so only the packing is compared.
+    """
+    scenes_dir = os.path.join(work_dir, f"graph_batch_{n}")
+    generate_scenes(scenes_dir, n)
+    os.environ["FAKE_GPT_SLEEP"] = str(sleep)
+    try:
+        single = run_batch(work_dir, scenes_dir, template=SUBSET_TEMPLATE, batch_subtables="image1",
+                           fuse_graphs=True)
+        packed = run_batch(work_dir, scenes_dir, template=SUBSET_TEMPLATE, batch_subtables="image1",
+                           fuse_graphs=True, graph_batch=graph_batch)
+    finally:
+        os.environ["FAKE_GPT_SLEEP"] = "0"
+    return {
+        "single_wall_s": single["wall_s"],
+        "single_gpt_calls": single["gpt_calls"],
+        f"graph_batch_{graph_batch}_wall_s": packed["wall_s"],
+        f"graph_batch_{graph_batch}_gpt_calls": packed["gpt_calls"],
+        "speedup": single["wall_s"] / packed["wall_s"],
+    }
+
+def bench_cleanup(work_dir: str, n: int, output_size: int = 8 * 1024**2) -> dict:
+    """
+    Cost of removing intermediate products and the peak scratch usage with
+    and without cleanup of a chain of steps.
+    """
+    scenes_dir = os.path.join(work_dir, f"cleanup_{n}")
+    generate_scenes(scenes_dir, n)
+    os.environ["FAKE_GPT_OUTPUT_SIZE"] = str(output_size)
+    try:
+        keep = run_batch(work_dir, scenes_dir, cleanup=False, template=CHAIN_TEMPLATE, batch_subtables="image1")
+        remove = run_batch(work_dir, scenes_dir, cleanup=True, template=CHAIN_TEMPLATE, batch_subtables="image1")
+    finally:
+        os.environ["FAKE_GPT_OUTPUT_SIZE"] = "1024"
+    return {
+        "no_cleanup_wall_s": keep["wall_s"],
+        "cleanup_wall_s": remove["wall_s"],
+        "cleanup_cost_s": remove["wall_s"] - keep["wall_s"],
+        "no_cleanup_peak_scratch_bytes": keep["peak_scratch_bytes"],
+        "cleanup_peak_scratch_bytes": remove["peak_scratch_bytes"],
+    }
+
+def bench_snaphu(work_dir: str, n: int) -> dict:
+    """
+    Overhead of preparing and running SNAPHU on exported interferograms.
+    """
+    from pysnaptoolbox.snaphu import run_snaphu
+
+    export_dir = os.path.join(work_dir, f"snaphu_{n}")
+    for i in range(n):
+        write_snaphu_export(os.path.join(export_dir, f"pair_{i}"), 1024)
+    start = time.perf_counter()
+    with quiet():
+        for i in range(n):
+            run_snaphu(export_dir, {}, f"pair_{i}", cpus=1)
+    elapsed = time.perf_counter() - start
+    return {"wall_s": elapsed, "per_run_s": elapsed / n}
+
+def bench_planning(work_dir: str, n: int) -> dict:
+    """
+    Cost of sorting scenes by time, pairing them with each strategy, and
+    creating the workflow overlays of the items.
+    """
+    import random
+
+    import toml
+
+    from pysnaptoolbox.metadata import SceneMetadata
+    from pysnaptoolbox.planner import ScenePlan, overlay_workflow
+
+    scenes = []
+    for i in range(n):
+        scene = SceneMetadata(os.path.join(work_dir, f"scene_{i:05d}.zip"))
+        scene.start_time = datetime(2017, 1, 1) + timedelta(days=6 * i)
+        scenes.append(scene)
+    random.Random(0).shuffle(scenes)
+    config = toml.loads(BATCH_TEMPLATE)
+    result = {"sort_s": timed(ScenePlan, scenes)}
+    plan = ScenePlan(scenes)
+    for strategy, options in [("sequential", {}), ("reference", {}),
+                              ("sbas", {"max_baseline": 48, "max_connections": 4})]:
+        result[f"{strategy}_s"] = timed(lambda: list(plan.pairs(strategy, 2, **options)))
+    pairs = list(plan.pairs("sbas", 2, max_baseline=48, max_connections=4))
+    result["sbas_pairs"] = len(pairs)
+    result["overlay_s"] = timed(lambda: [overlay_workflow(config, ["image1", "image2"], x) for x in pairs])
+    return result
+
+def bench_startup(work_dir: str, n: int) -> dict:
+    """
+    Python side time of launching a workflow of n subtables with main.py,
+    the first time and again with the cached plan, compared with the startup
+    of a gpt call.
+    """
+    import re
+
+    from pysnaptoolbox.config import TomlConfig
+
+    scene = generate_scenes(os.path.join(work_dir, f"startup_{n}"), 1)[0]
+    config = os.path.join(work_dir, f"startup_{n}.toml")
+    with open(config, "w") as f:
+        f.write(f'[sources]\nscene = "{scene}"\n')
+        for i in range(n):
+            f.write(SUBSET_TEMPLATE.replace("image1", f"image{i}").replace('source = "x"', 'source = "$scene"'))
+    main = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+    result = {
+        "import_s": timed(subprocess.run, [sys.executable, main, "--help"], check=True, capture_output=True),
+        "load_s": timed(TomlConfig().load_config, config),
+    }
+    output_dir = tempfile.mkdtemp(dir=work_dir)
+    for run in ["cold", "warm"]:
+        output = subprocess.run([sys.executable, main, "--workflow", config, "--platform", "sentinel-1",
+                                 "--output-dir", output_dir], check=True, capture_output=True, text=True).stdout
+        # Plan load and compile times reported by main.py
+        load, compile_time = re.search(r"plan in ([\d.]+) s and compiled GPT commands in ([\d.]+) s", output).groups()
+        result[f"{run}_plan_s"] = float(load) + float(compile_time)
+    result["gpt_startup_s"] = measure_gpt_startup()
+    result["warm_startup_per_gpt_startup"] = (result["import_s"] + result["warm_plan_s"]) / result["gpt_startup_s"]
+    shutil.rmtree(output_dir)
+    return result
+
+class RangeCountingClient:
+
+    def __init__(self, client) -> None:
+        """
+        S3 client wrapper that counts the range requests and the bytes they
+        return.
+        """
+        self.client = client
+        self.range_requests = 0
+        self.range_bytes = 0
+
+    def get_object(self, **kwargs):
+        response = self.client.get_object(**kwargs)
+        if "Range" in kwargs:
+            self.range_requests += 1
+            self.range_bytes += response["ContentLength"]
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+def bench_s3_probe(work_dir: str, n: int, measurement_size: int = 16 * 1024**2) -> dict:
+    """
+    Metadata probing of SAFE zips in a local moto S3 stand-in. The metadata
+    must match the generated scenes and only the zip central directory and
+    the manifest may be fetched with range requests.
+    """
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        print("WARNING: boto3 and moto are needed for the s3 benchmark")
+        return {}
+    from zipfile import ZipFile
+
+    from pysnaptoolbox.metadata import read_scene_metadata
+    from pysnaptoolbox.s3 import probe_s3_scene
+
+    scenes = generate_scenes(os.path.join(work_dir, f"s3_{n}"), n, measurement_size)
+    for key in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+        os.environ[key] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="scenes")
+        for scene in scenes:
+            client.upload_file(scene, "scenes", f"batch/{os.path.basename(scene)}")
+        counting = RangeCountingClient(client)
+        start = time.perf_counter()
+        with quiet():
+            probed = [probe_s3_scene(f"s3://scenes/batch/{os.path.basename(x)}", counting) for x in scenes]
+        elapsed = time.perf_counter() - start
+
+    for scene, metadata in zip(scenes, probed):
+        expected = read_scene_metadata(scene)
+        for name in ["start_time", "stop_time", "platform", "orbit", "relative_orbit", "polarisations", "subswaths"]:
+            if getattr(metadata, name) != getattr(expected, name):
+                raise RuntimeError(f"Metadata {name} of the S3 scene {scene} is {getattr(metadata, name)} "
+                                   f"instead of {getattr(expected, name)}")
+        if metadata.size != os.path.getsize(scene):
+            raise RuntimeError(f"Size of the S3 scene {scene} is {metadata.size} instead of {os.path.getsize(scene)}")
+    # The central directory and the manifest with its local header are read
+    # in blocks of 64 KB, which adds at most two blocks to each of them
+    needed = 0
+    for scene in scenes:
+        with ZipFile(scene) as archive:
+            manifest = archive.getinfo(f"{os.path.basename(scene)[:-4]}.SAFE/manifest.safe")
+            needed += os.path.getsize(scene) - archive.start_dir + manifest.compress_size + 1024
+    if counting.range_bytes > needed + n * 4 * 64 * 1024:
+        raise RuntimeError(f"Probing {n} S3 scenes fetched {counting.range_bytes} bytes, which is more than the "
+                           f"zip central directories and manifests ({needed} bytes)")
+    return {
+        "probe_s": elapsed,
+        "scenes_per_s": n / elapsed,
+        "range_requests_per_scene": counting.range_requests / n,
+        "range_bytes_per_scene": counting.range_bytes // n,
+        "needed_bytes_per_scene": needed // n,
+    }
+
+BENCHMARKS = {
+    "metadata": bench_metadata,
+    "registry": bench_registry,
+    "batch": bench_batch,
+    "scaling": bench_scaling,
+    "graph_batch": bench_graph_batch,
+    "cleanup": bench_cleanup,
+    "snaphu": bench_snaphu,
+    "planning": bench_planning,
+    "startup": bench_startup,
+    "s3": bench_s3_probe,
+}
+
+# Benchmarks where the size is fixed because larger sizes only repeat the
+# same measurement
+FIXED_SIZES = {"scaling": 16, "graph_batch": 32, "cleanup": 10, "startup": 20, "s3": 10}
+
+def compare_results(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Get the time measurements that are slower than the baseline by more than
+    tolerance.
+    """
+    regressions = []
+    for key, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(key, {}).get(metric)
+            if not metric.endswith("_s") or not reference:
+                continue
+            if value > reference * (1 + tolerance):
+                regressions.append(f"{key} {metric}: {value:.3f} s vs {reference:.3f} s")
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks of pysnap-toolbox using stand-in gpt and snaphu executables')
+    parser.add_argument('--benchmarks', help='Comma separated list of benchmarks to run', default=",".join(BENCHMARKS))
+    parser.add_argument('--sizes', help='Comma separated list of batch sizes', default="10,100,1000")
+    parser.add_argument('--output', help='JSON file where the results are saved', default=None)
+    parser.add_argument('--compare', help='JSON file of previous results. Exits with an error if a time measurement \
+                        is slower than the previous one by more than the tolerance', default=None)
+    parser.add_argument('--tolerance', help='Allowed slowdown compared to previous results', type=float, default=0.2)
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="pysnap-benchmarks-")
+    results = {}
+    try:
+        with fake_environment(work_dir, gpt_sleep=0, snaphu_sleep=0, gpt_output_size=1024):
+            for name in args.benchmarks.split(","):
+                sizes = [FIXED_SIZES[name]] if name in FIXED_SIZES else [int(x) for x in args.sizes.split(",")]
+                for n in sizes:
+                    key = f"{name}_{n}"
+                    results[key] = BENCHMARKS[name](work_dir, n)
+                    print(key)
+                    for metric, value in results[key].items():
+                        print(f"  {metric:<32} {value:.4f}" if isinstance(value, float) else f"  {metric:<32} {value}")
+    finally:
+        if args.keep:
+            print("INFO: Working directory", work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("ERROR: Regression", regression)
+        sys.exit(1 if regressions else 0)
@@ -1,5 +1,12 @@
 import argparse
+import time
+from pysnaptoolbox.bursts import apply_aoi, load_aoi
+from pysnaptoolbox.subswaths import expand_subswaths
+from pysnaptoolbox.tiles import expand_tiles
 from pysnaptoolbox.config import Runner, TomlConfig
+from pysnaptoolbox.plancache import get_plan_key, load_plan, save_plan
+from pysnaptoolbox.profiling import TraceWriter, summarize_traces
+from pysnaptoolbox.tuning import GptTuner, learn_profiles, load_learned_profiles
 
 def main(**kwargs):
     Runner(**kwargs)
@@ -21,6 +28,13 @@ if __name__ == "__main__":
     main_args_group.add_argument("--workflow", help='Type of workflow')
     main_args_group.add_argument("--platform", help="Satellite platform used to capture data")
     main_args_group.add_argument("--output-dir", help="Path of output directory")
+    main_args_group.add_argument("--fuse-graphs", action="store_true", help="Run each workflow subtable as a single SNAP graph")
+    main_args_group.add_argument("--max-workers", type=int, default=1, help="Number of independent workflow subtables to run at the same time")
+    main_args_group.add_argument("--trace", help="Trace file where the resources used by every GPT call are written")
+    main_args_group.add_argument("--trace-format", choices=["jsonl", "chrome"], default="jsonl", help="Format of the trace file")
+    main_args_group.add_argument("--aoi", help="Area of interest as a WKT polygon or the path of a WKT or GeoJSON file", default=None)
+    main_args_group.add_argument("--no-plan-cache", action="store_true", help="Compile the workflow again instead of using the plan cached next to the TOML file")
+    main_args_group.add_argument("--learned-profiles", help="JSON file of the peak memory and parallelism of GPT steps learned from traces", default=None)
     # main_args_group.add_argument('--images', help='Type of workflow', nargs='+', type=str)
     
     # batch_args = main_parser.add_argument_group("Batch Processing")
@@ -42,7 +56,38 @@ if __name__ == "__main__":
     #         user_args[key] = arg_split[1]
 
     args = vars(main_parser.parse_args())
+    start = time.perf_counter()
     config = TomlConfig()
     config.load_config(args["workflow"])
-    output = Runner(config, args["platform"], args["output_dir"])
-    output.run_config()
+    aoi = args["aoi"] or config.get("aoi")
+    # Workflows that were run before reuse the plan compiled by that run
+    plan_key = get_plan_key(args["workflow"], config, platform=args["platform"], output_dir=args["output_dir"],
+                            fuse_graphs=args["fuse_graphs"], max_workers=args["max_workers"], aoi=aoi)
+    plan = None if args["no_plan_cache"] else load_plan(args["workflow"], plan_key)
+    if plan is not None:
+        config["workflow"] = config.sub_workflow_data = plan["workflow"]
+        max_workers = plan["max_workers"]
+    else:
+        # Only the bursts intersecting the AOI are processed
+        aoi = load_aoi(aoi) if aoi else None
+        # Subswath lists and "auto" are expanded into one branch per subswath
+        subswath_width = expand_subswaths(config, aoi=aoi)
+        if aoi is not None:
+            apply_aoi(config, aoi)
+        # Subswath branches and tiles run at the same time
+        max_workers = max(args["max_workers"], subswath_width, expand_tiles(config, aoi))
+        plan = {"workflow": config["workflow"], "max_workers": max_workers}
+    cached = "sections" in plan
+    startup_time = time.perf_counter() - start
+    trace = TraceWriter(args["trace"], args["trace_format"]) if args["trace"] else None
+    tuner = GptTuner(max_workers, config.get("resources"), load_learned_profiles(args["learned_profiles"]))
+    output = Runner(config, args["platform"], args["output_dir"], fuse_graphs=args["fuse_graphs"],
+                    max_workers=max_workers, trace=trace, tuner=tuner, plan=plan)
+    try:
+        output.run_config()
+    finally:
+        save_plan(args["workflow"], plan_key, plan)
+    print(f"INFO: Loaded the {'cached' if cached else 'new'} workflow plan in {startup_time:.3f} s and compiled "
+          f"GPT commands in {output.compile_time:.3f} s")
+    if trace is not None:
+        learn_profiles(summarize_traces([trace.trace_file]), args["learned_profiles"])
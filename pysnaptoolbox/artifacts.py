@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+# Content-addressed store of step outputs used to skip steps that were
+# already computed
+
+# Increase when the key or the layout of the store changes
+STORE_VERSION = 1
+
+# Scene names are unique so these sources are identified without their
+# modification time which changes when they are downloaded again
+SCENE_EXTENSIONS = (".zip", ".SAFE")
+
+# Age in seconds after which unfinished temp entries are removed
+STALE_TMP_AGE = 24 * 3600
+
+def _data_dir(dim_file: str) -> str:
+    return dim_file[:-len(".dim")] + ".data" if dim_file.endswith(".dim") else None
+
+def _link_or_copy(src: str, dst: str) -> None:
+    # Hard links make storing and fetching products free on the same volume
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def link_product(src: str, dst: str) -> None:
+    """
+    Link or copy a BEAM-DIMAP product including its .data directory.
+    """
+    _link_or_copy(src, dst)
+    src_data = _data_dir(src)
+    if src_data and os.path.isdir(src_data):
+        shutil.copytree(src_data, _data_dir(dst), copy_function=_link_or_copy)
+
+def remove_product(path: str) -> None:
+    """
+    Remove a BEAM-DIMAP product including its .data directory if it exists.
+    """
+    if os.path.isfile(path):
+        os.remove(path)
+    data_dir = _data_dir(path)
+    if data_dir and os.path.isdir(data_dir):
+        shutil.rmtree(data_dir)
+
+def get_size(path: str) -> int:
+    """
+    Get the size in bytes of a file or of all files in a directory.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+class ArtifactStore:
+
+    def __init__(self, root: str, max_size: int = None, snap_version: str = "") -> None:
+        """
+        Store of finished step outputs keyed by a hash of the operator,
+        parameters, SNAP version, and the identity of the inputs. Each entry is
+        a directory containing the product and a manifest.json. Entries are
+        published atomically by renaming a temp directory, so an interrupted
+        step never leaves an entry that looks finished. The least recently used
+        entries are removed once the store is larger than max_size bytes.
+        """
+        self.root = root
+        self.max_size = max_size
+        self.snap_version = snap_version
+        # Keys of the products created or fetched by this process
+        self.keys = {}
+        os.makedirs(root, exist_ok=True)
+
+    def identity(self, path: str) -> str:
+        """
+        Get the identity of a step input. Outputs of previous steps are
+        identified by their key even if they were never written to disk.
+        """
+        path = os.path.abspath(path)
+        if path in self.keys:
+            return f"artifact:{self.keys[path]}"
+        if not os.path.exists(path):
+            return f"path:{path}"
+        size = get_size(path)
+        if path.endswith(SCENE_EXTENSIONS):
+            return f"scene:{os.path.basename(path)}:{size}"
+        return f"file:{path}:{size}:{os.stat(path).st_mtime_ns}"
+
+    def step_key(self, operator: str, parameters: dict, sources: list) -> str:
+        """
+        Get the key of a step from its operator, parameters, and sources.
+        """
+        data = {
+            "version": STORE_VERSION,
+            "snap_version": self.snap_version,
+            "operator": operator,
+            "parameters": parameters or {},
+            "sources": [self.identity(x) for x in sources],
+        }
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def register(self, target: str, key: str) -> None:
+        """
+        Register the key of a step output so steps using it as a source can
+        compute their key before the output exists.
+        """
+        self.keys[os.path.abspath(target)] = key
+
+    def fetch(self, key: str, target: str) -> bool:
+        """
+        Link a stored product to the target path. Returns False if the key is
+        not in the store.
+        """
+        entry = os.path.join(self.root, key)
+        manifest = os.path.join(entry, "manifest.json")
+        try:
+            with open(manifest) as f:
+                product = os.path.join(entry, json.load(f)["product"])
+            remove_product(target)
+            link_product(product, target)
+        except (OSError, ValueError, KeyError):
+            # Missing entry or removed by another process while linking
+            remove_product(target)
+            return False
+        # The modification time of the manifest is used for LRU eviction
+        os.utime(manifest)
+        self.register(target, key)
+        return True
+
+    def publish(self, key: str, target: str, operator: str = None) -> None:
+        """
+        Add a finished product to the store.
+        """
+        entry = os.path.join(self.root, key)
+        if os.path.isdir(entry) or not os.path.isfile(target):
+            return
+        tmp_entry = os.path.join(self.root, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_entry)
+        try:
+            link_product(target, os.path.join(tmp_entry, os.path.basename(target)))
+            with open(os.path.join(tmp_entry, "manifest.json"), "w") as f:
+                json.dump({
+                    "product": os.path.basename(target),
+                    "operator": operator,
+                    "snap_version": self.snap_version,
+                    "size": get_size(tmp_entry),
+                    "created": time.time(),
+                }, f, indent=1)
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another process published the same key first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.register(target, key)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until the store is smaller than
+        max_size. Entries used by this process are kept.
+        """
+        if self.max_size is None:
+            return
+        used = set(self.keys.values())
+        entries = []
+        total = 0
+        for key in os.listdir(self.root):
+            path = os.path.join(self.root, key)
+            # Remove temp entries left behind by interrupted processes
+            if key.startswith(".tmp-"):
+                if time.time() - os.path.getmtime(path) > STALE_TMP_AGE:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            manifest = os.path.join(self.root, key, "manifest.json")
+            try:
+                with open(manifest) as f:
+                    size = json.load(f)["size"]
+                entries.append((os.path.getmtime(manifest), size, key))
+            except (OSError, ValueError, KeyError):
+                continue
+            total += size
+        for _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key in used:
+                continue
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            total -= size
+
+if __name__ == "__main__":
+    pass
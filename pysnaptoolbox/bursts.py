@@ -0,0 +1,301 @@
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+from zipfile import ZipFile
+
+from .scheduler import get_source_references
+
+# Tools used to select the Sentinel-1 TOPS bursts that cover an area of interest
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+def _parse_ring(text: str) -> list:
+    return [tuple(float(x) for x in point.split()[:2]) for point in text.split(",")]
+
+def parse_wkt(wkt: str) -> list:
+    """
+    Parse a WKT POLYGON or MULTIPOLYGON into a list of polygons. Each polygon
+    is the list of (lon, lat) points of its outer ring. Holes are ignored.
+    """
+    wkt = wkt.strip()
+    kind = wkt.split("(", 1)[0].strip().upper()
+    if kind not in ["POLYGON", "MULTIPOLYGON"]:
+        raise ValueError(f"Unsupported AOI geometry: {kind}. Only POLYGON and MULTIPOLYGON are supported")
+    polygons = []
+    # The outer ring of every polygon is the first ring after "((" in POLYGON
+    # or after "((" of each part in MULTIPOLYGON
+    for match in re.finditer(r"\(\s*\(([^()]+)\)", wkt):
+        polygons.append(_parse_ring(match.group(1)))
+    if not polygons:
+        raise ValueError(f"Cannot parse AOI geometry: {wkt}")
+    return polygons
+
+def parse_geojson(data: dict) -> list:
+    """
+    Get the outer rings of the Polygon and MultiPolygon geometries of a
+    GeoJSON geometry, Feature, or FeatureCollection.
+    """
+    kind = data.get("type")
+    if kind == "FeatureCollection":
+        return [x for feature in data["features"] for x in parse_geojson(feature)]
+    if kind == "Feature":
+        return parse_geojson(data["geometry"])
+    if kind == "Polygon":
+        return [[tuple(x[:2]) for x in data["coordinates"][0]]]
+    if kind == "MultiPolygon":
+        return [[tuple(x[:2]) for x in polygon[0]] for polygon in data["coordinates"]]
+    raise ValueError(f"Unsupported AOI geometry: {kind}. Only Polygon and MultiPolygon are supported")
+
+def load_aoi(value: str) -> list:
+    """
+    Load an area of interest from a WKT string, a GeoJSON string, or the path
+    of a WKT or GeoJSON file.
+
+    Returns
+    -------
+    list
+        List of polygons where each polygon is a list of (lon, lat) points.
+    """
+    if os.path.isfile(value):
+        with open(value) as f:
+            value = f.read()
+    value = value.strip()
+    if value.startswith("{"):
+        return parse_geojson(json.loads(value))
+    return parse_wkt(value)
+
+def _orientation(a: tuple, b: tuple, c: tuple) -> float:
+    return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+def _on_segment(a: tuple, b: tuple, c: tuple) -> bool:
+    return min(a[0], b[0]) <= c[0] <= max(a[0], b[0]) and min(a[1], b[1]) <= c[1] <= max(a[1], b[1])
+
+def segments_intersect(a: tuple, b: tuple, c: tuple, d: tuple) -> bool:
+    """
+    Check if the segments ab and cd intersect or touch.
+    """
+    d1 = _orientation(c, d, a)
+    d2 = _orientation(c, d, b)
+    d3 = _orientation(a, b, c)
+    d4 = _orientation(a, b, d)
+    if ((d1 > 0 > d2) or (d1 < 0 < d2)) and ((d3 > 0 > d4) or (d3 < 0 < d4)):
+        return True
+    return ((d1 == 0 and _on_segment(c, d, a)) or (d2 == 0 and _on_segment(c, d, b))
+            or (d3 == 0 and _on_segment(a, b, c)) or (d4 == 0 and _on_segment(a, b, d)))
+
+def point_in_polygon(point: tuple, polygon: list) -> bool:
+    """
+    Check if a point is inside a polygon using ray casting.
+    """
+    x, y = point
+    inside = False
+    n = len(polygon)
+    for i in range(n):
+        (x1, y1), (x2, y2) = polygon[i], polygon[(i + 1) % n]
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+    return inside
+
+def polygons_intersect(a: list, b: list) -> bool:
+    """
+    Check if two simple polygons overlap or touch. Polygons are lists of
+    (lon, lat) points and do not need to be closed.
+    """
+    # Bounding boxes first as most bursts are far from the AOI
+    if (max(x[0] for x in a) < min(x[0] for x in b) or max(x[0] for x in b) < min(x[0] for x in a)
+            or max(x[1] for x in a) < min(x[1] for x in b) or max(x[1] for x in b) < min(x[1] for x in a)):
+        return False
+    for i in range(len(a)):
+        for j in range(len(b)):
+            if segments_intersect(a[i], a[(i + 1) % len(a)], b[j], b[(j + 1) % len(b)]):
+                return True
+    # One polygon is inside the other
+    return point_in_polygon(a[0], b) or point_in_polygon(b[0], a)
+
+def parse_annotation(file) -> dict:
+    """
+    Read the subswath, polarisation, burst size, and geolocation grid of a
+    Sentinel-1 annotation XML file object.
+    """
+    annotation = {"swath": None, "polarisation": None, "lines_per_burst": None, "bursts": 0, "grid": []}
+    point = {}
+    for _, elem in ET.iterparse(file, events=("end",)):
+        name = _local_name(elem.tag)
+        if name == "swath" and annotation["swath"] is None:
+            annotation["swath"] = elem.text
+        elif name == "polarisation" and annotation["polarisation"] is None:
+            annotation["polarisation"] = elem.text
+        elif name == "linesPerBurst":
+            annotation["lines_per_burst"] = int(elem.text)
+        elif name == "burstList":
+            annotation["bursts"] = int(elem.get("count", len(elem)))
+        elif name in ["line", "pixel"]:
+            point[name] = int(elem.text)
+        elif name in ["latitude", "longitude"]:
+            point[name] = float(elem.text)
+        elif name == "geolocationGridPoint":
+            annotation["grid"].append((point["line"], point["pixel"], point["longitude"], point["latitude"]))
+            point = {}
+        # Burst elements are only counted so they can be cleared
+        if name in ["burst", "geolocationGridPoint"]:
+            elem.clear()
+    return annotation
+
+def get_burst_footprints(annotation: dict) -> list:
+    """
+    Get the footprint of every burst of a subswath from the rows of the
+    geolocation grid closest to the first and last line of the burst.
+
+    Returns
+    -------
+    list
+        Footprint polygon of each burst in burst order.
+    """
+    rows = {}
+    for line, pixel, lon, lat in annotation["grid"]:
+        rows.setdefault(line, []).append((pixel, lon, lat))
+    lines = sorted(rows)
+    footprints = []
+    for i in range(annotation["bursts"]):
+        first = i * annotation["lines_per_burst"]
+        last = (i + 1) * annotation["lines_per_burst"] - 1
+        top = rows[min(lines, key=lambda x: abs(x - first))]
+        bottom = rows[min(lines, key=lambda x: abs(x - last))]
+        footprints.append([(x[1], x[2]) for x in sorted(top)] + [(x[1], x[2]) for x in sorted(bottom, reverse=True)])
+    return footprints
+
+def read_burst_footprints(path: str, s3_client=None) -> dict:
+    """
+    Read the burst footprints of every subswath of a Sentinel-1 SLC SAFE zip
+    file or .SAFE directory. Zip files in S3 are read using range requests
+    if an S3 client is given. Only the annotation of the first polarisation
+    of each subswath is read as all polarisations have the same bursts.
+
+    Returns
+    -------
+    dict
+        Dictionary of the burst footprints of each subswath such as
+        {"IW1": [polygon, ...], "IW2": [...]}.
+    """
+    footprints = {}
+
+    def read(names: list, open_member) -> None:
+        # Annotation files are in <name>.SAFE/annotation, calibration and
+        # noise files are in sub directories of it
+        names = sorted(x for x in names if os.path.basename(os.path.dirname(x)) == "annotation" and x.endswith(".xml"))
+        for name in names:
+            swath = os.path.basename(name).split("-")[1].upper()
+            if swath in footprints:
+                continue
+            with open_member(name) as f:
+                annotation = parse_annotation(f)
+            if annotation["bursts"] and annotation["grid"]:
+                footprints[annotation["swath"] or swath] = get_burst_footprints(annotation)
+
+    if path.startswith("s3://"):
+        from .s3 import S3RangeFile, parse_s3_uri
+
+        if s3_client is None:
+            raise ValueError(f"An S3 client is required to read the bursts of {path}")
+        bucket, key = parse_s3_uri(path)
+        size = s3_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        with S3RangeFile(s3_client, bucket, key, size) as f:
+            with ZipFile(f) as archive:
+                read(archive.namelist(), archive.open)
+    elif os.path.isdir(path):
+        annotation_dir = os.path.join(path, "annotation")
+        read([os.path.join(annotation_dir, x) for x in os.listdir(annotation_dir)], lambda x: open(x, "rb"))
+    else:
+        with ZipFile(path) as archive:
+            read(archive.namelist(), archive.open)
+    if not footprints:
+        raise LookupError(f"Cannot find burst geolocation in the annotations of {path}")
+    return footprints
+
+def select_bursts(footprints: dict, aoi: list) -> dict:
+    """
+    Get the range of bursts of each subswath that intersect the AOI.
+
+    Returns
+    -------
+    dict
+        Dictionary of the first and last burst index (starting at 1 as used by
+        TOPSAR-Split) of each subswath intersecting the AOI.
+    """
+    selected = {}
+    for swath, bursts in footprints.items():
+        indices = [i + 1 for i, burst in enumerate(bursts) if any(polygons_intersect(burst, x) for x in aoi)]
+        if indices:
+            selected[swath] = (min(indices), max(indices))
+    return selected
+
+def apply_aoi(config: dict, aoi: list, get_footprints=read_burst_footprints) -> list:
+    """
+    Fill the subswath and burst range of the TOPSAR-Split steps that read a
+    scene so only the bursts intersecting the AOI are processed. Steps where
+    firstBurstIndex or lastBurstIndex are set are not changed. If no subswath
+    is set, the subswath with the most intersecting bursts is used.
+    Subtables whose subswath does not intersect the AOI are removed together
+    with the subtables using them as $ sources.
+
+    Parameters
+    ----------
+    config: dict
+        Loaded TOML config. The workflow is changed in place. $ sources
+        referencing the [sources] table are resolved.
+    aoi: list
+        List of AOI polygons created by `load_aoi`.
+    get_footprints: callable
+        Function returning the burst footprints of a scene path.
+
+    Returns
+    -------
+    list
+        Names of the removed subtables.
+    """
+    workflow = config["workflow"]
+    sources = config.get("sources") or {}
+    removed = []
+    for name, steps in workflow.items():
+        step = steps[0]
+        source = step.get("source")
+        if isinstance(source, str) and source.startswith("$"):
+            source = sources.get(source[1:])
+        parameters = step.get("parameters") or {}
+        if step["operator"] != "TOPSAR-Split" or not isinstance(source, str):
+            continue
+        if "firstBurstIndex" in parameters or "lastBurstIndex" in parameters:
+            continue
+
+        bursts = select_bursts(get_footprints(source), aoi)
+        subswath = parameters.get("subswath")
+        if subswath is None and bursts:
+            subswath = max(bursts, key=lambda x: bursts[x][1] - bursts[x][0])
+            if len(bursts) > 1:
+                print(f"WARNING: AOI intersects subswaths {', '.join(sorted(bursts))} of {source}. Only {subswath} is "
+                      f"processed by workflow.{name}")
+        if subswath not in bursts:
+            print(f"INFO: Subswath {subswath} of {source} does not intersect the AOI. Removing workflow.{name}")
+            removed.append(name)
+            continue
+        parameters["subswath"] = subswath
+        parameters["firstBurstIndex"], parameters["lastBurstIndex"] = bursts[subswath]
+        step["parameters"] = parameters
+        print(f"INFO: Using bursts {bursts[subswath][0]} to {bursts[subswath][1]} of {subswath} of {source}")
+
+    # Remove the subtables that depend on removed subtables
+    changed = True
+    while changed:
+        changed = False
+        for name, steps in workflow.items():
+            if name not in removed and any(x in removed for x in get_source_references(steps)):
+                removed.append(name)
+                changed = True
+    for name in removed:
+        del workflow[name]
+    return removed
+
+if __name__ == "__main__":
+    pass
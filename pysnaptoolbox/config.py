@@ -1,10 +1,127 @@
+import json
 import os
-import subprocess
+import re
+import time
 
-import toml
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11 uses the toml package which has the same loads function
+    import toml as tomllib
 
-from .operators import get_output_suffix, operator_source_flags
-from .dates import get_datetime
+from .operators import get_output_suffix, has_positional_sources, operator_source_flags
+from .metadata import SceneIndex
+from .graph import split_graph_segments, write_graph
+from .profiling import TraceWriter, run_command
+from .scheduler import build_dependency_graph, run_dependency_graph
+from .tiles import get_tile_parameters, get_trim_parameters
+from .tuning import GptTuner
+
+# Escape sequences of TOML basic strings besides \uXXXX and \UXXXXXXXX
+TOML_ESCAPES = 'btnfr"\\'
+
+def _toml_escape_length(text: str, i: int, multiline: bool) -> int:
+    # Length of the valid escape sequence starting at the backslash at i or 0
+    char = text[i + 1:i + 2]
+    if char and char in TOML_ESCAPES:
+        return 2
+    for prefix, digits in [("u", 4), ("U", 8)]:
+        if char == prefix and re.fullmatch(r"[0-9A-Fa-f]{%d}" % digits, text[i + 2:i + 2 + digits]):
+            return 2 + digits
+    # Line ending backslash of multi-line basic strings
+    match = re.match(r"\\[ \t]*\r?\n", text[i:]) if multiline else None
+    return match.end() if match else 0
+
+def escape_toml_backslashes(text: str) -> str:
+    """
+    Escape the backslashes of TOML basic strings that do not start a valid
+    escape sequence so Windows paths such as "C:\\Users\\data" can be
+    written in basic strings. Valid escape sequences such as \\" or \\n,
+    literal strings, and comments are not changed.
+    """
+    out = []
+    i = 0
+    quote = None
+    while i < len(text):
+        if quote is None:
+            if text[i] == "#":
+                end = text.find("\n", i)
+                end = len(text) if end < 0 else end
+                out.append(text[i:end])
+                i = end
+                continue
+            for delimiter in ['"""', "'''", '"', "'"]:
+                if text.startswith(delimiter, i):
+                    quote = delimiter
+                    break
+            if quote is not None:
+                out.append(quote)
+                i += len(quote)
+                continue
+        elif text.startswith(quote, i):
+            out.append(quote)
+            i += len(quote)
+            quote = None
+            continue
+        elif text[i] == "\\" and quote[0] == '"':
+            length = _toml_escape_length(text, i, len(quote) == 3)
+            out.append(text[i:i + length] if length else "\\\\")
+            i += max(length, 1)
+            continue
+        out.append(text[i])
+        i += 1
+    return "".join(out)
+
+def load_toml(path: str, escape_backslashes: bool = False) -> dict:
+    """
+    Load a TOML file. If escape_backslashes is True, backslashes of basic
+    strings that are not TOML escape sequences are escaped so Windows paths
+    can be written in basic strings. See `escape_toml_backslashes`.
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    if escape_backslashes:
+        text = escape_toml_backslashes(text)
+    return tomllib.loads(text)
+
+def _toml_key(key: str) -> str:
+    return key if re.fullmatch(r"[A-Za-z0-9_-]+", key) else json.dumps(key)
+
+def _toml_value(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        # JSON string escapes are valid in TOML basic strings
+        return json.dumps(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_toml_value(x) for x in value) + "]"
+    if isinstance(value, dict):
+        return "{" + ", ".join(f"{_toml_key(k)} = {_toml_value(v)}" for k, v in value.items()) + "}"
+    raise TypeError(f"Cannot write {type(value).__name__} to TOML")
+
+def dumps_toml(data: dict, prefix: str = "") -> str:
+    """
+    Write a dictionary as TOML. Dictionaries are written as tables and lists
+    of dictionaries as arrays of tables. The standard library can only read
+    TOML so this is used to save workflows.
+    """
+    lines = []
+    tables = []
+    for key, value in data.items():
+        if isinstance(value, dict):
+            tables.append((key, value, False))
+        elif isinstance(value, list) and value and all(isinstance(x, dict) for x in value):
+            tables.append((key, value, True))
+        else:
+            lines.append(f"{_toml_key(key)} = {_toml_value(value)}\n")
+    for key, value, is_array in tables:
+        name = prefix + _toml_key(key)
+        for table in (value if is_array else [value]):
+            lines.append(f"\n[[{name}]]\n" if is_array else f"\n[{name}]\n")
+            lines.append(dumps_toml(table, name + "."))
+    return "".join(lines)
 
 class TomlConfig(dict):
     def __init__(self, *args, **kwargs):
@@ -23,23 +140,8 @@ class TomlConfig(dict):
         Load the TOML config file and re-initialize the TomlConfig object with
         the data from the TOML config file.
         """
-        with open(path) as f:
-            lines = f.readlines()
-        
-        # Iterate through lines and find ones with reserved escape sequences
-        # If exists, add an extra backslash to escape it
-        for i, line in enumerate(lines):
-            escaped_string = ""
-            if "\\" in line:
-                for char in line:
-                    if char == "\\":
-                        escaped_string += "\\\\"
-                    else:
-                        escaped_string += char
-                lines[i] = escaped_string
-        
-        # Reload class with TOML data
-        self.__init__(toml.loads("\n".join(lines)))
+        # Backslashes are escaped so Windows paths can be used as sources
+        self.__init__(load_toml(path, escape_backslashes=True))
         
         if "sources" in self.keys():
             self.sources = self["sources"]
@@ -71,15 +173,35 @@ class TomlConfig(dict):
 
 class Runner:
 
-    def __init__(self, config: TomlConfig, platform: str, output_dir: str, debug_mode: bool = False) -> None:
+    def __init__(self, config: TomlConfig, platform: str, output_dir: str, debug_mode: bool = False, fuse_graphs: bool = False,
+                 max_workers: int = 1, trace: TraceWriter = None, tuner: GptTuner = None, plan: dict = None) -> None:
         """
         Takes in a TomlConfig object and allows the user to run
-        SNAP processing methods.
+        SNAP processing methods. If fuse_graphs is True, the steps of each
+        workflow subtable are compiled into SNAP graphs so intermediate
+        products are not written to disk. Up to max_workers workflow
+        subtables that do not depend on each other are run at the same time.
+        If a trace is given, the resources used by every GPT call are written
+        to it. The heap, tile cache, and threads of every GPT call are chosen
+        by the tuner, which by default splits the machine between max_workers
+        jobs and uses the [resources] table of the config. The commands of
+        every subtable and the dependency graph are added to plan as they are
+        compiled, and subtables already in plan are run without compiling
+        them again. See `pysnaptoolbox.plancache`.
         """
         self.config = config
         self.platform = platform.upper()
         self.output_dir = output_dir
         self.debug_mode = debug_mode
+        self.fuse_graphs = fuse_graphs
+        self.max_workers = max_workers
+        self.trace = trace
+        self.tuner = tuner or GptTuner(max_workers, config.get("resources"))
+        self.scene_index = SceneIndex()
+        self.plan = plan if plan is not None else {}
+        self.plan.setdefault("sections", {})
+        # Time spent compiling subtables that were not in the plan
+        self.compile_time = 0.0
 
         # Initialize namespace
         self.namespace = self.config["sources"]
@@ -93,12 +215,12 @@ class Runner:
 
     def generate_cli_command(self, op: str, sources: str, target: str, param: dict):
         
-        if op in ["Back-Geocoding"]:
+        if has_positional_sources(op):
             # The sources will be the first arguments without any flag such as:
             # gpt Back-Geocoding img1.dim img2.dim param1=foo param2=bar
             cmd = f'gpt {op} '
             for file in sources.split(","):
-                cmd += file + " "
+                cmd += f'"{file}" '
         else:
             source_flag = operator_source_flags(op)
             cmd = f'gpt {op} -S{source_flag}="{sources}"'
@@ -117,7 +239,8 @@ class Runner:
         return cmd
     
     def get_source_files(self, sources, section: str):
-        print("DEBUG NAMESPACE", self.namespace)
+        if self.debug_mode:
+            print("DEBUG NAMESPACE", self.namespace)
 
         # We are expecting an array from sources
         source_string = ""
@@ -133,53 +256,145 @@ class Runner:
         source_string = source_string.rstrip(",")
         return source_string
     
-    def run_config(self):
-
+    def plan_section(self, section: str) -> list:
+        """
+        Resolve the source and target paths of every step in a workflow
+        subtable. Sources that reference other subtables using $ are resolved
+        from the namespace so those subtables need to be run beforehand.
+        """
+        steps = []
         target_file = ""
-        datetimes = []
-        for section in self.config.sub_workflow_data:
-            print("\nDEBUG: Starting new section")
-            for i, action in enumerate(self.config["workflow"][section]):
-
-                # Handle path namespace logic here then feed it into generate_cli_command
-                if action.get("source") is None and section not in self.namespace.keys():
-                    raise RuntimeError("No source is specified but existing path not found in namespace or config file")
-                elif action.get("source") is None and i == 0:
-                    raise RuntimeError(f"No source was specified for section {section} operator {action.get('operator')}")
-                elif action.get("source") is None:
-                    source = self.namespace[section]
+        tile_core = None
+        for i, action in enumerate(self.config["workflow"][section]):
+
+            # Handle path namespace logic here then feed it into generate_cli_command
+            if action.get("source") is None and i == 0:
+                raise RuntimeError(f"No source was specified for section {section} operator {action.get('operator')}")
+            elif action.get("source") is None:
+                source = steps[-1]["target"]
+            else:
+                source = self.get_source_files(action.get("source"), section)
+
+            # If the target file is empty, create new file basename from datetime
+            # If one date then do something like 20220623
+            # If two dates then do something lime 20220623_20220701
+            if i == 0:
+                for file in source.split(","):
+                    dt_obj = self.scene_index.get(file, self.platform).start_time
+                    target_file += dt_obj.strftime(r"%Y%m%d") #+ "_"
+                # Subswath branches of a subtable read the same scene
+                if action.get("subswath"):
+                    target_file += f"_{action['subswath']}"
+                if action.get("tile") is not None:
+                    target_file += f"_T{action['tile']['index'] + 1}"
+                target_file = os.path.join(self.output_dir, target_file) + ".dim"
+
+            # Append operator suffix to output filename
+            # suffix = get_output_suffix(action)
+            suffix = action.get("outputBasename")
+            target_file = target_file.replace(".dim", f"_{suffix}.dim")
+
+            # Tile regions are computed from the product that is tiled. Trim
+            # regions are computed when the processed tile is written.
+            parameters = action.get("parameters")
+            if action.get("tile") is not None:
+                tile_parameters, tile_core = get_tile_parameters(action["tile"], source)
+                parameters = dict(parameters, **tile_parameters)
+
+            step = {
+                "operator": action.get("operator"),
+                "parameters": parameters,
+                "source": action.get("source"),
+                "sources": source,
+                "target": target_file,
+            }
+            if action.get("trim") is not None:
+                step["trim"] = [action["trim"], tile_core]
+            steps.append(step)
+        return steps
+
+    def compile_section(self, section: str) -> list:
+        """
+        Compile the GPT commands of a workflow subtable.
+
+        Returns
+        -------
+        list
+            List of [steps, command, graph file] of every GPT call where the
+            graph file is None for single operator calls.
+        """
+        steps = self.plan_section(section)
+        if self.fuse_graphs:
+            segments = split_graph_segments(steps)
+        else:
+            segments = [[step] for step in steps]
+
+        compiled = []
+        for n, segment in enumerate(segments):
+            graph_file = None
+            if len(segment) == 1:
+                step = segment[0]
+                cmd = self.generate_cli_command(step["operator"], step["sources"], step["target"], step["parameters"])
+            else:
+                graph_file = os.path.join(self.output_dir, "graphs", f"{section}_{n}.xml")
+                write_graph(segment, segment[0]["sources"].split(","), segment[-1]["target"], graph_file)
+                cmd = f'gpt "{graph_file}"'
+            compiled.append([segment, cmd, graph_file])
+        return compiled
+
+    def run_section(self, section: str):
+        """
+        Run all steps of a workflow subtable. If graph fusion is enabled, chains
+        of steps are compiled into a single graph and run with one GPT call.
+        """
+        if self.debug_mode:
+            print(f"\nDEBUG: Starting new section {section}")
+        compiled = self.plan["sections"].get(section)
+        if compiled is None:
+            start = time.perf_counter()
+            compiled = self.compile_section(section)
+            self.compile_time += time.perf_counter() - start
+            self.plan["sections"][section] = compiled
+
+        for segment, cmd, graph_file in compiled:
+            # Trim steps start a segment and cut the core of the tile written
+            # by the previous segment
+            if segment[0].get("trim") is not None:
+                tile, core = segment[0]["trim"]
+                parameters = dict(segment[0]["parameters"], **get_trim_parameters(tile, core, segment[0]["sources"]))
+                segment = [dict(segment[0], parameters=parameters)] + segment[1:]
+                if graph_file is None:
+                    cmd = self.generate_cli_command(segment[0]["operator"], segment[0]["sources"],
+                                                    segment[0]["target"], parameters)
                 else:
-                    print("BLEH2", action.get("source"))
-                    source = self.get_source_files(action.get("source"), section)
-
-                # If the target file is empty, create new file basename from datetime
-                # If one date then do something like 20220623
-                # If two dates then do something lime 20220623_20220701
-                if i == 0:
-                    for file in source.split(","):
-                        dt_obj = get_datetime(self.platform, file)
-                        target_file += dt_obj.strftime(r"%Y%m%d") #+ "_"
-                    target_file = os.path.join(self.output_dir, target_file) + ".dim"
-
-                # Append operator suffix to output filename
-                # suffix = get_output_suffix(action)
-                suffix = action.get("outputBasename")
-                target_file = target_file.replace(".dim", f"_{suffix}.dim")
-                # print("DEBUG3:", target_file)
-
-                cmd = self.generate_cli_command(action.get("operator"), source, target_file, action.get("parameters"))
+                    write_graph(segment, segment[0]["sources"].split(","), segment[-1]["target"], graph_file)
+            # Graph files of a cached plan may have been removed with the
+            # output directory
+            if graph_file is not None and not os.path.isfile(graph_file):
+                write_graph(segment, segment[0]["sources"].split(","), segment[-1]["target"], graph_file)
+            options, env = self.tuner.options([x["operator"] for x in segment], segment[0]["sources"].split(","))
+            cmd += f" {options}"
+            if self.debug_mode:
                 print("DEBUG CMD", cmd)
-                # Run CLI command using subprocess
-                subprocess.call(cmd, shell=True)
+            # Run CLI command using subprocess
+            name = "+".join(x["operator"] for x in segment)
+            record = run_command(cmd, name, "gpt", segment[-1]["target"], self.trace, shell=True, env=env)
+            if record["exit_status"] != 0:
+                raise RuntimeError(f"GPT failed with exit status {record['exit_status']} in section {section}: {cmd}")
+
+            # Update path namespace after every segment
+            self.namespace[section] = segment[-1]["target"]
 
-                # Update path namespace after every action
-                self.namespace[section] = target_file
+    def run_config(self):
 
-            target_file = ""
+        # Subtables only depend on each other through $ source references
+        graph = self.plan.get("graph")
+        if graph is None:
+            graph = build_dependency_graph(self.config.sub_workflow_data, self.namespace)
+            self.plan["graph"] = graph
+        run_dependency_graph(graph, self.run_section, self.max_workers)
 
-            
         return
 
-
 if __name__ == "__main__":
     pass
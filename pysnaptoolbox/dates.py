@@ -1,44 +1,92 @@
+from contextlib import contextmanager
 from datetime import datetime
 import os
-import shutil
 import xml.etree.ElementTree as ET
 from zipfile import ZipFile
 
+SAFE_NAMESPACE = "http://www.esa.int/safe/sentinel-1.0"
+
+def find_manifest_member(archive: ZipFile) -> str:
+    """
+    Get the name of the manifest.safe member of a Sentinel-1 SAFE zip file.
+    """
+    # SAFE zips normally contain <name>.SAFE/manifest.safe so try that first
+    # before searching through all the members
+    if archive.filename:
+        stem = os.path.splitext(os.path.basename(archive.filename))[0]
+        try:
+            return archive.getinfo(f"{stem}.SAFE/manifest.safe").filename
+        except KeyError:
+            pass
+    for name in archive.namelist():
+        if name.endswith("manifest.safe"):
+            return name
+    raise LookupError(f"Cannot find manifest.safe in {archive.filename}")
+
+@contextmanager
+def open_manifest(path: str):
+    """
+    Open the manifest.safe of a Sentinel-1 product as a binary file object
+    without extracting anything to disk. The path can be a SAFE zip file, a
+    .SAFE directory, or the manifest.safe file itself.
+    """
+    if os.path.isdir(path):
+        with open(os.path.join(path, "manifest.safe"), "rb") as f:
+            yield f
+    elif path.endswith("manifest.safe"):
+        with open(path, "rb") as f:
+            yield f
+    else:
+        with ZipFile(path) as archive:
+            with archive.open(find_manifest_member(archive)) as f:
+                yield f
+
+def find_xml_text(file, tag: str) -> str:
+    """
+    Get the text of the first element with the given tag. The XML is parsed
+    incrementally and parsing stops as soon as the element is found so the
+    rest of the file is never read.
+
+    Parameters
+    ----------
+    file: str or file object
+        XML file to parse.
+    tag: str
+        Element tag including the namespace in {namespace}tag format.
+
+    Returns
+    -------
+    str
+        Text of the element or None if the element does not exist.
+    """
+    for _, elem in ET.iterparse(file, events=("end",)):
+        if elem.tag == tag:
+            return elem.text
+        elem.clear()
+    return None
+
 def get_datetime(platform: str, path: str):
 
     if path.endswith('.dim'):
-    
-        tree = ET.parse(path)
-        root = tree.getroot()
-        datetime_str = root.find(".//PRODUCT_SCENE_RASTER_START_TIME")
+
+        datetime_str = find_xml_text(path, "PRODUCT_SCENE_RASTER_START_TIME")
         if datetime_str is None:
             raise LookupError(f"Cannot find datetime from BEAM-DIMAP file {path}")
-        
-        if "T" in datetime_str.text:
-            dt_obj = datetime.strptime(datetime_str.text, r"%Y-%m-%dT%H:%M:%S.%f")
+
+        if "T" in datetime_str:
+            dt_obj = datetime.strptime(datetime_str, r"%Y-%m-%dT%H:%M:%S.%f")
         else:
-            dt_obj = datetime.strptime(datetime_str.text, r"%d-%b-%Y %H:%M:%S.%f")
+            dt_obj = datetime.strptime(datetime_str, r"%d-%b-%Y %H:%M:%S.%f")
 
     else:
+        platform = platform.upper()
         if platform == "SENTINEL-1":
-            # Extract manifest.safe file
-            with ZipFile(path) as f:
-                manifest = None
-                for item in f.filelist:
-                    if "manifest.safe" in item.filename:
-                        manifest = item.filename
-                f.extract(manifest, "")
-            
-            # Parse XML
-            tree = ET.parse(manifest)
-            metadata = tree.getroot()
-            datetime_str = metadata.find((".//safe:startTime"), {'safe': r"http://www.esa.int/safe/sentinel-1.0"})
+            # Read manifest.safe directly from the zip or SAFE directory
+            with open_manifest(path) as f:
+                datetime_str = find_xml_text(f, f"{{{SAFE_NAMESPACE}}}startTime")
             if datetime_str is None:
                 raise LookupError("cannot find scene start time in Sentinel-1 .SAFE file")
-            dt_obj = datetime.strptime(datetime_str.text, r"%Y-%m-%dT%H:%M:%S.%f")
-            
-            # Clean up
-            shutil.rmtree(os.path.dirname(manifest))
+            dt_obj = datetime.strptime(datetime_str, r"%Y-%m-%dT%H:%M:%S.%f")
         else:
             raise ValueError(f"Unsupported sensor: {platform}")
     return dt_obj
@@ -0,0 +1,217 @@
+import os
+import re
+import xml.etree.ElementTree as ET
+
+# Tools used to compile a chain of workflow steps into a single SNAP graph
+
+# Operators that have to write their output to disk before the next step can
+# run. These are never fused into a graph and split a chain into segments.
+GRAPH_BOUNDARY_OPERATORS = [
+    "SnaphuExport",
+    "SnaphuUnwrapping",  # custom operator
+    "SnaphuImport",
+]
+
+# Parameters that are set to imitate the SNAP GUI default values when the
+# operator is used as a graph node. See graphs/subset.xml
+GRAPH_PARAMETER_DEFAULTS = {
+    "Subset": {"copyMetadata": True},
+}
+
+def is_graph_boundary(operator: str) -> bool:
+    """
+    Check if an operator has to be run as a standalone step.
+
+    Parameters
+    ----------
+    operator: str
+        SNAP Operator as identified in the SNAP Graphs
+    """
+    return operator in GRAPH_BOUNDARY_OPERATORS
+
+def split_graph_segments(steps: list) -> list:
+    """
+    Split a list of workflow steps into segments that can each be run with
+    a single GPT call. Graph boundary operators are always placed in their own
+    segment. A step with its own source also starts a new segment because it
+    does not read the output of the previous step, and so does a step that
+    trims a tile because it reads the size of the processed tile.
+
+    Parameters
+    ----------
+    steps: list
+        List of step dictionaries containing at least the operator name and the
+        source key if the step defines its own source.
+
+    Returns
+    -------
+    list
+        List of segments where each segment is a list of steps.
+    """
+    segments = []
+    current = []
+    for i, step in enumerate(steps):
+        boundary = is_graph_boundary(step["operator"])
+        if current and (boundary or (i > 0 and step.get("source") is not None) or step.get("trim") is not None):
+            segments.append(current)
+            current = []
+        current.append(step)
+        if boundary:
+            segments.append(current)
+            current = []
+    if current:
+        segments.append(current)
+    return segments
+
+def format_graph_value(value) -> str:
+    """
+    Convert a TOML parameter value into the text used in a SNAP graph node.
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (list, tuple)):
+        return ",".join(format_graph_value(x) for x in value)
+    return str(value)
+
+def _unique_node_id(name: str, used: set) -> str:
+    # Imitate the SNAP Graph Builder naming of duplicate nodes e.g. Read(2)
+    node_id = name
+    count = 2
+    while node_id in used:
+        node_id = f"{name}({count})"
+        count += 1
+    used.add(node_id)
+    return node_id
+
+def _add_node(graph: ET.Element, node_id: str, operator: str, source_ids: list, parameters: dict) -> None:
+    node = ET.SubElement(graph, "node", id=node_id)
+    ET.SubElement(node, "operator").text = operator
+    sources = ET.SubElement(node, "sources")
+    for i, source_id in enumerate(source_ids):
+        tag = "sourceProduct" if i == 0 else f"sourceProduct.{i}"
+        ET.SubElement(sources, tag, refid=source_id)
+    params = ET.SubElement(node, "parameters", {"class": "com.bc.ceres.binding.dom.XppDomElement"})
+    for name, value in parameters.items():
+        ET.SubElement(params, name).text = format_graph_value(value)
+
+def _add_branch(graph: ET.Element, steps: list, sources: list, target: str, used: set) -> list:
+    # Read nodes for each input product
+    node_ids = []
+    previous = []
+    for source in sources:
+        node_id = _unique_node_id("Read", used)
+        _add_node(graph, node_id, "Read", [], {"file": source, "copyMetadata": True})
+        previous.append(node_id)
+        node_ids.append(node_id)
+
+    # Processing nodes where every step reads the output of the previous node
+    for step in steps:
+        operator = step["operator"]
+        if is_graph_boundary(operator):
+            raise ValueError(f"Operator '{operator}' cannot be used inside a graph")
+        parameters = dict(GRAPH_PARAMETER_DEFAULTS.get(operator, {}))
+        parameters.update(step.get("parameters") or {})
+        node_id = _unique_node_id(operator, used)
+        _add_node(graph, node_id, operator, previous, parameters)
+        previous = [node_id]
+        node_ids.append(node_id)
+
+    node_id = _unique_node_id("Write", used)
+    _add_node(graph, node_id, "Write", previous, {"file": target, "formatName": "BEAM-DIMAP"})
+    node_ids.append(node_id)
+    return node_ids
+
+def build_graph(steps: list, sources: list, target: str) -> ET.ElementTree:
+    """
+    Build a SNAP graph that reads the source products, runs every step in
+    order, and writes the result of the last step as a BEAM-DIMAP product.
+
+    Parameters
+    ----------
+    steps: list
+        List of step dictionaries with the operator and parameters keys.
+    sources: list
+        Paths of the products used as input for the first step.
+    target: str
+        Path of the output BEAM-DIMAP file.
+
+    Returns
+    -------
+    ET.ElementTree
+        SNAP graph that can be run using `gpt <graph.xml>`
+    """
+    tree, _ = build_graph_branches([(steps, sources, target)])
+    return tree
+
+def build_graph_branches(branches: list) -> tuple:
+    """
+    Build a SNAP graph with independent Read -> ... -> Write branches so
+    several products are processed by a single GPT call.
+
+    Parameters
+    ----------
+    branches: list
+        List of (steps, sources, target) of each branch as used by
+        `build_graph`.
+
+    Returns
+    -------
+    tuple
+        SNAP graph and a dictionary of the branch index of every node ID.
+    """
+    graph = ET.Element("graph", id="Graph")
+    ET.SubElement(graph, "version").text = "1.0"
+    used = set()
+    node_branches = {}
+    for k, (steps, sources, target) in enumerate(branches):
+        for node_id in _add_branch(graph, steps, sources, target, used):
+            node_branches[node_id] = k
+
+    tree = ET.ElementTree(graph)
+    ET.indent(tree)
+    return tree, node_branches
+
+def get_failed_branches(gpt_output: str, node_branches: dict) -> list:
+    """
+    Get the branches of a graph that caused a GPT error. SNAP reports graph
+    errors with the ID of the failing node such as "[NodeId: Subset(3)]".
+
+    Returns
+    -------
+    list
+        Sorted branch indices of the failing nodes found in the output.
+    """
+    node_ids = re.findall(r"\[NodeId: ([^\]]+)\]", gpt_output)
+    return sorted({node_branches[x] for x in node_ids if x in node_branches})
+
+def write_graph(steps: list, sources: list, target: str, graph_file: str) -> str:
+    """
+    Build a SNAP graph using `build_graph` and save it to an XML file.
+
+    Returns
+    -------
+    str
+        Path of the XML graph file.
+    """
+    tree = build_graph(steps, sources, target)
+    os.makedirs(os.path.dirname(os.path.abspath(graph_file)), exist_ok=True)
+    tree.write(graph_file, encoding="unicode")
+    return graph_file
+
+def write_graph_branches(branches: list, graph_file: str) -> dict:
+    """
+    Build a SNAP graph using `build_graph_branches` and save it to an XML
+    file.
+
+    Returns
+    -------
+    dict
+        Branch index of every node ID of the graph.
+    """
+    tree, node_branches = build_graph_branches(branches)
+    os.makedirs(os.path.dirname(os.path.abspath(graph_file)), exist_ok=True)
+    tree.write(graph_file, encoding="unicode")
+    return node_branches
+
+if __name__ == "__main__":
+    pass
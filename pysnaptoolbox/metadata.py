@@ -0,0 +1,233 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import os
+import threading
+import xml.etree.ElementTree as ET
+
+from .dates import open_manifest
+
+# Tools used to read and cache scene metadata
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+def _parse_time(value: str) -> datetime:
+    if value is None:
+        return None
+    if "T" in value:
+        return datetime.strptime(value, r"%Y-%m-%dT%H:%M:%S.%f")
+    return datetime.strptime(value, r"%d-%b-%Y %H:%M:%S.%f")
+
+
+class SceneMetadata:
+
+    def __init__(self, path: str) -> None:
+        """
+        Object to store the metadata of a scene that is needed for filename
+        generation and pairing.
+        """
+        self.path = path
+        self.start_time = None
+        self.stop_time = None
+        self.platform = None
+        self.orbit = None
+        self.relative_orbit = None
+        self.polarisations = []
+        self.subswaths = []
+        # Used to check if the cached metadata is still valid
+        self.size = None
+        self.mtime = None
+
+    def to_dict(self) -> dict:
+        data = dict(vars(self))
+        for key in ["start_time", "stop_time"]:
+            if data[key] is not None:
+                data[key] = data[key].isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        scene = cls(data["path"])
+        for key, value in data.items():
+            setattr(scene, key, value)
+        for key in ["start_time", "stop_time"]:
+            if data.get(key) is not None:
+                setattr(scene, key, datetime.fromisoformat(data[key]))
+        return scene
+
+def parse_manifest(file, scene: SceneMetadata) -> SceneMetadata:
+    """
+    Fill scene metadata from a Sentinel-1 manifest.safe file object. Parsing
+    stops at the end of the metadata section so the data object section is
+    never read.
+    """
+    family = number = None
+    for _, elem in ET.iterparse(file, events=("end",)):
+        name = _local_name(elem.tag)
+        if name == "metadataSection":
+            break
+        elif name == "familyName" and family is None:
+            family = elem.text
+        elif name == "number" and number is None:
+            number = elem.text
+        elif name == "orbitNumber" and elem.get("type") == "start":
+            scene.orbit = int(elem.text)
+        elif name == "relativeOrbitNumber" and elem.get("type") == "start":
+            scene.relative_orbit = int(elem.text)
+        elif name == "startTime":
+            scene.start_time = _parse_time(elem.text)
+        elif name == "stopTime":
+            scene.stop_time = _parse_time(elem.text)
+        elif name == "transmitterReceiverPolarisation" and elem.text not in scene.polarisations:
+            scene.polarisations.append(elem.text)
+        elif name == "swath" and elem.text not in scene.subswaths:
+            scene.subswaths.append(elem.text)
+        elem.clear()
+    if family is not None:
+        scene.platform = family + (number or "")
+    return scene
+
+def parse_dim(path: str, scene: SceneMetadata) -> SceneMetadata:
+    """
+    Fill scene metadata from a BEAM-DIMAP header file.
+    """
+    attributes = {}
+    for _, elem in ET.iterparse(path, events=("end",)):
+        if elem.tag == "PRODUCT_SCENE_RASTER_START_TIME" and scene.start_time is None:
+            scene.start_time = _parse_time(elem.text)
+        elif elem.tag == "PRODUCT_SCENE_RASTER_STOP_TIME" and scene.stop_time is None:
+            scene.stop_time = _parse_time(elem.text)
+        elif elem.tag == "MDATTR" and elem.get("name") not in attributes:
+            attributes[elem.get("name")] = elem.text
+        elem.clear()
+
+    scene.platform = attributes.get("MISSION")
+    if attributes.get("ABS_ORBIT"):
+        scene.orbit = int(attributes["ABS_ORBIT"])
+    if attributes.get("REL_ORBIT"):
+        scene.relative_orbit = int(attributes["REL_ORBIT"])
+    for i in range(1, 5):
+        polarisation = attributes.get(f"mds{i}_tx_rx_polar")
+        if polarisation and polarisation != "-":
+            scene.polarisations.append(polarisation)
+    if attributes.get("SWATH"):
+        scene.subswaths.append(attributes["SWATH"])
+    return scene
+
+def read_scene_metadata(path: str, platform: str = "SENTINEL-1") -> SceneMetadata:
+    """
+    Read the metadata of a scene from a BEAM-DIMAP file, SAFE zip file, or
+    .SAFE directory.
+    """
+    scene = SceneMetadata(path)
+    if path.endswith(".dim"):
+        parse_dim(path, scene)
+    elif platform.upper() == "SENTINEL-1":
+        with open_manifest(path) as f:
+            parse_manifest(f, scene)
+    else:
+        raise ValueError(f"Unsupported sensor: {platform}")
+    if scene.start_time is None:
+        raise LookupError(f"Cannot find scene start time in {path}")
+    return scene
+
+
+class SceneIndex:
+
+    def __init__(self, index_file: str = None, s3_client=None) -> None:
+        """
+        Index of scene metadata keyed by path. Entries are reused as long as the
+        size and modification time of the file do not change. If index_file is
+        given, the index is loaded from and saved to that JSON file. S3 URIs are
+        supported if an s3_client is given and are validated using the ETag.
+        """
+        self.index_file = index_file
+        self.s3_client = s3_client
+        self.scenes = {}
+        self._lock = threading.Lock()
+        if index_file is not None and os.path.isfile(index_file):
+            with open(index_file) as f:
+                for data in json.load(f):
+                    self.scenes[data["path"]] = SceneMetadata.from_dict(data)
+
+    def __getstate__(self):
+        # Locks and S3 clients cannot be sent to worker processes
+        state = dict(self.__dict__)
+        del state["_lock"]
+        state["s3_client"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, path: str, platform: str = "SENTINEL-1") -> SceneMetadata:
+        """
+        Get the metadata of a scene. The scene is only read if it is not in the
+        index or if it changed since it was indexed.
+        """
+        if path.startswith("s3://"):
+            return self._get_s3(path, platform)
+
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        scene = self.scenes.get(key)
+        if scene is not None and scene.size == stat.st_size and scene.mtime == stat.st_mtime_ns:
+            return scene
+
+        scene = read_scene_metadata(path, platform)
+        scene.path = key
+        scene.size = stat.st_size
+        scene.mtime = stat.st_mtime_ns
+        with self._lock:
+            self.scenes[key] = scene
+        return scene
+
+    def _get_s3(self, s3_uri: str, platform: str) -> SceneMetadata:
+        from .s3 import parse_s3_uri, probe_s3_scene
+
+        if self.s3_client is None:
+            raise ValueError(f"An S3 client is required to read the metadata of {s3_uri}")
+        scene = self.scenes.get(s3_uri)
+        if scene is not None:
+            bucket, key = parse_s3_uri(s3_uri)
+            head = self.s3_client.head_object(Bucket=bucket, Key=key)
+            if scene.size == head["ContentLength"] and scene.mtime == head.get("ETag"):
+                return scene
+
+        scene = probe_s3_scene(s3_uri, self.s3_client, platform)
+        with self._lock:
+            self.scenes[s3_uri] = scene
+        return scene
+
+    def scan(self, paths: list, platform: str = "SENTINEL-1", max_workers: int = None) -> list:
+        """
+        Index a list of scenes in parallel and save the index if it has an
+        index file.
+
+        Returns
+        -------
+        list
+            List of SceneMetadata in the same order as paths.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            scenes = list(executor.map(lambda x: self.get(x, platform), paths))
+        self.save()
+        return scenes
+
+    def save(self) -> None:
+        """
+        Save the index to the index file.
+        """
+        if self.index_file is None:
+            return
+        with self._lock:
+            data = [x.to_dict() for x in self.scenes.values()]
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_file, self.index_file)
+
+if __name__ == "__main__":
+    pass
@@ -1,35 +1,30 @@
-import re
-import subprocess
+from .registry import get_registry
 
 # Tools related to SNAP operators
 
+# Operators that read an array of source products. GPT takes their sources
+# as positional arguments instead of -S options.
+POSITIONAL_SOURCE_OPERATORS = ["Back-Geocoding", "TOPSAR-Merge", "SAR-Mosaic"]
+
+def has_positional_sources(operator: str) -> bool:
+    """
+    Check if the sources of an operator are passed to GPT as positional
+    arguments such as gpt Back-Geocoding img1.dim img2.dim.
+    """
+    return operator in POSITIONAL_SOURCE_OPERATORS
+
 def operator_source_flags(operator: str):
     """
-    Get operator source flag from the GPT CLI. This can vary from operator
-    from operator so this just extracts it from the command line output.
+    Get operator source flag of a SNAP operator. This can vary from operator
+    to operator so it is loaded from the operator registry which caches the
+    GPT CLI output.
 
     Parameters
     ----------
     operator: str
         SNAP Operator as identified in the SNAP Graphs
     """
-    output = subprocess.run(["gpt", operator, "-h"], capture_output=True)
-    stdout = output.stdout.decode('utf-8')
-    if "Unknown operator" in stdout:
-        raise ValueError(stdout)
-    # pattern = r"<(source)>\${source}|<(sourceProduct)>\${sourceProduct}"
-    pattern = r"\${(source)}|\${(sourceProduct)}"
-    match = re.search(pattern, stdout)
-
-    if match.group(1) is None and match.group(2) is None:
-        raise ValueError(f"No source flag match found for operator {operator}")
-    elif match:
-        if match.group(1) is not None:
-            return match.group(1)
-        else:
-            return match.group(2)
-    else:
-        raise ValueError(f"No source flag match found for operator {operator}")
+    return get_registry().source_flag(operator)
 
 def get_output_suffix(action: dict) -> str:
     """
@@ -61,6 +56,8 @@ def get_output_suffix(action: dict) -> str:
         "Back-Geocoding": "Stack",
         "Interferogram": "Ifg",
         "TOPSAR-Deburst": "Deb",
+        "TOPSAR-Merge": "mrg",
+        "SAR-Mosaic": "Mos",
         "TopoPhaseRemoval": "Topo",
         "Coherence": "Coh",
         "Multilook": "ML",
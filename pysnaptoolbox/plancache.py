@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+
+from .registry import find_snap_install, get_snap_version
+
+# Cache of compiled workflow plans so a workflow that was run before starts
+# GPT without parsing scenes, reading annotations, or introspecting operators
+
+# Increase when the structure of the plan changes
+PLAN_VERSION = 1
+
+def plan_cache_file(toml_file: str) -> str:
+    """
+    Get the path of the plan cache file which is placed next to the TOML file.
+    """
+    directory, name = os.path.split(os.path.abspath(toml_file))
+    return os.path.join(directory, f".{name}.plan.json")
+
+def get_source_stats(config: dict) -> list:
+    """
+    Get the size and modification time of the local files used as sources so
+    the plan is compiled again if a source is replaced.
+    """
+    paths = [x for x in (config.get("sources") or {}).values() if isinstance(x, str)]
+    for steps in config["workflow"].values():
+        for step in steps:
+            sources = step.get("source") or []
+            paths += [sources] if isinstance(sources, str) else sources
+    stats = []
+    for path in sorted(set(paths)):
+        if not path.startswith("$") and os.path.exists(path):
+            stat = os.stat(path)
+            stats.append([path, stat.st_size, int(stat.st_mtime)])
+    return stats
+
+def get_plan_key(toml_file: str, config: dict, **options) -> str:
+    """
+    Get the key of the plan of a workflow, which is the hash of the TOML file,
+    the SNAP version, the sources, and the options that change the plan such
+    as the platform and output directory. If the aoi option is the path of a
+    file, the hash of its contents is used so the plan follows edits of the
+    AOI.
+    """
+    aoi = options.get("aoi")
+    if isinstance(aoi, str) and os.path.isfile(aoi):
+        with open(aoi, "rb") as f:
+            options["aoi"] = [aoi, hashlib.sha256(f.read()).hexdigest()]
+    try:
+        snap_version = get_snap_version(find_snap_install())
+    except FileNotFoundError:
+        snap_version = None
+    digest = hashlib.sha256()
+    with open(toml_file, "rb") as f:
+        digest.update(f.read())
+    digest.update(json.dumps([PLAN_VERSION, snap_version, get_source_stats(config), options], sort_keys=True,
+                             default=str).encode())
+    return digest.hexdigest()
+
+def load_plan(toml_file: str, key: str) -> dict:
+    """
+    Load the cached plan of a workflow. Returns None if there is no plan for
+    this key.
+    """
+    try:
+        with open(plan_cache_file(toml_file)) as f:
+            plan = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if plan.get("key") != key:
+        return None
+    return plan
+
+def save_plan(toml_file: str, key: str, plan: dict) -> None:
+    """
+    Save the plan of a workflow next to its TOML file. Nothing is saved if
+    the directory is not writable.
+    """
+    cache_file = plan_cache_file(toml_file)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(dict(plan, key=key), f, indent=1)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print(f"WARNING: Cannot save the workflow plan to {cache_file}: {e}")
+
+if __name__ == "__main__":
+    pass
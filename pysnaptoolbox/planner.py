@@ -0,0 +1,183 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+import os
+
+from .config import dumps_toml
+
+# Tools used to pair the scenes of a batch in acquisition order and to plan
+# batch items without copying the whole template for every item
+
+PAIRING_STRATEGIES = ["sequential", "reference", "sbas"]
+
+class ScenePlan:
+
+    def __init__(self, scenes: list) -> None:
+        """
+        Scenes sorted by acquisition start time with a sorted index of the
+        start times so scenes can be looked up by time with bisect. Scenes
+        without a start time are placed last in path order.
+
+        Parameters
+        ----------
+        scenes: list
+            List of SceneMetadata such as returned by `SceneIndex.scan`.
+        """
+        dated = sorted((x for x in scenes if x.start_time is not None), key=lambda x: (x.start_time, x.path))
+        undated = sorted((x for x in scenes if x.start_time is None), key=lambda x: x.path)
+        if undated:
+            print(f"WARNING: {len(undated)} scenes have no start time and are paired after the dated scenes")
+        self.scenes = dated + undated
+        self.paths = [x.path for x in self.scenes]
+        self.times = [x.start_time for x in dated]
+
+    def __len__(self) -> int:
+        return len(self.scenes)
+
+    def nearest(self, time: datetime) -> int:
+        """
+        Get the index of the scene acquired closest to a time.
+        """
+        if not self.times:
+            raise LookupError("No scene has a start time")
+        i = bisect_left(self.times, time)
+        candidates = [x for x in [i - 1, i] if 0 <= x < len(self.times)]
+        return min(candidates, key=lambda x: abs(self.times[x] - time))
+
+    def find_reference(self, reference: str = None) -> int:
+        """
+        Get the index of the reference scene of a common reference stack.
+
+        Parameters
+        ----------
+        reference: str
+            Path or file name of the reference scene or its date as YYYYMMDD.
+            The scene closest to the middle of the time span is used if None,
+            which keeps the temporal baselines short.
+        """
+        if reference is None:
+            if not self.times:
+                return 0
+            return self.nearest(self.times[0] + (self.times[-1] - self.times[0]) / 2)
+        for i, path in enumerate(self.paths):
+            if path == reference or os.path.basename(path) == reference:
+                return i
+        try:
+            date = datetime.strptime(reference, r"%Y%m%d")
+        except ValueError:
+            raise ValueError(f"Reference {reference} is neither a scene of the batch nor a YYYYMMDD date")
+        i = self.nearest(date + timedelta(hours=12))
+        if self.times[i].date() != date.date():
+            raise LookupError(f"No scene of the batch was acquired on {reference}")
+        return i
+
+    def sequential(self, size: int, step: int = 1):
+        """
+        Yield windows of size consecutive scenes moving step scenes at a time.
+        """
+        for i in range(0, len(self.paths) - size + 1, step):
+            yield self.paths[i:i + size]
+
+    def common_reference(self, reference: str = None):
+        """
+        Yield (reference, secondary) pairs of a reference scene with every
+        other scene.
+        """
+        r = self.find_reference(reference)
+        for i, path in enumerate(self.paths):
+            if i != r:
+                yield [self.paths[r], path]
+
+    def small_baseline(self, max_baseline: float = None, max_connections: int = None):
+        """
+        Yield the (earlier, later) pairs of a small baseline network. Each
+        scene is paired with the following scenes acquired within
+        max_baseline days, up to max_connections of them.
+        """
+        for i in range(len(self.times)):
+            end = len(self.times)
+            if max_baseline is not None:
+                end = bisect_right(self.times, self.times[i] + timedelta(days=max_baseline), i + 1)
+            if max_connections is not None:
+                end = min(end, i + 1 + max_connections)
+            for j in range(i + 1, end):
+                yield [self.paths[i], self.paths[j]]
+
+    def pairs(self, strategy: str, size: int, step: int = 1, reference: str = None, max_baseline: float = None,
+              max_connections: int = None):
+        """
+        Yield the scenes of every batch item using a pairing strategy.
+
+        Parameters
+        ----------
+        strategy: str
+            sequential: windows of consecutive scenes.
+            reference: a reference scene paired with every other scene.
+            sbas: small baseline network limited by max_baseline (days) and
+            max_connections per scene.
+        size: int
+            Number of scenes of each item. Only sequential supports sizes
+            other than 2.
+        """
+        if strategy not in PAIRING_STRATEGIES:
+            raise ValueError(f"Unknown pairing strategy {strategy}. Use one of {', '.join(PAIRING_STRATEGIES)}")
+        if strategy == "sequential":
+            return self.sequential(size, step)
+        if size != 2:
+            raise ValueError(f"The {strategy} pairing strategy needs two batch subtables but {size} were given")
+        if strategy == "reference":
+            return self.common_reference(reference)
+        return self.small_baseline(max_baseline, max_connections)
+
+def overlay_workflow(config: dict, subtables: list, sources: list) -> dict:
+    """
+    Create the workflow of a batch item from the template without copying
+    it. The item has its own workflow table and its own first step of every
+    batch subtable, which are the only parts set per item. Other subtables
+    and steps are shared with the template and must not be changed.
+
+    Parameters
+    ----------
+    config: dict
+        Loaded TOML template.
+    subtables: list
+        Names of the batch subtables.
+    sources: list
+        Source of each batch subtable.
+    """
+    workflow = dict(config["workflow"])
+    for name, source in zip(subtables, sources):
+        first = dict(workflow[name][0], source=source)
+        # Burst selection fills in the parameters of the first step
+        if first.get("parameters") is not None:
+            first["parameters"] = dict(first["parameters"])
+        workflow[name] = [first] + workflow[name][1:]
+    return dict(config, workflow=workflow)
+
+class PlanWriter:
+
+    def __init__(self, plan_file: str) -> None:
+        """
+        Writes the workflow of every batch item to a TOML file as soon as it
+        is planned so the plan does not need to be kept in memory to be
+        saved. Each item is a table named after its index.
+        """
+        self.plan_file = plan_file
+        self.file = open(plan_file, "w")
+        self.count = 0
+
+    def write(self, index: int, workflow: dict) -> None:
+        self.file.write(dumps_toml({str(index): workflow}))
+        self.file.flush()
+        self.count += 1
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,155 @@
+from contextlib import contextmanager
+import threading
+import time
+
+# Tools used to share the machine between the stages of batch items
+
+class StagePools:
+
+    def __init__(self, slots: dict, manager=None) -> None:
+        """
+        Resource pools used to run the stages of batch items such as GPT
+        calls, SNAPHU runs, and file transfers. Each stage waits for a free
+        slot in its pool, so an item can run GPT while another item is
+        unwrapping. The time each stage holds a slot is recorded for the
+        utilization report.
+
+        Parameters
+        ----------
+        slots: dict
+            Number of slots of each pool such as {"gpt": 2, "snaphu": 4}.
+        manager:
+            multiprocessing Manager used to create semaphores that are
+            shared by worker processes. Thread semaphores are used if None.
+        """
+        self.slots = dict(slots)
+        self.semaphores = {}
+        for pool, n in slots.items():
+            self.semaphores[pool] = manager.BoundedSemaphore(n) if manager is not None else threading.BoundedSemaphore(n)
+        self.records = []
+        # Slots held by an item and the number of its stages using them
+        self.held = None
+
+    def for_item(self):
+        """
+        Get a copy of the pools that shares the same slots but records the
+        stages of a single item. Stages of the item that run at the same
+        time, such as subswath branches, share the slot held by the item.
+        """
+        pools = StagePools.__new__(StagePools)
+        pools.slots = self.slots
+        pools.semaphores = self.semaphores
+        pools.records = []
+        pools.held = {}
+        # Time each slot was acquired and the number of stages that used it
+        pools.acquired = {}
+        pools.acquiring = set()
+        pools.condition = threading.Condition()
+        return pools
+
+    @contextmanager
+    def stage(self, pool: str):
+        """
+        Context manager that holds a slot of a pool while a stage is running.
+        The time each slot is held is recorded, so stages sharing a slot are
+        only counted once.
+        """
+        semaphore = self.semaphores.get(pool)
+        if semaphore is None:
+            yield
+            return
+        if self.held is None:
+            semaphore.acquire()
+            start = time.time()
+            try:
+                yield
+            finally:
+                semaphore.release()
+                self.records.append((pool, start, time.time(), 1))
+            return
+
+        # The first stage of the item acquires the slot and the others started
+        # before it is released share it. The slot is acquired without holding
+        # the lock so other stages of the item can release their slots.
+        with self.condition:
+            while pool in self.acquiring:
+                self.condition.wait()
+            first = not self.held.get(pool)
+            if first:
+                self.acquiring.add(pool)
+            else:
+                self.held[pool] += 1
+                self.acquired[pool][1] += 1
+        if first:
+            try:
+                semaphore.acquire()
+            except BaseException:
+                with self.condition:
+                    self.acquiring.discard(pool)
+                    self.condition.notify_all()
+                raise
+            with self.condition:
+                self.acquiring.discard(pool)
+                self.held[pool] = 1
+                self.acquired[pool] = [time.time(), 1]
+                self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.held[pool] -= 1
+                if not self.held[pool]:
+                    semaphore.release()
+                    start, stages = self.acquired.pop(pool)
+                    self.records.append((pool, start, time.time(), stages))
+
+def get_pool_utilization(slots: dict, records: list, start: float, end: float) -> dict:
+    """
+    Get the utilization of each pool from the recorded stages.
+
+    Parameters
+    ----------
+    slots: dict
+        Number of slots of each pool.
+    records: list
+        List of (pool, start, end, stages) of every time a slot was held and
+        the number of stages that used it.
+    start: float
+        Start time of the batch.
+    end: float
+        End time of the batch.
+
+    Returns
+    -------
+    dict
+        Number of stages, busy time in seconds, and utilization between 0
+        and 1 of each pool.
+    """
+    elapsed = max(end - start, 1e-9)
+    utilization = {}
+    for pool, n in slots.items():
+        busy = sum(x[2] - x[1] for x in records if x[0] == pool)
+        utilization[pool] = {
+            "slots": n,
+            "stages": sum(x[3] for x in records if x[0] == pool),
+            "busy": busy,
+            "utilization": busy / (n * elapsed),
+        }
+    return utilization
+
+def report_pool_utilization(slots: dict, records: list, start: float, end: float, items: int = None) -> dict:
+    """
+    Print the utilization of each pool and the batch throughput.
+    """
+    utilization = get_pool_utilization(slots, records, start, end)
+    elapsed = end - start
+    print(f"INFO: Batch finished in {elapsed:.1f} s")
+    if items:
+        print(f"INFO: Throughput {items / elapsed * 3600:.1f} items per hour")
+    for pool, x in utilization.items():
+        print(f"INFO: Pool {pool}: {x['slots']} slots, {x['stages']} stages, {x['busy']:.1f} s busy, "
+              f"{x['utilization']:.0%} utilization")
+    return utilization
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,298 @@
+import argparse
+from glob import glob
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+
+from .artifacts import get_size
+from .resources import parse_size
+
+# Tools used to measure the resources used by GPT and SNAPHU processes
+
+# Seconds between two samples of the process tree
+SAMPLE_INTERVAL = 0.5
+
+TRACE_FORMATS = {"jsonl": ".jsonl", "chrome": ".json"}
+
+def _read_proc(path: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+def get_process_tree(root_pid: int) -> list:
+    """
+    Get the PIDs of a process and all of its descendants from /proc.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        stat = _read_proc(f"/proc/{entry}/stat")
+        if stat is None:
+            continue
+        # The command name in parentheses can contain spaces
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    pids = [root_pid]
+    for pid in pids:
+        pids.extend(children.get(pid, []))
+    return pids
+
+
+class ProcessSampler:
+
+    def __init__(self, pid: int, interval: float = SAMPLE_INTERVAL) -> None:
+        """
+        Background thread sampling the memory and I/O of a process tree from
+        /proc. The peak RSS is the largest sum of the RSS of all processes in
+        the tree. Read and written bytes are the last values of the I/O
+        counters of every process seen.
+        """
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.io = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.enabled = os.path.isdir("/proc")
+
+    def sample(self) -> None:
+        rss = 0
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        for pid in get_process_tree(self.pid):
+            statm = _read_proc(f"/proc/{pid}/statm")
+            if statm is not None:
+                rss += int(statm.split()[1]) * page_size
+            io = _read_proc(f"/proc/{pid}/io")
+            if io is not None:
+                counters = dict(line.split(": ") for line in io.splitlines())
+                self.io[pid] = (int(counters["read_bytes"]), int(counters["write_bytes"]))
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def start(self) -> None:
+        if self.enabled:
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self.enabled:
+            self._thread.join()
+
+    @property
+    def read_bytes(self) -> int:
+        return sum(x[0] for x in self.io.values())
+
+    @property
+    def write_bytes(self) -> int:
+        return sum(x[1] for x in self.io.values())
+
+
+class TraceWriter:
+
+    def __init__(self, trace_file: str, trace_format: str = "jsonl") -> None:
+        """
+        Writer of step records to a trace file. Records are written as JSON
+        lines, or as Chrome trace events which can be opened in
+        chrome://tracing or Perfetto. Records are appended as soon as a step is
+        finished so the trace of an interrupted run is kept.
+        """
+        if trace_format not in TRACE_FORMATS:
+            raise ValueError(f"Unsupported trace format: {trace_format}")
+        self.trace_file = trace_file
+        self.trace_format = trace_format
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+
+    def __getstate__(self):
+        # Locks cannot be sent to worker processes
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def write(self, record: dict) -> None:
+        if self.trace_format == "chrome":
+            # Chrome accepts a JSON array without the closing bracket
+            event = {
+                "name": record["name"],
+                "cat": record["stage"],
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["wall_time"] * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": record,
+            }
+            line = json.dumps(event) + ",\n"
+        else:
+            line = json.dumps(record) + "\n"
+        with self._lock:
+            new_file = not os.path.isfile(self.trace_file)
+            with open(self.trace_file, "a") as f:
+                if new_file and self.trace_format == "chrome":
+                    f.write("[\n")
+                f.write(line)
+
+def run_command(cmd, name: str, stage: str = "gpt", target: str = None, trace: TraceWriter = None,
+                shell: bool = False, cwd: str = None, log_file: str = None, env: dict = None) -> dict:
+    """
+    Run a command and measure the wall time, CPU time, peak RSS, and bytes
+    read and written by its process tree. The CPU time and the fallback
+    values of the other measurements come from the resource usage of the
+    child which includes all of its waited for descendants.
+
+    Parameters
+    ----------
+    cmd: str or list
+        Command to run.
+    name: str
+        Name of the step such as the operators of the step.
+    stage: str
+        Type of the step such as gpt or snaphu.
+    target: str
+        Output product of the step used to get the output size.
+    trace: TraceWriter
+        Optional trace the record is written to.
+    shell: bool
+        Run the command using the shell.
+    cwd: str
+        Working directory of the command.
+    log_file: str
+        Optional file the output of the command is written to instead of the
+        console.
+    env: dict
+        Optional environment variables added to the environment of the
+        command.
+
+    Returns
+    -------
+    dict
+        Record of the step. The exit status is stored in "exit_status".
+    """
+    log = open(log_file, "w") if log_file is not None else None
+    start = time.time()
+    process = subprocess.Popen(cmd, shell=shell, cwd=cwd, stdout=log, stderr=subprocess.STDOUT if log else None,
+                               env=dict(os.environ, **env) if env else None)
+    sampler = ProcessSampler(process.pid)
+    sampler.start()
+    usage = None
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    else:
+        process.wait()
+    end = time.time()
+    sampler.stop()
+    if log is not None:
+        log.close()
+
+    record = {
+        "name": name,
+        "stage": stage,
+        "cmd": cmd if isinstance(cmd, str) else " ".join(cmd),
+        "start": start,
+        "wall_time": end - start,
+        "cpu_user": usage.ru_utime if usage else None,
+        "cpu_system": usage.ru_stime if usage else None,
+        "peak_rss": max(sampler.peak_rss, usage.ru_maxrss * 1024 if usage else 0),
+        "read_bytes": max(sampler.read_bytes, usage.ru_inblock * 512 if usage else 0),
+        "write_bytes": max(sampler.write_bytes, usage.ru_oublock * 512 if usage else 0),
+        "output_size": None,
+        "exit_status": process.returncode,
+    }
+    if target is not None:
+        data_dir = os.path.splitext(target)[0] + ".data"
+        record["output_size"] = sum(get_size(x) for x in [target, data_dir] if os.path.exists(x))
+    if trace is not None:
+        trace.write(record)
+    return record
+
+def read_trace(trace_file: str) -> list:
+    """
+    Read the step records of a JSON lines or Chrome trace file.
+    """
+    with open(trace_file) as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        events = json.loads("[" + text.lstrip("[").rstrip("]").rstrip(",") + "]")
+        return [x["args"] for x in events if x.get("ph") == "X"]
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def get_tile_cache(cmd: str) -> int:
+    """
+    Get the tile cache in bytes set with -c in a GPT command. Returns 0 if
+    it is not set.
+    """
+    match = re.search(r"(?:^|\s)-c\s+(\d+[KMGT]?)B?(?=\s|$)", cmd or "", flags=re.IGNORECASE)
+    return parse_size(match.group(1)) if match else 0
+
+def summarize_traces(trace_files: list) -> dict:
+    """
+    Aggregate the step records of trace files by step name.
+
+    Returns
+    -------
+    dict
+        Number of runs, failures, total and mean wall time, total CPU time,
+        largest peak RSS, largest peak RSS without the tile cache set with -c,
+        and total bytes read and written of every step name.
+    """
+    summary = {}
+    for trace_file in trace_files:
+        for record in read_trace(trace_file):
+            x = summary.setdefault(record["name"], {
+                "runs": 0, "failed": 0, "wall_time": 0.0, "cpu_time": 0.0, "peak_rss": 0, "peak_working": 0,
+                "read_bytes": 0, "write_bytes": 0,
+            })
+            x["runs"] += 1
+            x["failed"] += record["exit_status"] != 0
+            x["wall_time"] += record["wall_time"]
+            x["cpu_time"] += (record["cpu_user"] or 0) + (record["cpu_system"] or 0)
+            x["peak_rss"] = max(x["peak_rss"], record["peak_rss"] or 0)
+            # The RSS of the JVM includes the tile cache
+            x["peak_working"] = max(x["peak_working"], (record["peak_rss"] or 0) - get_tile_cache(record["cmd"]))
+            x["read_bytes"] += record["read_bytes"] or 0
+            x["write_bytes"] += record["write_bytes"] or 0
+    for x in summary.values():
+        x["mean_wall_time"] = x["wall_time"] / x["runs"]
+    return summary
+
+def report_trace_summary(summary: dict) -> None:
+    """
+    Print the summary of trace files sorted by total wall time.
+    """
+    total = sum(x["wall_time"] for x in summary.values()) or 1
+    print(f"{'Step':<40} {'Runs':>5} {'Failed':>6} {'Wall (s)':>10} {'Share':>6} {'Mean (s)':>9} {'CPU (s)':>10} "
+          f"{'Peak RSS (GB)':>13} {'Read (GB)':>9} {'Write (GB)':>10}")
+    for name, x in sorted(summary.items(), key=lambda item: -item[1]["wall_time"]):
+        print(f"{name[:40]:<40} {x['runs']:>5} {x['failed']:>6} {x['wall_time']:>10.1f} {x['wall_time'] / total:>6.0%} "
+              f"{x['mean_wall_time']:>9.1f} {x['cpu_time']:>10.1f} {x['peak_rss'] / 1024**3:>13.2f} "
+              f"{x['read_bytes'] / 1024**3:>9.2f} {x['write_bytes'] / 1024**3:>10.2f}")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Summarize pysnap-toolbox trace files by step')
+    parser.add_argument('traces', nargs='+', help='Trace files or directories containing trace files')
+    args = parser.parse_args()
+
+    trace_files = []
+    for path in args.traces:
+        if os.path.isdir(path):
+            # Traces of shared subtables are in a sub-directory
+            trace_files += sorted(glob(os.path.join(path, "**", "*.json*"), recursive=True))
+        else:
+            trace_files.append(path)
+    report_trace_summary(summarize_traces(trace_files))
@@ -1,19 +1,34 @@
 import argparse
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import nullcontext
 from copy import deepcopy
-from datetime import datetime
 from glob import glob
+import json
+from multiprocessing import Manager
 import os
 import shutil
-import subprocess
-import sys
-import toml
+import time
+import traceback
 from typing import Union
-import xml.etree.ElementTree as ET
-from zipfile import ZipFile
 
-from pysnaptoolbox.operators import get_output_suffix, operator_source_flags
-from snaphu import run_snaphu
-from pysnaptoolbox.config import TomlConfig
+from pysnaptoolbox.artifacts import ArtifactStore, remove_product
+from pysnaptoolbox.bursts import apply_aoi, load_aoi, read_burst_footprints
+from pysnaptoolbox.graph import get_failed_branches, is_graph_boundary, write_graph, write_graph_branches
+from pysnaptoolbox.metadata import SceneIndex
+from pysnaptoolbox.operators import get_output_suffix, has_positional_sources, operator_source_flags
+from pysnaptoolbox.planner import PlanWriter, ScenePlan, overlay_workflow
+from pysnaptoolbox.pools import StagePools, report_pool_utilization
+from pysnaptoolbox.profiling import TRACE_FORMATS, TraceWriter, report_trace_summary, run_command, summarize_traces
+from pysnaptoolbox.registry import get_registry
+from pysnaptoolbox.resources import cpu_count, parse_jobs, parse_size
+from pysnaptoolbox.scheduler import build_dependency_graph, get_source_references, run_dependency_graph
+from pysnaptoolbox.scratch import ScratchTracker, parse_scratch_tiers
+from pysnaptoolbox.s3 import SceneCache, get_s3_client, list_s3_objects, parse_s3_uri
+from pysnaptoolbox.snaphu import run_snaphu
+from pysnaptoolbox.subswaths import expand_subswaths, get_merge_width
+from pysnaptoolbox.tiles import expand_tiles, get_tile_parameters, get_tile_width, get_trim_parameters
+from pysnaptoolbox.tuning import GptTuner, learn_profiles, load_learned_profiles
+from pysnaptoolbox.config import TomlConfig, load_toml
 
 
 class WorkflowGroup:
@@ -27,6 +42,21 @@ class WorkflowGroup:
         self.latest_dim_path = None
         self.datetimes = []
 
+class BatchItemResult:
+
+    def __init__(self, index: int, sources: list) -> None:
+        """
+        Object to store the outcome of a batch processing item.
+        """
+        self.index = index
+        self.sources = sources
+        self.output_dim = None
+        self.output_data = None
+        self.peak_scratch = None
+        # (pool, start, end) of each stage
+        self.stages = []
+        self.error = None
+
 def get_cli_flag(d: dict, v: any) -> any:
     """
     Quick helper function to check dict from CLI and raise an error if None.
@@ -36,59 +66,88 @@ def get_cli_flag(d: dict, v: any) -> any:
         raise KeyError(f"CLI flag '{v}' is required but is empty.")
     return output
 
-def get_datetime(platform: str, path: str):
-
-    if path.endswith('.dim'):
-    
-        tree = ET.parse(path)
-        root = tree.getroot()
-        datetime_str = root.find(".//PRODUCT_SCENE_RASTER_START_TIME")
-        if datetime_str is None:
-            raise LookupError(f"Cannot find datetime from BEAM-DIMAP file {path}")
-        
-        if "T" in datetime_str.text:
-            dt_obj = datetime.strptime(datetime_str.text, r"%Y-%m-%dT%H:%M:%S.%f")
-        else:
-            dt_obj = datetime.strptime(datetime_str.text, r"%d-%b-%Y %H:%M:%S.%f")
+def run_graph_segment(steps: list, graph_file: str, gpt_options: str = "", artifact_store: ArtifactStore = None,
+                      scratch: ScratchTracker = None, pools: StagePools = None, trace: TraceWriter = None,
+                      graph_branches: list = None, tuner: GptTuner = None) -> None:
+    """
+    Run buffered processing steps as a single GPT call. Multiple steps are
+    compiled into a graph so intermediate products stay in memory. If an
+    artifact store is given, the output is fetched from the store when it
+    was already computed and new outputs are added to the store. If a scratch
+    tracker is given, inputs that are no longer needed are removed. If stage
+    pools are given, GPT waits for a free slot in the gpt pool. If a trace is
+    given, the resources used by GPT are written to it. If graph_branches is
+    given, the steps are appended to it instead of being run so they can be
+    run later as a branch of a larger graph. If a tuner is given, the heap,
+    tile cache, and threads of the graph are chosen by it.
+    """
+    if not steps:
+        return
+    key = steps[-1].get("key")
+    target = steps[-1]["target"]
+    if artifact_store is not None and key is not None:
+        if artifact_store.fetch(key, target):
+            print("INFO: Reusing stored output", target, "for operators", ", ".join(x["operator"] for x in steps))
+            finish_steps(steps, scratch)
+            return
+        # Remove outputs of interrupted runs so GPT does not write into them
+        remove_product(target)
+    if graph_branches is not None:
+        graph_branches.append(list(steps))
+        steps.clear()
+        return
 
+    if len(steps) == 1:
+        cmd = steps[0]["cmd"]
+        env = steps[0].get("env")
     else:
-        platform = platform.upper()
-        if platform == "SENTINEL-1":
-            # Extract manifest.safe file
-            with ZipFile(path) as f:
-                manifest = None
-                for item in f.filelist:
-                    if "manifest.safe" in item.filename:
-                        manifest = item.filename
-                f.extract(manifest, "")
-            
-            # Parse XML
-            tree = ET.parse(manifest)
-            metadata = tree.getroot()
-            datetime_str = metadata.find((".//safe:startTime"), {'safe': r"http://www.esa.int/safe/sentinel-1.0"})
-            if datetime_str is None:
-                raise LookupError("cannot find scene start time in Sentinel-1 .SAFE file")
-            dt_obj = datetime.strptime(datetime_str.text, r"%Y-%m-%dT%H:%M:%S.%f")
-            
-            # Clean up
-            shutil.rmtree(os.path.dirname(manifest))
-        else:
-            raise ValueError(f"Unsupported sensor: {platform}")
-    return dt_obj
+        write_graph(steps, steps[0]["sources"], steps[-1]["target"], graph_file)
+        options, env = tuner.options([x["operator"] for x in steps], steps[0]["sources"]) if tuner else ("", None)
+        cmd = f'gpt "{graph_file}" {gpt_options} {options}'.strip().replace("  ", " ")
+        print("INFO: Running graph", graph_file, "with operators", ", ".join(x["operator"] for x in steps))
+    with pools.stage("gpt") if pools is not None else nullcontext():
+        record = run_command(cmd, "+".join(x["operator"] for x in steps), "gpt", target, trace, shell=True, env=env)
+    # Failed or killed GPT calls are never published and their partial
+    # output is removed so it cannot be taken for a finished product
+    if record["exit_status"] != 0:
+        remove_product(target)
+        raise RuntimeError(f"GPT failed with exit status {record['exit_status']}: {cmd}")
+    if artifact_store is not None and key is not None:
+        artifact_store.publish(key, target, steps[-1]["operator"])
+    finish_steps(steps, scratch)
 
-def run_processing_groups(group: WorkflowGroup, output_dir: str, platform: str):
+def finish_steps(steps: list, scratch: ScratchTracker = None) -> None:
+    """
+    Mark buffered steps as finished and clear the buffer.
+    """
+    if scratch is not None:
+        for step in steps:
+            scratch.finish(step["id"], step["target"])
+    steps.clear()
+
+def run_processing_groups(group: WorkflowGroup, output_dir: str, platform: str, fuse_graphs: bool = False, gpt_options: str = "",
+                          scene_index: SceneIndex = None, shared_outputs: dict = None, artifact_store: ArtifactStore = None,
+                          scratch: ScratchTracker = None, pools: StagePools = None, snaphu_cpus: int = None,
+                          trace: TraceWriter = None, graph_branches: list = None, tuner: GptTuner = None):
 
-    group_output_paths = {}
+    if scene_index is None:
+        scene_index = SceneIndex()
+    # Outputs of groups that were already processed elsewhere can be used as
+    # $ sources
+    group_output_paths = dict(shared_outputs or {})
+    pending_steps = []
     latest_dim_file = None
     source_arg = None
     target_file = None
     snaphu_phase_file = None
     snaphu_unwrap_phase_file = None
     snaphu_target_dir = None
-    kwargs = {}
+    snaphu_product_name = None
+    tile_core = None
 
     # Loop through processing_group
     for group_name, group_data in group.items():
+        graph_count = 0
         # Loop through steps in group
         for i, process_group in enumerate(group_data.processing_steps):
 
@@ -103,7 +162,11 @@ def run_processing_groups(group: WorkflowGroup, output_dir: str, platform: str):
             
             source_arg = ""
             source_count = 1
-            flag = "-" + operator_source_flags(operator)
+            step_sources = []
+            # Custom operators are not available in GPT and operators reading
+            # an array of products take their sources as positional arguments
+            positional = has_positional_sources(operator)
+            flag = "-S" + operator_source_flags(operator) if operator != "SnaphuUnwrapping" and not positional else ""
 
             # We are expecting an array of sources to make things easier
             if isinstance(group_data.source, str):
@@ -114,18 +177,36 @@ def run_processing_groups(group: WorkflowGroup, output_dir: str, platform: str):
             # Iterate through it and add to cmd string
             if i > 0:
                 source = latest_dim_file
-                source_arg += f'{flag}="{source}" '
+                source_arg += f'"{source}" ' if positional else f'{flag}="{source}" '
                 source_count +=1
+                step_sources.append(source)
             else:
                 for source in group_data.source:
                     # Load latest output path from specified processing group
                     if source.startswith("$"):
                         source = group_output_paths[source.lstrip("$")]
-                    if len(group_data.source) > 1:
+                    if positional:
+                        source_arg += f'"{source}" '
+                    elif len(group_data.source) > 1:
                         source_arg += f'{flag}{source_count}="{source}" '
                         source_count +=1
                     else:
                         source_arg += f'{flag}="{source}" '
+                    step_sources.append(source)
+
+            # Tile regions are computed from the product that is tiled and
+            # the overlap is trimmed after the tile is processed
+            if process_group.get("tile") is not None:
+                tile_parameters, tile_core = get_tile_parameters(process_group["tile"], step_sources[0])
+                process_group = dict(process_group, parameters=dict(process_group["parameters"], **tile_parameters))
+            elif process_group.get("trim") is not None:
+                # The size of the processed tile is read from its product so
+                # the steps before the trim are written first
+                run_graph_segment(pending_steps, os.path.join(output_dir, "graphs", f"{group_name}_{graph_count}.xml"),
+                                  gpt_options, artifact_store, scratch, pools, trace, graph_branches, tuner)
+                graph_count += 1
+                trim_parameters = get_trim_parameters(process_group["trim"], tile_core, step_sources[0])
+                process_group = dict(process_group, parameters=dict(process_group["parameters"], **trim_parameters))
 
             # Override if SnaphuImport (Special case)
             if operator == "SnaphuImport":
@@ -136,18 +217,16 @@ def run_processing_groups(group: WorkflowGroup, output_dir: str, platform: str):
             # Handle output file logic
             #########################
             # TODO: Special cases (separate funcs?) for operators instead of a bunch of nested statements
-            if operator == "TOPSAR-Split":
-                kwargs["subswath"] = process_group["parameters"]["subswath"]
-            suffix = get_output_suffix(operator, **kwargs)
-
-            for source in group_data.source:
-                if source.startswith("$"):
-                    source = group_output_paths[source.lstrip("$")]
-                dt = get_datetime(platform, source)
-                if dt is not None:
-                    group_data.datetimes.append(dt)
+            suffix = get_output_suffix(process_group)
 
             if i == 0:
+                # Sources do not change between steps so the datetimes are only
+                # looked up once per group
+                for source in group_data.source:
+                    if source.startswith("$"):
+                        source = group_output_paths[source.lstrip("$")]
+                    group_data.datetimes.append(scene_index.get(source, platform).start_time)
+
                 if operator == "Back-Geocoding":
                     # Use first and last date in the array to show range of datetime
                     first = group_data.datetimes[0]
@@ -159,13 +238,24 @@ def run_processing_groups(group: WorkflowGroup, output_dir: str, platform: str):
                     date = group_data.datetimes[0]
                     datetime_str = f'{date.year}{date.month}{date.day}'
                 target_file = os.path.join(output_dir, f'{datetime_str}.dim')
+                # Branches of a subswath fan-out write to different files
+                if process_group.get("subswath"):
+                    target_file = os.path.splitext(target_file)[0] + f'_{process_group["subswath"]}.dim'
+                if process_group.get("tile") is not None:
+                    target_file = os.path.splitext(target_file)[0] + f'_T{process_group["tile"]["index"] + 1}.dim'
 
             if suffix != "":
                 target_file = target_file.rstrip(".dim")
                 target_file += f'_{suffix}{".dim"}'
 
+            # Intermediate products are written to the fastest scratch tier
+            if scratch is not None:
+                target_file = os.path.join(scratch.target_dir((group_name, i), step_sources), os.path.basename(target_file))
+
             if operator == "SnaphuExport":
                 snaphu_phase_file = target_file
+                # SnaphuExport writes to a folder named after its source
+                snaphu_product_name = os.path.splitext(os.path.basename(step_sources[0]))[0]
 
             #########################
             # Handle parameter logic
@@ -182,43 +272,81 @@ def run_processing_groups(group: WorkflowGroup, output_dir: str, platform: str):
                     else:
                         parameters += f'-P{param}="{value}" '
 
+            # Steps that can be fused are buffered and run as a single graph
+            # once a graph boundary or the end of the processing group is reached
+            fuse_step = fuse_graphs and not is_graph_boundary(operator)
+            graph_file = os.path.join(output_dir, "graphs", f"{group_name}_{graph_count}.xml")
+            if not fuse_step:
+                run_graph_segment(pending_steps, graph_file, gpt_options, artifact_store, scratch, pools, trace,
+                                  graph_branches, tuner)
+                graph_count += 1
+            step = {
+                "id": (group_name, i),
+                "operator": operator,
+                "parameters": process_group.get("parameters"),
+                "sources": step_sources,
+                "target": target_file,
+            }
+            # SNAPHU operators write files outside of the target product so
+            # they are not stored
+            if artifact_store is not None and not is_graph_boundary(operator):
+                step["key"] = artifact_store.step_key(operator, step["parameters"], step_sources)
+                artifact_store.register(target_file, step["key"])
+
+            # Heap, tile cache, and threads of this GPT call
+            step_options = gpt_options
+            if tuner is not None and operator != "SnaphuUnwrapping":
+                options, step["env"] = tuner.options([operator], step_sources)
+                step_options = f"{gpt_options} {options}"
+
             # Create GPT command
             if operator == "SnaphuExport":
-                cmd = f'gpt {operator} {parameters} {source_arg}'
+                cmd = f'gpt {operator} {step_options} {parameters} {source_arg}'
             elif operator == "Subset":
                 operator = os.path.join(os.path.dirname(__file__), "graphs", "subset.xml")
-                cmd = f'gpt {operator} {parameters} {source_arg} -PoutputFile="{target_file}"'
+                cmd = (f'gpt {operator} {step_options} {parameters} {source_arg} -PinputFile="{step_sources[0]}" '
+                       f'-PoutputFile="{target_file}"')
             elif operator == "SnaphuImport":
                 operator = os.path.join(os.path.dirname(__file__), "graphs", "snaphuImport.xml")
-                cmd = f'gpt {operator} {parameters} {source_arg} -PoutputFile="{target_file}"'
+                cmd = f'gpt {operator} {step_options} {parameters} {source_arg} -PoutputFile="{target_file}"'
             else:
-                cmd = f'gpt {operator} {parameters} {source_arg} -t "{target_file}"'
+                cmd = f'gpt {operator} {step_options} {parameters} {source_arg} -t "{target_file}"'
             cmd = cmd.replace("  ", " ")
 
             print("\n#######################################")
             print("Processing group:", group_name)
             print("Running", operator, "operator")
-            print("GPT command:", cmd)
+            # The command is recorded in the trace and in the error of a failed call
             # print("DEBUG: Group sources", group_data.source)
             # print("DEBUG: Latest dim file", latest_dim_file)
             print("#######################################\n")
 
             # Some operators require external non GPT software
-            if operator == "SnaphuUnwrapping":
+            if fuse_step:
+                step["cmd"] = cmd
+                pending_steps.append(step)
+            elif operator == "SnaphuUnwrapping":
                 if snaphu_target_dir is None:
                     raise RuntimeError("Error with SnaphuUnwrapping operator. \
                                        Could not detect SnaphuExport targetFolder. \
                                        SnaphuExport needs to be in the same workflow.")
-                run_snaphu(snaphu_target_dir, process_group["parameters"])
-                snaphu_unwrap_phase_file = glob(os.path.join(snaphu_target_dir, "*", "UnwPhase*.snaphu.hdr"))[0]
-                
+                snaphu_limit = pools.stage("snaphu") if pools is not None else None
+                snaphu_data_dir = run_snaphu(snaphu_target_dir, process_group.get("parameters"), snaphu_product_name,
+                                             snaphu_limit, snaphu_cpus, trace)
+                snaphu_unwrap_phase_file = glob(os.path.join(snaphu_data_dir, "UnwPhase*.snaphu.hdr"))[0]
+                finish_steps([step], scratch)
             else:
-                subprocess.call(cmd, shell=True)
+                step["cmd"] = cmd
+                run_graph_segment([step], graph_file, gpt_options, artifact_store, scratch, pools, trace, graph_branches,
+                                  tuner)
 
             # Update latest path
             latest_dim_file = target_file
             group_output_paths[group_name] = latest_dim_file
 
+        run_graph_segment(pending_steps, os.path.join(output_dir, "graphs", f"{group_name}_{graph_count}.xml"), gpt_options,
+                          artifact_store, scratch, pools, trace, graph_branches, tuner)
+
     return latest_dim_file
 
 def prepare_source_args(i: int, operator: str, group_data: WorkflowGroup, latest_dim_file: str):
@@ -254,23 +382,86 @@ def parse_processing_group(group_name, group) -> WorkflowGroup:
                 raise KeyError(f"Missing source in TOML config for processing group workflow.{group_name}")
     return wg
 
-def run(toml_template: str, platform: str, output_dir: str = "", cleanup_ignore_list: list = [], cleanup: bool = True):
+def parse_workflow_groups(config) -> dict:
+    """
+    Parse the subtables of a loaded workflow into WorkflowGroup objects.
+    """
+    # Parse pysnaptoolbox TOML reference
+    # Parse data into objects to help keep track of different processing groups
+    workflow_groups = {}
+    for group in config["workflow"]:
+        workflow_groups[group] = parse_processing_group(group, config["workflow"][group])
+        # Parse group processing steps into processing_steps property
+        for process in config["workflow"][group]:
+            workflow_groups[group].processing_steps.append(process)
+    return workflow_groups
 
-    config = TomlConfig(toml_template)
+def run(toml_template: Union[str, dict], platform: str, output_dir: str = "", cleanup_ignore_list: list = [], cleanup: bool = True,
+        fuse_graphs: bool = False, gpt_options: str = "", scene_index: SceneIndex = None, shared_outputs: dict = None,
+        artifact_store: ArtifactStore = None, scratch: ScratchTracker = None, scratch_tiers: list = None,
+        pools: StagePools = None, snaphu_cpus: int = None, trace: TraceWriter = None, tuner: GptTuner = None,
+        max_workers: int = 1):
+
+    # Batch processing items are passed as an already loaded workflow
+    if isinstance(toml_template, dict):
+        config = TomlConfig(toml_template)
+    else:
+        config = TomlConfig()
+        config.load_config(toml_template)
     
-    # # Parse pysnaptoolbox TOML reference
-    # # Parse data into objects to help keep track of different processing groups
-    # workflow_groups = {}
-    # for group in config["workflow"]:
-    #     workflow_groups[group] = parse_processing_group(group, config["workflow"][group])
-    #     # Parse group processing steps into processing_steps property
-    #     for process in config["workflow"][group]:
-    #         workflow_groups[group].processing_steps.append(process)
+    if scene_index is None:
+        scene_index = SceneIndex()
+    # Subswath lists are expanded into branches and only the bursts
+    # intersecting the AOI are processed
+    aoi = load_aoi(config["aoi"]) if config.get("aoi") else None
+    expand_subswaths(config, lambda x: scene_index.get(x, platform).subswaths, aoi, outputs=shared_outputs)
+    if aoi is not None:
+        apply_aoi(config, aoi)
+    # Steps where tiles is set run once per tile and are mosaicked
+    expand_tiles(config, aoi)
+    if not config["workflow"]:
+        raise ValueError("No subtable of the workflow intersects the AOI")
+    workflow_groups = parse_workflow_groups(config)
+    # The heap, tile cache, and threads of every GPT call are chosen from the
+    # machine and the [resources] table
+    if tuner is None:
+        tuner = GptTuner(1, config.get("resources"), load_learned_profiles())
+    # Subswath branches and tiles run at the same time and share the
+    # resources of the job
+    max_workers = max(max_workers, get_merge_width(config["workflow"]), get_tile_width(config["workflow"]))
+    if max_workers > 1:
+        tuner = tuner.split(max_workers)
+
+    # Intermediate products are removed as soon as the steps reading them are
+    # finished so they do not all stay on disk until the end of the workflow
+    if scratch is None:
+        scratch = ScratchTracker(config["workflow"], output_dir, cleanup, cleanup_ignore_list, scratch_tiers)
 
     # Run workflow groups
-    protected_output_dim = run_processing_groups(workflow_groups, output_dir, platform)
+    try:
+        if max_workers > 1:
+            # Subtables start as soon as the subtables they read are finished
+            outputs = dict(shared_outputs or {})
+
+            def run_group(name: str) -> None:
+                outputs[name] = run_processing_groups({name: workflow_groups[name]}, output_dir, platform, fuse_graphs,
+                                                      gpt_options, scene_index, dict(outputs), artifact_store, scratch,
+                                                      pools, snaphu_cpus, trace, tuner=tuner)
+
+            run_dependency_graph(build_dependency_graph(config["workflow"], outputs), run_group, max_workers)
+            protected_output_dim = outputs[list(workflow_groups)[-1]]
+        else:
+            protected_output_dim = run_processing_groups(workflow_groups, output_dir, platform, fuse_graphs,
+                                                         gpt_options, scene_index, shared_outputs, artifact_store,
+                                                         scratch, pools, snaphu_cpus, trace, tuner=tuner)
+    finally:
+        scratch.close()
     protected_output_data = protected_output_dim.replace('.dim', '.data')
+    scratch.report()
 
+    # Outputs of steps marked with keep = true are not removed
+    cleanup_ignore_list = list(cleanup_ignore_list) + [scratch.targets[x] for x in scratch.final if x in scratch.targets]
+    cleanup_ignore_list += [x.replace('.dim', '.data') for x in cleanup_ignore_list]
     if cleanup:
         dim_files = glob(os.path.join(output_dir, '*.dim'))
         data_dirs = glob(os.path.join(output_dir, '*.data'))
@@ -282,6 +473,26 @@ def run(toml_template: str, platform: str, output_dir: str = "", cleanup_ignore_
                 shutil.rmtree(data_dir)
     return protected_output_dim, protected_output_data
 
+def create_artifact_store(root: str, max_size: str = None) -> ArtifactStore:
+    """
+    Create the artifact store used to reuse step outputs of previous runs.
+    Returns None if no store directory is given.
+    """
+    if not root:
+        return None
+    return ArtifactStore(root, parse_size(max_size) if max_size else None, get_registry().snap_version)
+
+def to_plain_dict(data):
+    """
+    Recursively convert the dict subclasses created by the TOML parser to plain
+    dicts so the data can be pickled.
+    """
+    if isinstance(data, dict):
+        return {k: to_plain_dict(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [to_plain_dict(x) for x in data]
+    return data
+
 def run_batch_processing(**kwargs):
     """
     Run batch processing using a TOML file as a reference file. The data in input directory path `batch_folder`
@@ -297,125 +508,557 @@ def run_batch_processing(**kwargs):
     batch_folder_glob = get_cli_flag(kwargs, "pattern")
     cleanup = get_cli_flag(kwargs, "cleanup")
     step = int(get_cli_flag(kwargs, "batch_step"))
+    fuse_graphs = kwargs.get("fuse_graphs", False)
+    artifact_store = create_artifact_store(kwargs.get("artifact_store"), kwargs.get("artifact_store_size"))
+    scratch_tiers = parse_scratch_tiers(kwargs.get("scratch_dir") or "")
+    jobs = kwargs.get("jobs") or 1
+
+    # Use plain dicts so workflows can be sent to worker processes
+    config = to_plain_dict(load_toml(toml_template, escape_backslashes=True))
 
-    with open(toml_template) as f:
-        config = toml.load(f)
+    s3_endpoint_url = kwargs.get("s3_endpoint_url")
+    s3 = None
 
     # Get files
     if batch_folder.startswith("s3://"):
 
-        import boto3
-
         # required kwargs
         aws_profile = get_cli_flag(kwargs, "aws_profile")
-        path_parts = batch_folder.replace("s3://","").split("/")
-        bucket = path_parts.pop(0)
-        prefix = "/".join(path_parts)
+        bucket, prefix = parse_s3_uri(batch_folder)
         
         # create an S3 client object
-        session = boto3.Session(profile_name=aws_profile)
-        s3 = session.client("s3")
-        response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        files = []
-        for i, item in enumerate(response['Contents']):
-            # Skip the first item because it is the parent directory
-            if i == 0:
-                continue
-            files.append("s3://" + bucket + '/' + item["Key"])
+        s3 = get_s3_client(aws_profile, s3_endpoint_url)
+        files = ("s3://" + bucket + "/" + key for key in list_s3_objects(s3, bucket, prefix, batch_folder_glob))
     else:
         files = glob(os.path.join(batch_folder, batch_folder_glob))
-    # Get image batches
-    image_batches = []
+
+    # Read the metadata of all scenes once so batch items do not need to open
+    # the scenes again. Scenes in S3 are read using range requests so nothing
+    # is downloaded before it is known to be needed. S3 keys are read while the
+    # listing is still running.
+    scene_index = SceneIndex(os.path.join(output_dir, "scenes.json"), s3)
+    # Scenes are paired in acquisition order
+    scene_plan = ScenePlan(scene_index.scan(files, platform))
     batch_subtables = batch_subtables.split(',')
-    batch_size = len(batch_subtables)
-    # Iterate through files
-    for i in range(0, len(files), step):
-        if i + batch_size <= len(files):
-            batch = []
-            # Get batch size according to the size of entry points
-            for j in range(batch_size):
-                try:
-                    batch.append(files[i+j])
-                except IndexError:
-                    break
-            image_batches.append(batch)
-    
-    workflow_list = []
-    # construct workflow from batches
-    for batch in image_batches:
-        # Make a copy of the config file which will be appended to the workflow list
-        config_copy = deepcopy(config)
-        for i, image in enumerate(batch):
-            config_copy["workflow"][batch_subtables[i]][0]["source"] = image
-        workflow_list.append(config_copy)
-
-    # Save a copy of full workflow to TOML file for reference
-    toml_out = {}
-    for i, workflow in enumerate(workflow_list):
-        toml_out[str(i)] = workflow["workflow"]
-    with open(os.path.join(output_dir, "workflow.toml"), "w") as f:
-        toml.dump(toml_out, f)
+    max_baseline = kwargs.get("max_baseline")
+    max_connections = kwargs.get("max_connections")
+    image_batches = scene_plan.pairs(kwargs.get("pairing") or "sequential", len(batch_subtables), step,
+                                     kwargs.get("reference"), float(max_baseline) if max_baseline else None,
+                                     int(max_connections) if max_connections else None)
+
+    # The bursts of each scene are read once even if it is used by several
+    # items
+    aoi = kwargs.get("aoi") or config.get("aoi")
+    config.pop("aoi", None)
+    aoi = load_aoi(aoi) if aoi else None
+    footprints = {}
+
+    def get_subswaths(path: str) -> list:
+        return scene_index.get(path, platform).subswaths
+
+    def get_footprints(path: str) -> dict:
+        if path not in footprints:
+            footprints[path] = read_burst_footprints(path, s3)
+        return footprints[path]
+
+    def plan_items():
+        # Workflows of the items are created one at a time as overlays of
+        # the template
+        for batch in image_batches:
+            config_copy = overlay_workflow(config, batch_subtables, batch)
+            expand_subswaths(config_copy, get_subswaths, aoi, get_footprints)
+            if aoi is not None:
+                apply_aoi(config_copy, aoi, get_footprints)
+            expand_tiles(config_copy, aoi)
+            # Subswath branches of the batch subtables read the scenes as well
+            entry_points = [name for name, steps in config_copy["workflow"].items() if steps[0].get("source") in batch]
+            # Items are skipped if one of their scenes does not cover the AOI
+            if any(all(config_copy["workflow"][x][0]["source"] != image for x in entry_points) for image in batch):
+                print("INFO: Skipping batch item with sources", batch, "which does not intersect the AOI")
+                continue
+            yield config_copy, entry_points
+
+    # Every item is planned before any of them runs because subtables shared
+    # by several items are found by comparing all items and run first, and
+    # graph batches and the number of jobs depend on the number of items.
+    # Items only keep their overlay of the template and the options that are
+    # the same for every item are added when an item is submitted. The
+    # workflow of every item is saved to a TOML file for reference while the
+    # items are planned.
+    items = []
+    with PlanWriter(os.path.join(output_dir, "workflow.toml")) as plan_writer:
+        for config_copy, entry_points in plan_items():
+            plan_writer.write(len(items), config_copy["workflow"])
+            items.append(dict(index=len(items), workflow=config_copy, batch_subtables=entry_points))
+
+    jobs = parse_jobs(jobs, len(items))
+
+    # The memory and cores are split between the GPT jobs. The [resources]
+    # table of the TOML file and profiles learned from previous traces refine
+    # the options of each operator.
+    learned_profiles = kwargs.get("learned_profiles")
+    tuner = GptTuner(jobs, config.get("resources"), load_learned_profiles(learned_profiles))
+
+    # Stages of the items run in separate pools. The gpt pool has one slot
+    # per job as long as the heap of every GPT call fits in the memory. If a
+    # SNAPHU pool size is given, more items than jobs are started so items
+    # can run GPT while other items are unwrapping.
+    gpt_slots = tuner.gpt_slots()
+    if gpt_slots < jobs:
+        print(f"INFO: Running {gpt_slots} GPT calls at the same time because the heap of {jobs} calls does not "
+              "fit in the memory")
+    snaphu_jobs = int(kwargs.get("snaphu_jobs") or 0)
+    io_jobs = int(kwargs.get("io_jobs") or 2)
+    workers = jobs + snaphu_jobs
+    manager = Manager() if workers > 1 else None
+    pools = StagePools({"gpt": gpt_slots, "snaphu": snaphu_jobs or jobs, "io": io_jobs}, manager)
+    # CPUs are split between the SNAPHU jobs that can run at the same time
+    snaphu_cpus = max(1, cpu_count() // (snaphu_jobs or jobs))
+    trace_dir = os.path.join(output_dir, "traces") if kwargs.get("profile") else None
+    trace_format = kwargs.get("trace_format") or "jsonl"
 
     # Run workflows
-    # print("Processing", len(workflow_list), "scene pairs")
-    protected_data = []
-    aws_profile = get_cli_flag(kwargs, "aws_profile")
-    # Tmp dir used for s3 data if needed
-    out_tmp = os.path.join(output_dir, "tmp")
-    os.makedirs(out_tmp, exist_ok=True)
-    for workflow in workflow_list:
-
-        # TODO: Add logic to only delete data when necessary
-        # It currently deletes/redownloads after every group
-
-        # Check if S3 URIs and download beforehand
-        for subtable in batch_subtables:
-            source = workflow["workflow"][subtable][0]["source"]
-            if source.startswith("s3://"):
-                outfile = os.path.join(out_tmp, os.path.basename(source))
-                download_s3(source, outfile, aws_profile)
-                # Set source to local file instead of S3 URI
-                workflow["workflow"][subtable][0]["source"] = outfile
-                
-        output_dim, output_data = run(workflow, platform, output_dir, protected_data, cleanup=cleanup)
-        # If cleanup is enabled these files will be protected from cleanup
-        protected_data.append(output_dim)
-        protected_data.append(output_data)
-    
-    # Remove tmp dir once done
-    shutil.rmtree(out_tmp)
+    print("Processing", len(items), "batch items using", jobs, "jobs")
+    gpt_options = ""
+    item_options = dict(platform=platform, output_dir=output_dir, cleanup=cleanup, fuse_graphs=fuse_graphs,
+                        gpt_options=gpt_options, scene_index=scene_index, artifact_store=artifact_store,
+                        scratch_tiers=scratch_tiers, pools=pools, snaphu_cpus=snaphu_cpus, trace_dir=trace_dir,
+                        trace_format=trace_format, tuner=tuner)
+
+    # Subtables that are identical in several items such as the reference
+    # scene of a common reference stack are only processed once
+    shared_items = []
+    shared_consumers = []
+    for n, consumers in enumerate(find_shared_subtables([x["workflow"] for x in items]).values()):
+        i, name = consumers[0]
+        workflow = dict(items[i]["workflow"], workflow={name: items[i]["workflow"]["workflow"][name]})
+        shared_items.append(dict(index=n, workflow=deepcopy(workflow), batch_subtables=[name],
+                                 output_dir=os.path.join(output_dir, "shared"),
+                                 trace_dir=trace_dir and os.path.join(trace_dir, "shared")))
+        shared_consumers.append(consumers)
+    for consumers in shared_consumers:
+        for i, name in consumers:
+            del items[i]["workflow"]["workflow"][name]
+            items[i]["batch_subtables"] = [x for x in items[i]["batch_subtables"] if x != name]
+    if shared_items:
+        print("INFO: Processing", len(shared_items), "subtables shared by several batch items")
+        os.makedirs(os.path.join(output_dir, "shared"), exist_ok=True)
+
+    # Scenes in S3 are downloaded once into a shared cache while other items
+    # are being processed
+    scene_cache = None
+    if s3 is not None:
+        scene_cache = SceneCache(os.path.join(output_dir, "tmp"), s3, max_workers=io_jobs,
+                                 max_concurrency=int(kwargs.get("download_concurrency") or 8), pools=pools)
+    start = time.time()
+    try:
+        prefetch = int(kwargs.get("prefetch") or 2)
+        shared_results = execute_batch_items(shared_items, workers, scene_cache, prefetch, options=item_options)
+
+        # Items use the shared outputs as $ sources. Shared outputs are kept
+        # until the last item using them is finished.
+        results = [None] * len(items)
+        shared_refs = {}
+        for result, consumers in zip(shared_results, shared_consumers):
+            for i, name in consumers:
+                if result.error is not None:
+                    results[i] = BatchItemResult(i, get_item_sources(items[i]))
+                    results[i].error = f"Shared subtable {name} failed\n{result.error}"
+                    continue
+                items[i].setdefault("shared_outputs", {})[name] = result.output_dim
+                shared_refs[result.output_dim] = shared_refs.get(result.output_dim, 0) + 1
+
+        def release_shared(k: int) -> None:
+            for output_dim in items[k].get("shared_outputs", {}).values():
+                shared_refs[output_dim] -= 1
+                if shared_refs[output_dim] == 0 and cleanup:
+                    os.remove(output_dim)
+                    shutil.rmtree(output_dim.replace(".dim", ".data"), ignore_errors=True)
+
+        # Items that are skipped because one of their shared subtables failed
+        # release the shared outputs they would have used
+        for k in range(len(items)):
+            if results[k] is not None:
+                release_shared(k)
+
+        pending = [k for k in range(len(items)) if results[k] is None]
+
+        # Items with short independent chains are packed into graphs of
+        # graph_batch branches so they share a single GPT call
+        graph_batch = int(kwargs.get("graph_batch") or 1)
+        if graph_batch > 1:
+            packable = [k for k in pending if is_packable_item(items[k])]
+            pending = [k for k in pending if k not in set(packable)]
+            packs = [packable[n:n + graph_batch] for n in range(0, len(packable), graph_batch)]
+            if packs:
+                print("INFO: Processing", len(packable), "batch items in", len(packs), "graphs")
+            pack_items = [dict(items=[items[k] for k in pack],
+                               graph_file=os.path.join(output_dir, "graphs", f"items_{pack[0]:04d}.xml"))
+                          for pack in packs]
+            pack_results = execute_batch_items(pack_items, workers, scene_cache, prefetch,
+                                               run_item=run_packed_batch_items, options=item_options)
+            for pack, pack_result in zip(packs, pack_results):
+                for k, result in zip(pack, pack_result):
+                    results[k] = result
+
+        pending_results = execute_batch_items([items[k] for k in pending], workers, scene_cache, prefetch,
+                                              on_finished=lambda k: release_shared(pending[k]), options=item_options)
+        for k, result in zip(pending, pending_results):
+            results[k] = result
+        if cleanup and shared_items:
+            shutil.rmtree(os.path.join(output_dir, "shared"), ignore_errors=True)
+    finally:
+        if scene_cache is not None:
+            scene_cache.close()
+            shutil.rmtree(scene_cache.cache_dir, ignore_errors=True)
+        if manager is not None:
+            manager.shutdown()
+
+    report_batch_results(results, os.path.join(output_dir, "batch_results.json"))
+    # Downloads of the scene cache are recorded by the pools of the batch
+    records = [x for result in shared_results + results for x in result.stages] + pools.records
+    report_pool_utilization(pools.slots, records, start, time.time(), len(results))
+    if trace_dir is not None:
+        summary = summarize_traces(glob(os.path.join(trace_dir, "**", "item*.json*"), recursive=True))
+        report_trace_summary(summary)
+        # Later runs use the measured memory and parallelism of each step
+        learn_profiles(summary, learned_profiles)
+    return results
+
+def find_shared_subtables(workflow_list: list) -> dict:
+    """
+    Find workflow subtables that are identical in more than one batch item.
+    Subtables are identical if they have the same sources, operators, and
+    parameters. Subtables that use $ sources are not shared.
+
+    Returns
+    -------
+    dict
+        Dictionary where the values are lists of (item index, subtable name)
+        of the items that use the same subtable.
+    """
+    consumers = {}
+    for i, workflow in enumerate(workflow_list):
+        for name, steps in workflow["workflow"].items():
+            if get_source_references(steps):
+                continue
+            key = json.dumps(steps, sort_keys=True, default=str)
+            consumers.setdefault(key, []).append((i, name))
+    return {k: v for k, v in consumers.items() if len(v) > 1}
+
+def get_item_sources(item: dict) -> list:
+    """
+    Get the entry point sources of a batch item or of all items of a graph
+    batch.
+    """
+    if "items" in item:
+        return [x for packed in item["items"] for x in get_item_sources(packed)]
+    # Subswath branches of a subtable read the same scene
+    return list(dict.fromkeys(item["workflow"]["workflow"][x][0]["source"] for x in item["batch_subtables"]))
+
+def execute_batch_items(items: list, jobs: int, scene_cache: SceneCache = None, prefetch: int = 2, on_finished=None,
+                        run_item=None, options: dict = None) -> list:
+    """
+    Run batch items using a pool of workers. If a scene cache is given, the S3
+    sources of the next `prefetch` items after the running ones are
+    downloaded in the background so the download time is hidden behind
+    processing. Scenes are released once the items using them are finished.
 
-def download_s3(s3_uri: str, output_file: str, profile: str = "default"):
+    Parameters
+    ----------
+    items: list
+        List of keyword arguments of `run_batch_item` for each item.
+    jobs: int
+        Number of items processed at the same time.
+    scene_cache: SceneCache
+        Cache used to download S3 sources.
+    prefetch: int
+        Number of upcoming items to download in advance.
+    on_finished: callable
+        Optional function called with the item index after an item is finished.
+    run_item: callable
+        Function used to run each item. Defaults to `run_batch_item`. Graph
+        batches are run with `run_packed_batch_items` and return a list of
+        results.
+    options: dict
+        Keyword arguments shared by all items. The keys of an item override
+        them.
+
+    Returns
+    -------
+    list
+        List of BatchItemResult in the same order as items.
+    """
+    if run_item is None:
+        run_item = run_batch_item
+    results = [None] * len(items)
+    s3_sources = [[x for x in get_item_sources(item) if x.startswith("s3://")] for item in items]
+    if scene_cache is not None:
+        for sources in s3_sources:
+            for source in sources:
+                scene_cache.register(source)
+
+    def collect(running: dict, return_when: str) -> None:
+        finished, _ = wait(running, return_when=return_when)
+        for future in finished:
+            k = running.pop(future)
+            results[k] = future.result()
+            for source in s3_sources[k]:
+                scene_cache.release(source)
+            if on_finished is not None:
+                on_finished(k)
+
+    # Processing is done by GPT subprocesses so a single job can use a thread
+    executor_class = ThreadPoolExecutor if jobs == 1 else ProcessPoolExecutor
+    running = {}
+    with executor_class(max_workers=jobs) as executor:
+        for k, item in enumerate(items):
+            if scene_cache is not None:
+                for sources in s3_sources[k:k + jobs + prefetch]:
+                    for source in sources:
+                        scene_cache.prefetch(source)
+
+            # Wait for a free worker
+            while len(running) >= jobs:
+                collect(running, FIRST_COMPLETED)
+
+            # Set sources to local files instead of S3 URIs
+            try:
+                acquired = {}
+                for packed in item.get("items", [item]):
+                    for subtable in packed["batch_subtables"]:
+                        step = packed["workflow"]["workflow"][subtable][0]
+                        if step["source"].startswith("s3://"):
+                            if step["source"] not in acquired:
+                                acquired[step["source"]] = scene_cache.acquire(step["source"])
+                            step["source"] = acquired[step["source"]]
+            except Exception:
+                error = traceback.format_exc()
+                if "items" in item:
+                    results[k] = [BatchItemResult(x["index"], get_item_sources(x)) for x in item["items"]]
+                    for result in results[k]:
+                        result.error = error
+                else:
+                    results[k] = BatchItemResult(k, s3_sources[k])
+                    results[k].error = error
+                print(f"ERROR: Batch item {k} failed to download sources {s3_sources[k]}\n{error}")
+                for source in s3_sources[k]:
+                    scene_cache.release(source)
+                if on_finished is not None:
+                    on_finished(k)
+                continue
+
+            running[executor.submit(run_item, **dict(options or {}, **item))] = k
+        collect(running, ALL_COMPLETED)
+
+    return results
+
+def run_batch_item(index: int, workflow: dict, batch_subtables: list, platform: str, output_dir: str, cleanup: bool,
+                   fuse_graphs: bool = False, gpt_options: str = "", scene_index: SceneIndex = None,
+                   shared_outputs: dict = None, artifact_store: ArtifactStore = None,
+                   scratch_tiers: list = None, pools: StagePools = None, snaphu_cpus: int = None,
+                   trace_dir: str = None, trace_format: str = "jsonl", tuner: GptTuner = None) -> BatchItemResult:
     """
-    Download file from AWS S3
+    Run a single batch processing item in its own scratch directory so cleanup
+    does not affect other items running at the same time. The final product is
+    moved to the output directory. Errors are stored in the returned result
+    instead of being raised. GPT, SNAPHU, and file transfer stages wait for a
+    free slot in their pool if stage pools are given. If trace_dir is given,
+    the resources used by every step are written to a trace file of the item
+    in that directory.
     """
+    sources = list(dict.fromkeys(workflow["workflow"][x][0]["source"] for x in batch_subtables))
+    result = BatchItemResult(index, sources)
+    # Record the stages of this item only
+    if pools is not None:
+        pools = pools.for_item()
+    item_dir = os.path.join(output_dir, f"item_{index:04d}")
+    scratch = None
+    trace = None
+    if trace_dir is not None:
+        trace = TraceWriter(os.path.join(trace_dir, f"item_{index:04d}{TRACE_FORMATS[trace_format]}"), trace_format)
     try:
-        import boto3
-    except ImportError:
-        raise ImportError("boto3 is not installed. Install boto3 in your environment to use this function.")
+        os.makedirs(item_dir, exist_ok=True)
+        scratch = ScratchTracker(workflow["workflow"], item_dir, cleanup, tiers=scratch_tiers)
+        output_dim, output_data = run(workflow, platform, item_dir, [], cleanup=cleanup, fuse_graphs=fuse_graphs,
+                                      gpt_options=gpt_options, scene_index=scene_index, shared_outputs=shared_outputs,
+                                      artifact_store=artifact_store, scratch=scratch, pools=pools,
+                                      snaphu_cpus=snaphu_cpus, trace=trace, tuner=tuner)
 
-    path_parts = s3_uri.replace("s3://","").split("/")
-    bucket = path_parts.pop(0)
-    prefix = "/".join(path_parts)
+        # Move the final product from the scratch directory to the output directory
+        with pools.stage("io") if pools is not None else nullcontext():
+            result.output_dim = shutil.move(output_dim, os.path.join(output_dir, os.path.basename(output_dim)))
+            if os.path.exists(output_data):
+                result.output_data = shutil.move(output_data, os.path.join(output_dir, os.path.basename(output_data)))
+            # Outputs of steps marked with keep = true are moved as well
+            for step in scratch.final:
+                kept_dim = scratch.targets.get(step)
+                if kept_dim is None or kept_dim == output_dim or not os.path.isfile(kept_dim):
+                    continue
+                kept_data = kept_dim.replace(".dim", ".data")
+                shutil.move(kept_dim, os.path.join(output_dir, os.path.basename(kept_dim)))
+                if os.path.isdir(kept_data):
+                    shutil.move(kept_data, os.path.join(output_dir, os.path.basename(kept_data)))
+        if cleanup:
+            shutil.rmtree(item_dir)
+    except Exception:
+        result.error = traceback.format_exc()
+        print(f"ERROR: Batch item {index} failed with sources {sources}\n{result.error}")
+    if scratch is not None:
+        result.peak_scratch = scratch.peak_size
+    if pools is not None:
+        result.stages = pools.records
+    return result
 
-    session = boto3.Session(profile_name=profile)
-    s3 = session.client('s3')
-    
-    # Download progress
-    meta_data = s3.head_object(Bucket=bucket, Key=prefix)
-    total_length = int(meta_data.get('ContentLength', 0))
-    downloaded = 0
-    def progress(chunk):
-        nonlocal downloaded
-        downloaded += chunk
-        done = int(50 * downloaded / total_length)
-        sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50-done)) )
-        sys.stdout.flush()
-    print(f"INFO: Downloading from AWS S3 {s3_uri}")
-    with open(output_file, 'wb') as f:
-        s3.download_fileobj(bucket, prefix, f, Callback=progress)
-    print()
-    return
+def is_packable_item(item: dict) -> bool:
+    """
+    Check if a batch item can be run as a branch of a graph batch. The item
+    must have a single subtable without $ sources, graph boundary operators,
+    or kept intermediate products.
+    """
+    workflow = item["workflow"]["workflow"]
+    if len(workflow) != 1 or item.get("shared_outputs"):
+        return False
+    steps = next(iter(workflow.values()))
+    if get_source_references(steps):
+        return False
+    for i, step in enumerate(steps):
+        if is_graph_boundary(step["operator"]) or step.get("keep") or (i > 0 and step.get("source")):
+            return False
+    return True
+
+def run_packed_batch_items(items: list, graph_file: str, **options) -> list:
+    """
+    Run several batch items as the branches of a single graph so the JVM
+    startup and the loading of SNAP plugins are paid once for all of them.
+    Items must be accepted by `is_packable_item`. If GPT fails, the branches
+    named in the node IDs of the GPT output are marked as failed and the
+    other branches are run again. If GPT does not name a node, every branch
+    is run on its own so the failure is attributed to the item that caused
+    it.
+
+    Parameters
+    ----------
+    items: list
+        List of keyword arguments of `run_batch_item` for each item.
+    graph_file: str
+        Path of the graph XML file. The GPT output is written next to it.
+    options:
+        Keyword arguments shared by all items. The keys of an item override
+        them.
+
+    Returns
+    -------
+    list
+        List of BatchItemResult in the same order as items.
+    """
+    items = [dict(options, **x) for x in items]
+    first = items[0]
+    results = [BatchItemResult(item["index"], get_item_sources(item)) for item in items]
+    pools = first["pools"].for_item() if first.get("pools") is not None else None
+    trace = None
+    if first.get("trace_dir") is not None:
+        name = f"items_{first['index']:04d}_{items[-1]['index']:04d}{TRACE_FORMATS[first['trace_format']]}"
+        trace = TraceWriter(os.path.join(first["trace_dir"], name), first["trace_format"])
+    gpt_options = first["gpt_options"]
+    artifact_store = first["artifact_store"]
+    tuner = first.get("tuner")
+
+    # Compute the steps and targets of every item without running them
+    targets = {}
+    branches = {}
+    for k, item in enumerate(items):
+        try:
+            item_dir = os.path.join(item["output_dir"], f"item_{item['index']:04d}")
+            os.makedirs(item_dir, exist_ok=True)
+            segments = []
+            targets[k] = run_processing_groups(parse_workflow_groups(item["workflow"]), item_dir, item["platform"],
+                                               True, gpt_options, item["scene_index"], artifact_store=artifact_store,
+                                               graph_branches=segments, tuner=tuner)
+            # Outputs fetched from the artifact store have no segment
+            if segments:
+                branches[k] = segments[0]
+        except Exception:
+            results[k].error = traceback.format_exc()
+
+    log_file = os.path.splitext(graph_file)[0] + ".log"
+    while branches:
+        keys = list(branches)
+        for k in keys:
+            remove_product(targets[k])
+        node_branches = write_graph_branches([(x, x[0]["sources"], x[-1]["target"]) for x in branches.values()],
+                                             graph_file)
+        operators = "+".join(x["operator"] for x in branches[keys[0]])
+        # The memory of the graph is estimated from the sources of all branches
+        sources = [x for steps in branches.values() for x in steps[0]["sources"]]
+        options, env = tuner.options([x["operator"] for x in branches[keys[0]]], sources) if tuner else ("", None)
+        cmd = f'gpt "{graph_file}" {gpt_options} {options}'.strip().replace("  ", " ")
+        print("INFO: Running graph", graph_file, "with", len(keys), "batch items and operators", operators)
+        with pools.stage("gpt") if pools is not None else nullcontext():
+            record = run_command(cmd, f"{len(keys)}x {operators}", "gpt", None, trace, shell=True, log_file=log_file,
+                                 env=env)
+        with open(log_file) as f:
+            output = f.read()
+        print(output)
+        if record["exit_status"] == 0:
+            for k in keys:
+                steps = branches.pop(k)
+                if artifact_store is not None and steps[-1].get("key") is not None:
+                    artifact_store.publish(steps[-1]["key"], targets[k], steps[-1]["operator"])
+            break
+
+        failed = [keys[x] for x in get_failed_branches(output, node_branches)]
+        if not failed:
+            print("WARNING: GPT did not report the failing node of", graph_file, "so every batch item is run on its own")
+            for k in keys:
+                steps = branches.pop(k)
+                try:
+                    run_graph_segment(steps, f"{os.path.splitext(graph_file)[0]}_{k}.xml", gpt_options, artifact_store,
+                                      pools=pools, trace=trace, tuner=tuner)
+                except Exception:
+                    results[k].error = traceback.format_exc()
+            break
+        for k in failed:
+            del branches[k]
+            remove_product(targets[k])
+            results[k].error = f"GPT failed with exit status {record['exit_status']} in a graph of {len(keys)} batch " \
+                               f"items: {cmd}\n{output}"
+
+    # Move the final products from the scratch directories to the output directory
+    for k, item in enumerate(items):
+        result = results[k]
+        if result.error is not None:
+            print(f"ERROR: Batch item {item['index']} failed with sources {result.sources}\n{result.error}")
+            continue
+        output_dim = targets[k]
+        output_data = output_dim.replace(".dim", ".data")
+        with pools.stage("io") if pools is not None else nullcontext():
+            result.output_dim = shutil.move(output_dim, os.path.join(item["output_dir"], os.path.basename(output_dim)))
+            if os.path.exists(output_data):
+                result.output_data = shutil.move(output_data,
+                                                 os.path.join(item["output_dir"], os.path.basename(output_data)))
+        if item["cleanup"]:
+            shutil.rmtree(os.path.dirname(output_dim))
+    # The stages are shared by all items so they are only reported once
+    if pools is not None:
+        results[0].stages = pools.records
+    return results
+
+def report_batch_results(results: list, output_file: str = None) -> None:
+    """
+    Print a summary of batch processing results and optionally save them to a
+    JSON file.
+    """
+    failed = [x for x in results if x.error is not None]
+    print(f"INFO: {len(results) - len(failed)} of {len(results)} batch items finished successfully")
+    for result in failed:
+        print(f"ERROR: Batch item {result.index} failed: {result.sources}")
+    peaks = [x.peak_scratch for x in results if x.peak_scratch is not None]
+    if peaks:
+        print(f"INFO: Peak scratch usage per batch item {max(peaks) / 1024**3:.2f} GB")
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            json.dump([vars(x) for x in results], f, indent=2)
 
 if __name__ == "__main__":
 
@@ -423,17 +1066,61 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='pysnap-toolbox command line interface')
 
     main_args = parser.add_argument_group('Global Parameters')
-    main_args.add_argument('--pattern', help='Optional glob pattern used to filter data for batch processing')
+    main_args.add_argument('--pattern', help='Optional glob pattern used to filter data for batch processing. For S3 batch folders \
+                           directory levels such as "2022/*/S1A_*.zip" are listed concurrently')
     main_args.add_argument('--config', help='Input TOML config file for a single SNAP workflow or to be used as a template for batch processing')
     main_args.add_argument('--output-dir', help='Output directory for processed data')
     main_args.add_argument('--platform', help='Satellite platform that was used to capture the data')
     main_args.add_argument('--cleanup', action='store_true', help='Clean up scratch files after workflow is finished')
+    main_args.add_argument('--scratch-dir', help='Comma separated list of directories ordered from the fastest to the slowest \
+                           storage where intermediate products are written such as "/dev/shm:16G,/mnt/nvme". Each directory \
+                           can have a maximum size after a colon. The next directory is used when one is full. Final \
+                           products are written to the output directory.', default=None)
+    main_args.add_argument('--profile', action='store_true', help='Record the wall time, CPU time, peak memory, and I/O of \
+                           every GPT and SNAPHU call in trace files in the traces folder of the output directory. \
+                           Traces can be summarized with python -m pysnaptoolbox.profiling')
+    main_args.add_argument('--trace-format', choices=['jsonl', 'chrome'], default='jsonl', help='Format of the trace files. \
+                           Chrome traces can be opened in chrome://tracing or Perfetto')
+    main_args.add_argument('--aoi', help='Area of interest as a WKT polygon or the path of a WKT or GeoJSON file. Only the \
+                           subswaths and bursts intersecting it are processed by TOPSAR-Split steps. Overrides the aoi \
+                           key of the TOML file.', default=None)
+    main_args.add_argument('--learned-profiles', help='JSON file of the peak memory and parallelism of GPT steps learned \
+                           from traces of runs with --profile. They are used to choose the heap, tile cache, and \
+                           threads of GPT calls. Defaults to a file in the user cache directory.', default=None)
+    main_args.add_argument('--artifact-store', help='Directory used to store finished step outputs so reruns and other workflows \
+                           sharing the same steps reuse them instead of recomputing them', default=None)
+    main_args.add_argument('--artifact-store-size', help='Maximum size of the artifact store such as 500G. The least recently \
+                           used outputs are removed when it is exceeded', default=None)
     main_args.add_argument('--aws-profile', help="Name of the aws credential profile to use", default='default')
+    main_args.add_argument('--s3-endpoint-url', help="Endpoint URL of an S3 compatible server such as MinIO", default=None)
+    main_args.add_argument('--prefetch', help="Number of upcoming batch items whose S3 sources are downloaded in advance", default=2)
+    main_args.add_argument('--download-concurrency', help="Number of concurrent range requests used to download each S3 scene",
+                           default=8)
+    main_args.add_argument('--fuse-graphs', action='store_true', help='Compile the steps of each workflow subtable into a single SNAP graph \
+                           so intermediate products are kept in memory. SNAPHU operators are always run as separate steps.')
 
     batch_args = parser.add_argument_group("Batch Processing")
     batch_args.add_argument('--batch', help='Input directory containing image data used as input for batch image processing. \
                            Can be a local directory or an S3 URI link that starts with "s3://"')
+    batch_args.add_argument('--jobs', help='Number of batch items to process at the same time or "auto" to derive it \
+                           from the available cores and memory.', default=1)
+    batch_args.add_argument('--snaphu-jobs', help='Number of SNAPHU unwrapping jobs running at the same time in addition to \
+                           the GPT jobs. Items start GPT processing while other items are unwrapping. By default \
+                           every batch job can run SNAPHU in turn.', default=None)
+    batch_args.add_argument('--graph-batch', help='Number of batch items packed into a single SNAP graph with one \
+                           Read -> ... -> Write branch per item so they share one GPT call and JVM startup. Only items \
+                           with a single subtable without SNAPHU operators are packed.', default=1)
+    batch_args.add_argument('--io-jobs', help='Number of downloads and file transfers running at the same time.', default=2)
     batch_args.add_argument('--batch-step', help="Number of files to skip ahead in a folder when a batch of files is done.", default=1)
+    batch_args.add_argument('--pairing', choices=['sequential', 'reference', 'sbas'], default='sequential', help='How scenes \
+                           sorted by acquisition time are grouped into batch items. sequential: consecutive scenes. \
+                           reference: one reference scene paired with every other scene. sbas: each scene paired with \
+                           the following scenes within --max-baseline days, up to --max-connections of them.')
+    batch_args.add_argument('--reference', help='Reference scene of the reference pairing as a file name or YYYYMMDD date. \
+                           Defaults to the scene closest to the middle of the time span.', default=None)
+    batch_args.add_argument('--max-baseline', help='Largest temporal baseline in days of sbas pairs.', default=None)
+    batch_args.add_argument('--max-connections', help='Largest number of later scenes each scene is paired with by sbas.',
+                           default=None)
     batch_args.add_argument('--batch-subtables', help='Target subtables used to identify the entry points in your TOML file. \
                     The number of entry points indicate the number of files that will be processed per batch (batch size). \
                     A subtable can be seen as [[workflow.image1]] and [[workflow.image2]]. This would be a comma separated list \
@@ -444,7 +1131,23 @@ if __name__ == "__main__":
     args = vars(args)
 
     if not args["batch"]:
-        run(args["config"], args["platform"], args["output_dir"], [], args["cleanup"])
+        artifact_store = create_artifact_store(args["artifact_store"], args["artifact_store_size"])
+        trace = None
+        if args["profile"]:
+            trace_file = os.path.join(args["output_dir"], "traces", f"run{TRACE_FORMATS[args['trace_format']]}")
+            trace = TraceWriter(trace_file, args["trace_format"])
+        config = TomlConfig()
+        config.load_config(args["config"])
+        if args["aoi"]:
+            config["aoi"] = args["aoi"]
+        tuner = GptTuner(1, config.get("resources"), load_learned_profiles(args["learned_profiles"]))
+        run(config, args["platform"], args["output_dir"], [], args["cleanup"], args["fuse_graphs"],
+            artifact_store=artifact_store, scratch_tiers=parse_scratch_tiers(args["scratch_dir"] or ""), trace=trace,
+            tuner=tuner)
+        if trace is not None:
+            summary = summarize_traces([trace.trace_file])
+            report_trace_summary(summary)
+            learn_profiles(summary, args["learned_profiles"])
     else:
         if not args["pattern"]:
             args["pattern"] = "*"
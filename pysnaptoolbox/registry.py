@@ -0,0 +1,271 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+
+# Persistent cache of SNAP operator information parsed from `gpt <operator> -h`
+
+# Increase when the structure of the cache file changes
+CACHE_VERSION = 1
+
+def default_cache_file() -> str:
+    """
+    Get the default path of the operator registry cache file.
+    """
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "pysnaptoolbox", "operators.json")
+
+def find_snap_install(gpt: str = "gpt") -> str:
+    """
+    Get the SNAP installation directory from the location of the GPT executable.
+    """
+    gpt_path = shutil.which(gpt)
+    if gpt_path is None:
+        raise FileNotFoundError(f"Cannot find SNAP GPT executable '{gpt}'")
+    # GPT is located in <install>/bin/gpt
+    return os.path.dirname(os.path.dirname(os.path.realpath(gpt_path)))
+
+def get_snap_version(install_dir: str) -> str:
+    """
+    Get a string identifying the SNAP version without starting a JVM. It uses
+    the VERSION.txt of the installation and the modification times of the module
+    directories so that plugin updates are also detected.
+
+    Parameters
+    ----------
+    install_dir: str
+        SNAP installation directory.
+    """
+    version = "unknown"
+    version_file = os.path.join(install_dir, "VERSION.txt")
+    if os.path.isfile(version_file):
+        with open(version_file) as f:
+            version = " ".join(f.read().split())
+
+    module_dirs = [os.path.join(install_dir, x, "modules") for x in sorted(os.listdir(install_dir))]
+    module_dirs.append(os.path.join(os.path.expanduser("~"), ".snap", "system", "modules"))
+    mtimes = [str(int(os.path.getmtime(x))) for x in module_dirs if os.path.isdir(x)]
+    return f"{version} ({','.join(mtimes)})"
+
+def parse_operator_list(stdout: str) -> list:
+    """
+    Get the list of operator names from the output of `gpt -h`.
+    """
+    operators = []
+    in_section = False
+    for line in stdout.splitlines():
+        if line.strip() == "Operators:":
+            in_section = True
+            continue
+        if in_section:
+            match = re.match(r"^\s+(\S+)\s*", line)
+            if not match:
+                if operators:
+                    break
+                continue
+            operators.append(match.group(1))
+    return operators
+
+def parse_operator_help(stdout: str) -> dict:
+    """
+    Parse the output of `gpt <operator> -h` into a dictionary containing the
+    source flag, all source option names, and parameter names, types,
+    and default values.
+    """
+    # Source flag used in the XML graph e.g. ${source} or ${sourceProduct}
+    match = re.search(r"\${(source)}|\${(sourceProduct)}", stdout)
+    source_flags = re.findall(r"^\s*-S(\w+)=", stdout, flags=re.MULTILINE)
+    if match:
+        source_flag = match.group(1) or match.group(2)
+    elif source_flags:
+        source_flag = source_flags[0]
+    else:
+        source_flag = None
+
+    # Each parameter starts with -P<name>=<type> and the description lines
+    # that follow it may contain the default value
+    parameters = {}
+    entries = re.split(r"^\s*(?=-P\w+=)", stdout, flags=re.MULTILINE)
+    for entry in entries:
+        match = re.match(r"-P(\w+)=<([^>]+)>", entry)
+        if not match:
+            continue
+        default = re.search(r"Default value is '(.*?)'\.", entry)
+        parameters[match.group(1)] = {
+            "type": match.group(2),
+            "default": default.group(1) if default else None,
+        }
+
+    return {
+        "source_flag": source_flag,
+        "source_flags": source_flags,
+        "parameters": parameters,
+    }
+
+
+class OperatorRegistry:
+
+    def __init__(self, cache_file: str = None, gpt: str = "gpt") -> None:
+        """
+        Registry of SNAP operators which is saved to a cache file. All operators
+        are introspected at once using the GPT CLI when there is no cache for
+        the SNAP installation, and again when the installation changes.
+        """
+        self.cache_file = cache_file or default_cache_file()
+        self.gpt = gpt
+        self.install_dir = find_snap_install(gpt)
+        self.snap_version = get_snap_version(self.install_dir)
+        self.operators = {}
+        self._lock = threading.Lock()
+        self.loaded = self.load()
+        if not self.loaded:
+            self.refresh()
+
+    def _introspect(self, operator: str):
+        output = subprocess.run([self.gpt, operator, "-h"], capture_output=True)
+        stdout = output.stdout.decode('utf-8')
+        if "Unknown operator" in stdout + output.stderr.decode('utf-8', errors='replace'):
+            return None
+        # Failures such as a JVM crash are not cached so the next run tries again
+        if output.returncode != 0 or not stdout.strip():
+            raise RuntimeError(f"Cannot introspect operator {operator}: gpt exited with status {output.returncode}\n"
+                               f"{output.stderr.decode('utf-8', errors='replace')}")
+        return parse_operator_help(stdout)
+
+    def load(self) -> bool:
+        """
+        Load operators from the cache file. Returns False if the cache does not
+        exist or was created for a different SNAP installation or version.
+        """
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if cache.get("version") != CACHE_VERSION:
+            return False
+        install = cache.get("installs", {}).get(self.install_dir)
+        if install is None or install.get("snap_version") != self.snap_version:
+            return False
+        self.operators = install["operators"]
+        return True
+
+    def save(self) -> None:
+        """
+        Save the operators to the cache file. Entries of other SNAP installations
+        in the cache file are kept.
+        """
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            if cache.get("version") != CACHE_VERSION:
+                cache = {}
+        except (OSError, ValueError):
+            cache = {}
+        cache["version"] = CACHE_VERSION
+        cache.setdefault("installs", {})[self.install_dir] = {
+            "snap_version": self.snap_version,
+            "operators": self.operators,
+        }
+
+        # Write to a temp file first so readers never see a partial file
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f, indent=1)
+        os.replace(tmp_file, self.cache_file)
+
+    def refresh(self, operators: list = None, max_workers: int = None) -> None:
+        """
+        Introspect operators using the GPT CLI and save them to the cache file.
+        If no operators are given, all operators listed by `gpt -h` are used.
+        """
+        if operators is None:
+            print(f"INFO: Building the SNAP operator registry of {self.install_dir}")
+            output = subprocess.run([self.gpt, "-h"], capture_output=True)
+            if output.returncode != 0:
+                raise RuntimeError(f"Cannot list the SNAP operators: gpt exited with status {output.returncode}\n"
+                                   f"{output.stderr.decode('utf-8', errors='replace')}")
+            operators = parse_operator_list(output.stdout.decode('utf-8'))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {x: executor.submit(self._introspect, x) for x in operators}
+        results = {}
+        for operator, future in futures.items():
+            try:
+                info = future.result()
+            except RuntimeError as e:
+                print(f"WARNING: {e}")
+                continue
+            # Unknown operators are not cached so plugins installed later are found
+            if info is not None:
+                results[operator] = info
+        with self._lock:
+            self.operators.update(results)
+            self.save()
+
+    def get(self, operator: str) -> dict:
+        """
+        Get the information of an operator. Operators missing from the registry
+        are introspected and added to the cache file, which only happens for
+        operators that GPT did not list. Raises a RuntimeError without caching
+        anything if GPT fails.
+
+        Parameters
+        ----------
+        operator: str
+            SNAP Operator as identified in the SNAP Graphs
+        """
+        info = self.operators.get(operator)
+        if info is None:
+            info = self._introspect(operator)
+            if info is None:
+                raise ValueError(f"Unknown operator '{operator}'")
+            with self._lock:
+                self.operators[operator] = info
+                self.save()
+        return info
+
+    def source_flag(self, operator: str) -> str:
+        """
+        Get the source flag of an operator such as source or sourceProduct.
+        """
+        flag = self.get(operator)["source_flag"]
+        if flag is None:
+            raise ValueError(f"No source flag match found for operator {operator}")
+        return flag
+
+    def parameters(self, operator: str) -> dict:
+        """
+        Get the parameter names of an operator with their types and default values.
+        """
+        return self.get(operator)["parameters"]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry() -> OperatorRegistry:
+    """
+    Get the shared operator registry. The registry is created on first use.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = OperatorRegistry()
+    return _registry
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the pysnap-toolbox SNAP operator registry cache')
+    parser.add_argument('--cache-file', help='Path of the registry cache file', default=None)
+    args = parser.parse_args()
+
+    registry = OperatorRegistry(args.cache_file)
+    # A registry loaded from the cache is rebuilt on request
+    if registry.loaded:
+        registry.refresh()
+    print(f"INFO: Saved {len(registry.operators)} operators for {registry.install_dir} to {registry.cache_file}")
@@ -0,0 +1,73 @@
+import os
+
+# Tools used to split the resources of the machine between concurrent GPT jobs
+
+# Minimum memory and number of cores given to each GPT job
+MIN_JOB_MEMORY = 8 * 1024**3
+MIN_JOB_CORES = 2
+
+def cpu_count() -> int:
+    """
+    Get the number of cores available to this process.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def available_memory() -> int:
+    """
+    Get the available memory in bytes. Returns None if it cannot be determined.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def parse_size(value: str) -> int:
+    """
+    Parse a size such as 500G, 64M, or 1024 into bytes.
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    value = str(value).strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def auto_jobs(n_items: int = None) -> int:
+    """
+    Get the number of GPT jobs that can run at the same time on this machine
+    without oversubscribing the cores or the memory.
+
+    Parameters
+    ----------
+    n_items: int
+        Number of items to be processed. The number of jobs will not exceed it.
+    """
+    jobs = cpu_count() // MIN_JOB_CORES
+    memory = available_memory()
+    if memory is not None:
+        jobs = min(jobs, memory // MIN_JOB_MEMORY)
+    if n_items is not None:
+        jobs = min(jobs, n_items)
+    return max(1, int(jobs))
+
+def parse_jobs(value, n_items: int = None) -> int:
+    """
+    Parse the value of the --jobs CLI flag which is either a number or "auto".
+    """
+    if str(value).lower() == "auto":
+        return auto_jobs(n_items)
+    jobs = int(value)
+    if jobs < 1:
+        raise ValueError(f"Number of jobs must be at least 1, got {value}")
+    return jobs
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,378 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from fnmatch import fnmatch
+import hashlib
+import io
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from zipfile import ZipFile
+
+from .dates import find_manifest_member
+from .metadata import SceneMetadata, parse_manifest
+
+# Tools used to read data from AWS S3 or S3 compatible storage
+
+def parse_s3_uri(s3_uri: str) -> tuple:
+    """
+    Split an S3 URI into the bucket name and key.
+    """
+    path_parts = s3_uri.replace("s3://","").split("/")
+    bucket = path_parts.pop(0)
+    key = "/".join(path_parts)
+    return bucket, key
+
+def get_s3_client(profile: str = "default", endpoint_url: str = None):
+    """
+    Create an S3 client. The endpoint_url can point to an S3 compatible server
+    such as MinIO or a local moto server.
+    """
+    try:
+        import boto3
+    except ImportError:
+        raise ImportError("boto3 is not installed. Install boto3 in your environment to use this function.")
+
+    session = boto3.Session(profile_name=profile)
+    return session.client("s3", endpoint_url=endpoint_url)
+
+def split_glob_prefix(pattern: str) -> str:
+    """
+    Get the literal part of a glob pattern before the first wildcard. This part
+    can be used as an S3 prefix so the filtering is done by the server.
+    """
+    return re.split(r"[*?\[]", pattern, maxsplit=1)[0]
+
+def list_s3_objects(client, bucket: str, prefix: str, pattern: str = "*", max_workers: int = 8):
+    """
+    List the keys of objects in an S3 prefix that match a glob pattern. Keys
+    are yielded as soon as they are listed so processing can start before the
+    listing is finished.
+
+    Each directory level in the pattern such as "2022/*/S1A_*.zip" is listed
+    concurrently using the "/" delimiter, and sub-prefixes that do not match the
+    pattern are skipped without being listed. The last part of the pattern is
+    matched against the filename of every object under the remaining prefixes.
+    All listings are paginated so prefixes with more than 1000 objects are
+    fully listed.
+
+    Parameters
+    ----------
+    client:
+        boto3 S3 client.
+    bucket: str
+        Name of the bucket.
+    prefix: str
+        Prefix of the batch folder.
+    pattern: str
+        Glob pattern relative to the prefix.
+    max_workers: int
+        Number of prefixes listed at the same time.
+    """
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    levels = pattern.split("/")
+    results = queue.Queue()
+
+    def list_prefix(current: str, level: int) -> None:
+        try:
+            paginator = client.get_paginator("list_objects_v2")
+            component = levels[level]
+            if level < len(levels) - 1:
+                # Directory level, only list sub-prefixes
+                pages = paginator.paginate(Bucket=bucket, Prefix=current + split_glob_prefix(component), Delimiter="/")
+                for page in pages:
+                    for item in page.get("CommonPrefixes", []):
+                        name = item["Prefix"][len(current):].rstrip("/")
+                        if fnmatch(name, component):
+                            results.put(("prefix", item["Prefix"], level + 1))
+            else:
+                pages = paginator.paginate(Bucket=bucket, Prefix=current + split_glob_prefix(component))
+                for page in pages:
+                    keys = []
+                    for item in page.get("Contents", []):
+                        # Skip directory placeholder objects
+                        if item["Key"].endswith("/"):
+                            continue
+                        if fnmatch(os.path.basename(item["Key"]), component):
+                            keys.append(item["Key"])
+                    results.put(("keys", keys))
+            results.put(("done", None))
+        except Exception as e:
+            results.put(("error", e))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        executor.submit(list_prefix, prefix, 0)
+        pending = 1
+        while pending:
+            kind, *value = results.get()
+            if kind == "prefix":
+                executor.submit(list_prefix, *value)
+                pending += 1
+            elif kind == "keys":
+                yield from value[0]
+            elif kind == "error":
+                raise value[0]
+            else:
+                pending -= 1
+
+def download_s3(s3_uri: str, output_file: str, profile: str = "default", endpoint_url: str = None):
+    """
+    Download file from AWS S3
+    """
+    bucket, prefix = parse_s3_uri(s3_uri)
+    s3 = get_s3_client(profile, endpoint_url)
+
+    # Download progress
+    meta_data = s3.head_object(Bucket=bucket, Key=prefix)
+    total_length = int(meta_data.get('ContentLength', 0))
+    downloaded = 0
+    def progress(chunk):
+        nonlocal downloaded
+        downloaded += chunk
+        done = int(50 * downloaded / total_length)
+        sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50-done)) )
+        sys.stdout.flush()
+    print(f"INFO: Downloading from AWS S3 {s3_uri}")
+    with open(output_file, 'wb') as f:
+        s3.download_fileobj(bucket, prefix, f, Callback=progress)
+    print()
+    return
+
+
+class S3RangeFile(io.RawIOBase):
+
+    def __init__(self, client, bucket: str, key: str, size: int = None, block_size: int = 64 * 1024) -> None:
+        """
+        Read-only file object for an S3 object which fetches data using HTTP
+        range requests. Data is fetched in blocks which are kept in memory so
+        the small reads done by ZipFile do not each become a request.
+        """
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        # Used by ZipFile as the archive filename
+        self.name = key
+        self.block_size = block_size
+        self.size = size if size is not None else client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.position = 0
+        self.blocks = {}
+        self.bytes_fetched = 0
+        self.requests = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self.position
+
+    def _fetch(self, first_block: int, last_block: int) -> None:
+        start = first_block * self.block_size
+        end = min((last_block + 1) * self.block_size, self.size) - 1
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}")
+        data = response["Body"].read()
+        self.bytes_fetched += len(data)
+        self.requests += 1
+        for block in range(first_block, last_block + 1):
+            offset = (block - first_block) * self.block_size
+            self.blocks[block] = data[offset:offset + self.block_size]
+
+    def readinto(self, buffer) -> int:
+        end = min(self.position + len(buffer), self.size)
+        if self.position >= end:
+            return 0
+
+        # Fetch missing blocks using a single range request
+        first_block = self.position // self.block_size
+        last_block = (end - 1) // self.block_size
+        missing = [x for x in range(first_block, last_block + 1) if x not in self.blocks]
+        if missing:
+            self._fetch(missing[0], missing[-1])
+
+        data = b"".join(self.blocks[x] for x in range(first_block, last_block + 1))
+        offset = self.position - first_block * self.block_size
+        n = end - self.position
+        buffer[:n] = data[offset:offset + n]
+        self.position = end
+        return n
+
+
+class SceneCache:
+
+    def __init__(self, cache_dir: str, client, max_workers: int = 2, max_concurrency: int = 8,
+                 chunk_size: int = 64 * 1024**2, pools=None) -> None:
+        """
+        Local cache of scenes stored in S3 which is shared by batch items.
+        Scenes are downloaded in background threads using concurrent multipart
+        range requests. Each scene is downloaded once and kept until the last
+        registered consumer releases it. Scenes are stored in a folder named
+        after a hash of their URI so keys with the same file name do not
+        overwrite each other, while the file name read by SNAP is kept.
+
+        Parameters
+        ----------
+        cache_dir: str
+            Directory where downloaded scenes are stored.
+        client:
+            boto3 S3 client.
+        max_workers: int
+            Number of scenes that are downloaded at the same time.
+        max_concurrency: int
+            Number of concurrent range requests used for each scene.
+        chunk_size: int
+            Size in bytes of each range request.
+        pools: StagePools
+            Optional stage pools. Downloads hold a slot of the io pool.
+        """
+        from boto3.s3.transfer import TransferConfig
+
+        self.cache_dir = cache_dir
+        self.client = client
+        self.transfer_config = TransferConfig(
+            multipart_threshold=chunk_size,
+            multipart_chunksize=chunk_size,
+            max_concurrency=max_concurrency,
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.downloads = {}
+        self.consumers = {}
+        self.pools = pools
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def local_path(self, s3_uri: str) -> str:
+        """
+        Get the path where a scene is stored in the cache.
+        """
+        bucket, key = parse_s3_uri(s3_uri)
+        digest = hashlib.sha1(f"{bucket}/{key}".encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, digest, os.path.basename(key))
+
+    def _download(self, s3_uri: str) -> str:
+        bucket, key = parse_s3_uri(s3_uri)
+        output_file = self.local_path(s3_uri)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        tmp_file = output_file + ".part"
+        print(f"INFO: Downloading from AWS S3 {s3_uri}")
+        start = time.time()
+        with self.pools.stage("io") if self.pools is not None else nullcontext():
+            self.client.download_file(bucket, key, tmp_file, Config=self.transfer_config)
+        os.replace(tmp_file, output_file)
+        elapsed = time.time() - start
+        size = os.path.getsize(output_file) / 1024**2
+        print(f"INFO: Downloaded {s3_uri} ({size:.0f} MB in {elapsed:.1f} s)")
+        return output_file
+
+    def register(self, s3_uri: str) -> None:
+        """
+        Register a consumer of a scene. The scene is kept in the cache until
+        every registered consumer has called `release`.
+        """
+        with self._lock:
+            self.consumers[s3_uri] = self.consumers.get(s3_uri, 0) + 1
+
+    def prefetch(self, s3_uri: str):
+        """
+        Start downloading a scene in the background if it is not downloaded yet.
+
+        Returns
+        -------
+        Future
+            Future that returns the local path of the scene.
+        """
+        with self._lock:
+            if s3_uri not in self.downloads:
+                self.downloads[s3_uri] = self.executor.submit(self._download, s3_uri)
+            return self.downloads[s3_uri]
+
+    def acquire(self, s3_uri: str) -> str:
+        """
+        Get the local path of a scene. Waits until the download is finished.
+        """
+        return self.prefetch(s3_uri).result()
+
+    def _remove(self, download) -> None:
+        if not download.cancelled() and download.exception() is None:
+            output_file = download.result()
+            os.remove(output_file)
+            try:
+                os.rmdir(os.path.dirname(output_file))
+            except OSError:
+                pass
+
+    def release(self, s3_uri: str) -> None:
+        """
+        Release a scene. The local file is deleted once the last consumer
+        releases it. A download that is still running is cancelled, or its
+        file is deleted when it finishes unless the scene was registered
+        again in the meantime.
+        """
+        with self._lock:
+            self.consumers[s3_uri] = self.consumers.get(s3_uri, 1) - 1
+            if self.consumers[s3_uri] > 0:
+                return
+            del self.consumers[s3_uri]
+            download = self.downloads.get(s3_uri)
+            if download is None:
+                return
+            if download.done() or download.cancel():
+                del self.downloads[s3_uri]
+            else:
+                download.add_done_callback(lambda x: self._remove_unused(s3_uri, x))
+                return
+        self._remove(download)
+
+    def _remove_unused(self, s3_uri: str, download) -> None:
+        # Called when a download released before it finished is done
+        with self._lock:
+            if self.consumers.get(s3_uri) or self.downloads.get(s3_uri) is not download:
+                return
+            del self.downloads[s3_uri]
+        self._remove(download)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+def probe_s3_scene(s3_uri: str, client, platform: str = "SENTINEL-1") -> SceneMetadata:
+    """
+    Read the metadata of a SAFE zip file stored in S3 without downloading it.
+    Only the zip central directory and the manifest.safe member are fetched
+    using range requests.
+    """
+    if platform.upper() != "SENTINEL-1":
+        raise ValueError(f"Unsupported sensor: {platform}")
+
+    bucket, key = parse_s3_uri(s3_uri)
+    head = client.head_object(Bucket=bucket, Key=key)
+    scene = SceneMetadata(s3_uri)
+    with S3RangeFile(client, bucket, key, head["ContentLength"]) as f:
+        with ZipFile(f) as archive:
+            with archive.open(find_manifest_member(archive)) as manifest:
+                parse_manifest(manifest, scene)
+        print(f"INFO: Read metadata of {s3_uri} using {f.requests} requests ({f.bytes_fetched / 1024:.0f} KB)")
+
+    if scene.start_time is None:
+        raise LookupError(f"Cannot find scene start time in {s3_uri}")
+    scene.size = head["ContentLength"]
+    scene.mtime = head.get("ETag")
+    return scene
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,125 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Tools used to run workflow subtables according to their dependencies
+
+def get_source_references(actions: list) -> list:
+    """
+    Get the names referenced using $ in the sources of a workflow subtable.
+
+    Parameters
+    ----------
+    actions: list
+        List of steps of a workflow subtable.
+    """
+    references = []
+    for action in actions:
+        sources = action.get("source")
+        if sources is None:
+            continue
+        if isinstance(sources, str):
+            sources = [sources]
+        for source in sources:
+            if source.startswith("$") and source[1:] not in references:
+                references.append(source[1:])
+    return references
+
+def build_dependency_graph(workflow: dict, sources: dict = None) -> dict:
+    """
+    Build a dependency graph of workflow subtables from their $ source
+    references. References to entries of the sources table are not
+    dependencies since those files already exist.
+
+    Parameters
+    ----------
+    workflow: dict
+        Workflow table of the TOML config where each key is a subtable name.
+    sources: dict
+        Sources table of the TOML config.
+
+    Returns
+    -------
+    dict
+        Dictionary where each key is a subtable name and the value is the list
+        of subtables that need to be finished before it can start.
+    """
+    sources = sources or {}
+    graph = {}
+    for section, actions in workflow.items():
+        graph[section] = []
+        for name in get_source_references(actions):
+            if name in workflow and name != section:
+                graph[section].append(name)
+            elif name not in sources:
+                raise KeyError(f"Source reference '${name}' in workflow.{section} does not match a subtable or source")
+    topological_order(graph)
+    return graph
+
+def topological_order(graph: dict) -> list:
+    """
+    Sort the subtables of a dependency graph so every subtable is placed after
+    its dependencies. The original order is kept where possible.
+    """
+    order = []
+    visiting = set()
+
+    def visit(node, path):
+        if node in order:
+            return
+        if node in visiting:
+            raise RuntimeError(f"Circular source references found in workflow: {' -> '.join(path + [node])}")
+        visiting.add(node)
+        for dependency in graph[node]:
+            visit(dependency, path + [node])
+        visiting.discard(node)
+        order.append(node)
+
+    for node in graph:
+        visit(node, [])
+    return order
+
+def run_dependency_graph(graph: dict, func, max_workers: int = 1) -> None:
+    """
+    Run `func(name)` for every subtable in a dependency graph. A subtable is
+    dispatched to the worker pool as soon as all of its dependencies are
+    finished. If a subtable fails, no new subtables are started and the error
+    is raised once the running subtables are finished.
+
+    Parameters
+    ----------
+    graph: dict
+        Dependency graph created by `build_dependency_graph`.
+    func: callable
+        Function that runs a single subtable.
+    max_workers: int
+        Maximum number of subtables that are run at the same time.
+    """
+    order = topological_order(graph)
+    done = set()
+    running = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            if error is None:
+                for node in order:
+                    if len(running) >= max_workers:
+                        break
+                    if node in done or node in running.values():
+                        continue
+                    if all(x in done for x in graph[node]):
+                        running[executor.submit(func, node)] = node
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    done.add(node)
+
+    if error is not None:
+        raise error
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,239 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from .artifacts import get_size, remove_product
+from .resources import parse_size
+from .scheduler import get_source_references
+
+# Tools used to limit the disk space used by intermediate products
+
+def parse_scratch_tiers(value: str) -> list:
+    """
+    Parse scratch directories given as a comma separated list ordered from
+    the fastest to the slowest storage such as "/dev/shm:16G,/mnt/nvme". Each
+    directory can have a maximum size after a colon, which limits the size of
+    the products a workflow writes to it.
+
+    Returns
+    -------
+    list
+        List of (directory, maximum size in bytes or None) tuples.
+    """
+    tiers = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        path, _, max_size = item.strip().partition(":")
+        tiers.append((path, parse_size(max_size) if max_size else None))
+    return tiers
+
+def get_product_size(path: str) -> int:
+    """
+    Get the size of a BEAM-DIMAP product including its .data directory.
+    """
+    size = get_size(path) if os.path.exists(path) else 0
+    data_dir = os.path.splitext(path)[0] + ".data"
+    if path.endswith(".dim") and os.path.isdir(data_dir):
+        size += get_size(data_dir)
+    return size
+
+def get_step_inputs(workflow: dict, name: str, i: int) -> list:
+    """
+    Get the intermediate products read by a workflow step. Products are
+    identified by the (subtable name, step index) of the step creating them.
+    Sources that are not created by the workflow are not included.
+
+    Parameters
+    ----------
+    workflow: dict
+        Workflow table of the TOML config where each key is a subtable name.
+    name: str
+        Name of the subtable of the step.
+    i: int
+        Index of the step in the subtable.
+    """
+    steps = workflow[name]
+    operator = steps[i]["operator"]
+    if i == 0:
+        return [(x, len(workflow[x]) - 1) for x in get_source_references(steps[:1]) if x in workflow]
+    if operator == "SnaphuUnwrapping":
+        # Reads the files in the SnaphuExport target folder
+        return []
+    if operator == "SnaphuImport":
+        # Reads the wrapped phase of the last SnaphuExport step
+        exports = [j for j in range(i) if steps[j]["operator"] == "SnaphuExport"]
+        return [(name, exports[-1])] if exports else []
+    return [(name, i - 1)]
+
+
+class ScratchTracker:
+
+    def __init__(self, workflow: dict, scratch_dir: str, remove: bool = True, ignore_list: list = None,
+                 tiers: list = None) -> None:
+        """
+        Reference counts of the intermediate products of a workflow. A product
+        is removed as soon as the last step reading it is finished instead of
+        at the end of the workflow. Outputs of subtables referenced with $,
+        products that are not read by any step such as the final output, and
+        paths in ignore_list are kept. The peak size of the scratch directories
+        is measured after every step.
+
+        If tiers are given, intermediate products are written to the first
+        tier with enough free space instead of scratch_dir. The final output
+        and the outputs of steps with `keep = true` are always written to
+        scratch_dir.
+
+        Parameters
+        ----------
+        workflow: dict
+            Workflow table of the TOML config where each key is a subtable name.
+        scratch_dir: str
+            Directory where the final products are written.
+        remove: bool
+            Remove products once they are no longer needed.
+        ignore_list: list
+            Paths of products that are never removed.
+        tiers: list
+            List of (directory, maximum size) tuples ordered from the fastest
+            to the slowest storage. See `parse_scratch_tiers`.
+        """
+        self.scratch_dir = scratch_dir
+        self.remove = remove
+        self.ignore_list = [os.path.abspath(x) for x in ignore_list or []]
+        self.inputs = {}
+        self.consumers = {}
+        for name, steps in workflow.items():
+            for i in range(len(steps)):
+                self.inputs[(name, i)] = get_step_inputs(workflow, name, i)
+                for product in self.inputs[(name, i)]:
+                    self.consumers[product] = self.consumers.get(product, 0) + 1
+        self.keep = {(x, len(workflow[x]) - 1) for steps in workflow.values() for x in get_source_references(steps)
+                     if x in workflow}
+        # Outputs written to scratch_dir
+        self.final = {(name, i) for name, steps in workflow.items() for i, step in enumerate(steps) if step.get("keep")}
+        self.keep |= self.final
+        if workflow:
+            name = list(workflow)[-1]
+            self.final.add((name, len(workflow[name]) - 1))
+        # Each workflow uses its own directory in every tier so workflows
+        # running at the same time do not share files
+        self.tiers = []
+        for path, max_size in tiers or []:
+            os.makedirs(path, exist_ok=True)
+            self.tiers.append((tempfile.mkdtemp(prefix="pysnap-", dir=path), path, max_size))
+        # Bytes of the products in the directory of every tier, tracked
+        # instead of measured so choosing a tier does not walk the directory.
+        # Steps that are running reserve their estimated output size.
+        self.tier_usage = {x[0]: 0 for x in self.tiers}
+        self.reserved = {}
+        self.product_sizes = {}
+        self.targets = {}
+        self.largest_product = 0
+        self.peak_size = 0
+        self.peak_step = None
+        # Subtables of a workflow can run at the same time
+        self._lock = threading.Lock()
+
+    def target_dir(self, step: tuple, sources: list) -> str:
+        """
+        Get the directory where the output of a step is written. The output
+        size is estimated from the size of the sources, or the largest product
+        so far if the sources are not on disk. The first tier that has enough
+        free space and stays below its maximum size is used.
+
+        Parameters
+        ----------
+        step: tuple
+            (subtable name, step index) of the step.
+        sources: list
+            Source products of the step.
+        """
+        if step in self.final or not self.tiers:
+            return self.scratch_dir
+        estimate = sum(get_product_size(x) for x in sources) or self.largest_product
+        with self._lock:
+            for run_dir, path, max_size in self.tiers:
+                free = shutil.disk_usage(path).free
+                if max_size is not None:
+                    free = min(free, max_size - self.tier_usage[run_dir])
+                if estimate < free:
+                    self.tier_usage[run_dir] += estimate
+                    self.reserved[step] = (run_dir, estimate)
+                    return run_dir
+        return self.scratch_dir
+
+    def _tier_of(self, path: str) -> str:
+        path = os.path.abspath(path)
+        for run_dir, _, _ in self.tiers:
+            if path.startswith(os.path.join(os.path.abspath(run_dir), "")):
+                return run_dir
+        return None
+
+    def finish(self, step: tuple, target: str) -> None:
+        """
+        Mark a step as finished. The scratch directory size is measured and
+        the inputs of the step that have no other consumers are removed.
+
+        Parameters
+        ----------
+        step: tuple
+            (subtable name, step index) of the step.
+        target: str
+            Output product of the step.
+        """
+        with self._lock:
+            self.targets[step] = target
+            product_size = get_product_size(target)
+            self.largest_product = max(self.largest_product, product_size)
+            run_dir, estimate = self.reserved.pop(step, (None, 0))
+            if run_dir is not None:
+                self.tier_usage[run_dir] -= estimate
+            run_dir = self._tier_of(target)
+            if run_dir is not None:
+                self.tier_usage[run_dir] += product_size
+                self.product_sizes[step] = product_size
+            size = sum(get_size(x) for x in self.directories())
+            if size > self.peak_size:
+                self.peak_size = size
+                self.peak_step = step
+
+            for product in self.inputs.get(step, []):
+                self.consumers[product] -= 1
+                if self.consumers[product] > 0 or product in self.keep or product not in self.targets:
+                    continue
+                path = self.targets[product]
+                if self.remove and os.path.abspath(path) not in self.ignore_list:
+                    print("INFO: Removing intermediate product", path)
+                    remove_product(path)
+                    run_dir = self._tier_of(path)
+                    if run_dir is not None:
+                        self.tier_usage[run_dir] -= self.product_sizes.pop(product, 0)
+
+    def directories(self) -> list:
+        """
+        Get the directories where the products of the workflow are written.
+        """
+        return [self.scratch_dir] + [x[0] for x in self.tiers]
+
+    def close(self) -> None:
+        """
+        Remove the tier directories of the workflow if products are removed,
+        otherwise print where the intermediate products are.
+        """
+        for run_dir, _, _ in self.tiers:
+            if self.remove:
+                shutil.rmtree(run_dir, ignore_errors=True)
+            elif os.path.isdir(run_dir):
+                print("INFO: Intermediate products are kept in", run_dir)
+
+    def report(self) -> None:
+        """
+        Print the peak size of the scratch directories.
+        """
+        step = f" after {self.peak_step[0]} step {self.peak_step[1]}" if self.peak_step else ""
+        print(f"INFO: Peak scratch usage {self.peak_size / 1024**3:.2f} GB{step} in {', '.join(self.directories())}")
+
+if __name__ == "__main__":
+    pass
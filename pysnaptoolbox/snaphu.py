@@ -1,12 +1,97 @@
+from contextlib import nullcontext
 from glob import glob
 import os
 import platform
 import shutil
-import subprocess
+from .profiling import TraceWriter, run_command
+from .resources import cpu_count
+
+# Parameters of snaphu.conf that contain file paths
+SNAPHU_FILE_PARAMETERS = [
+    "CORRFILE", "OUTFILE", "AMPFILE", "AMPFILE1", "AMPFILE2", "PWRFILE", "PWRFILE1", "PWRFILE2", "MAGFILE",
+    "ESTIMATEFILE", "WEIGHTFILE", "COSTINFILE", "COSTOUTFILE", "CONNCOMPFILE", "UNWRAPPEDINFILE", "BYTEMASKFILE",
+    "DOTILEMASKFILE",
+]
+
+# Minimum size in pixels of the tiles used for tiled unwrapping
+MIN_TILE_SIZE = 2000
+
+# Minimum overlap in pixels between tiles
+MIN_TILE_OVERLAP = 200
 
 class SnaphuError(Exception):
     pass
 
+def read_envi_header(hdr_file: str) -> dict:
+    """
+    Read the key = value pairs of an ENVI header file such as the .hdr files
+    created by SnaphuExport.
+    """
+    header = {}
+    with open(hdr_file) as f:
+        for line in f:
+            key, sep, value = line.partition('=')
+            if sep:
+                header[key.strip().lower()] = value.strip()
+    return header
+
+def get_tiling_options(lines: int, samples: int, cpus: int) -> dict:
+    """
+    Get the SNAPHU tiling options for a raster. The raster is split into at
+    least one tile per CPU if the tiles can stay larger than MIN_TILE_SIZE,
+    choosing the grid with the most square tiles. The tile overlap is 10% of
+    the tile size and at least MIN_TILE_OVERLAP.
+    Parameters
+    ----------
+    lines: int
+        Number of lines of the raster.
+    samples: int
+        Number of samples (columns) of the raster.
+    cpus: int
+        Number of CPUs available for unwrapping.
+    Returns
+    -------
+    dict
+        Values of NTILEROW, NTILECOL, ROWOVRLP, COLOVRLP, and NPROC.
+    """
+    max_rows = max(1, lines // MIN_TILE_SIZE)
+    max_cols = max(1, samples // MIN_TILE_SIZE)
+    best = None
+    for rows in range(1, max_rows + 1):
+        for cols in range(1, max_cols + 1):
+            tiles = rows * cols
+            # Prefer the smallest grid with a tile per CPU, then square tiles
+            shape = abs(lines / rows - samples / cols) / max(lines / rows, samples / cols)
+            score = (tiles < cpus, -tiles if tiles < cpus else tiles, shape)
+            if best is None or score < best[0]:
+                best = (score, rows, cols)
+    _, rows, cols = best
+    return {
+        "NTILEROW": rows,
+        "NTILECOL": cols,
+        "ROWOVRLP": max(MIN_TILE_OVERLAP, lines // rows // 10) if rows > 1 else 0,
+        "COLOVRLP": max(MIN_TILE_OVERLAP, samples // cols // 10) if cols > 1 else 0,
+        "NPROC": max(1, min(cpus, rows * cols)),
+    }
+
+def get_raster_size(data_dir: str, conf_file: str) -> tuple:
+    """
+    Get the (lines, samples) of the wrapped phase exported by SnaphuExport
+    from its .hdr file. If there is no header, the number of samples is taken
+    from the SNAPHU command in the conf file and the number of lines from the
+    file size.
+    """
+    hdr_files = glob(os.path.join(data_dir, 'Phase_ifg*.snaphu.hdr'))
+    if hdr_files:
+        header = read_envi_header(hdr_files[0])
+        return int(header['lines']), int(header['samples'])
+    with open(conf_file, 'r') as f:
+        args = get_snaphu_command(f.readlines(), os.path.dirname(os.path.abspath(conf_file)))
+    samples = int(args[-1])
+    # Wrapped phase is stored as 4 byte floats
+    lines = os.path.getsize(args[-2]) // (4 * samples)
+    return lines, samples
+
 def load_conf_param_index(param: str, lines: list) -> int:
     """
     Get location of index containing specified parameter when loading
@@ -30,24 +115,39 @@ def load_conf_param_index(param: str, lines: list) -> int:
     # Get index
     return line[0][0]
 
+def get_snaphu_command(lines: list, conf_dir: str) -> list:
+    """
+    Get the arguments of the SNAPHU command written as a comment to the conf
+    file by SnaphuExport. Files are given as absolute paths.
+    """
+    command_args = lines[6].lstrip('#').split()
+    for i, arg in enumerate(command_args):
+        if i > 0 and os.path.isfile(os.path.join(conf_dir, arg)):
+            command_args[i] = os.path.join(conf_dir, arg)
+    return command_args
+
 def prep_snaphu(
-    conf_file: str
-    ) -> None:
+    conf_file: str,
+    options: dict = None
+    ) -> list:
     """
     Load and prepare the conf file for SNAPHU phase unwrapping.
-    For tiled processing the user must specify the number of columns
-    and rows using n_cols and n_rows respectively.
-    This method also loads the relevant command used to run SNAPHU and
-    sets the snaphu_cmd Class property.
+    Options such as the tiling options are written to the conf file.
+    File paths in the conf file and in the command are rewritten as
+    absolute paths so SNAPHU can be run from any working directory.
     Parameters
     ----------
     conf_file: str
         Path of config file generated by SNAP SNAPHU export.
+    options: dict
+        SNAPHU parameters to set in the conf file.
     
     Returns
     -------
-    None
+    list
+        Arguments of the command used to run SNAPHU.
     """
+    conf_dir = os.path.dirname(os.path.abspath(conf_file))
 
     with open(conf_file, 'r') as f:
         lines = f.readlines()
@@ -63,12 +163,22 @@ def prep_snaphu(
     lines[i_log] = '# LOGFILE \t\tsnaphu.log\n'
 
     # Update file paths to use absolute path
+    for i, line in enumerate(lines):
+        items = line.split()
+        if len(items) == 2 and items[0] in SNAPHU_FILE_PARAMETERS and not os.path.isabs(items[1]):
+            lines[i] = f'{items[0]}\t{os.path.join(conf_dir, items[1])}\n'
+
     # Update command call and path
-    command = lines[6]
-    command_args = command.split()
-    command = ' '.join(command_args)
-    command = command.lstrip('#     ')
-    command = command.rstrip('\n')
+    command_args = get_snaphu_command(lines, conf_dir)
+
+    # Set options, replacing the existing value of the parameter if any
+    for key, value in (options or {}).items():
+        line = f'{key}\t{value}\n'
+        indices = [i for i, x in enumerate(lines) if x.split()[:1] == [key]]
+        if indices:
+            lines[indices[0]] = line
+        else:
+            lines.append(line)
 
     with open(conf_file, 'w') as f:
         f.writelines(lines)
@@ -78,50 +188,80 @@ def prep_snaphu(
 
     # Update object properties
     # self._conf_lines = lines
-    return command
+    return command_args
+
+def find_snaphu_executable(bin_folder: str = None) -> str:
+    """
+    Get the path of the SNAPHU executable in bin_folder or in the PATH.
+    """
+    name = 'snaphu.exe' if platform.system() == 'Windows' else 'snaphu'
+    if bin_folder:
+        executable = os.path.join(bin_folder, name)
+        if os.path.isfile(executable):
+            return os.path.abspath(executable)
+    executable = shutil.which(name)
+    if executable is None:
+        raise SnaphuError(f"Cannot find {name} in binFolder {bin_folder} or in the PATH")
+    return executable
 
-def transfer_snaphu_files(src_dir: str, dst_dir: str) -> None:
+def run_snaphu(snaphu_target_dir: str, parameters: dict, product_name: str = None, limit=None, cpus: int = None,
+               trace: TraceWriter = None) -> str:
     """
-    Transfer coherence, phase, unwrapped phase, and conf files to and
-    from the SNAPHU bin directory
+    Run SNAPHU in the folder created by SnaphuExport. Files are not moved
+    so several unwrapping jobs can run at the same time. Tiled unwrapping
+    with one process per tile is used when the raster is large enough.
+    Upper case parameters such as NTILEROW or NPROC are written to the conf
+    file and override the automatic tiling options.
     Parameters
     ----------
-    src_dir: str
-        Path of directory contaning SNAPHU files.
-    dst_dir: bool
-        Path of directory where SNAPHU files should be moved to.
-    """
-    # Get SNAPHU files
-    coh_files = glob(os.path.join(src_dir, 'coh_*'))
-    phase_files = glob(os.path.join(src_dir, 'Phase_ifg*'))
-    unw_files = glob(os.path.join(src_dir, 'UnwPhase*'))
-    conf_file = glob(os.path.join(src_dir, 'snaphu.conf'))
-    files = coh_files + phase_files + unw_files + conf_file
-    
-    # Transfer files
-    for file in files:
-        dst = os.path.join(dst_dir, os.path.basename(file))
-        print(f"INFO: Transferring file {file} to {dst}")
-        shutil.move(src=file, dst=dst)
+    snaphu_target_dir: str
+        targetFolder of the SnaphuExport operator.
+    parameters: dict
+        Parameters of the SnaphuUnwrapping step. binFolder is the directory
+        containing the SNAPHU executable which is otherwise found in the PATH.
+    product_name: str
+        Name of the product exported by SnaphuExport. SnaphuExport creates a
+        folder with this name in targetFolder.
+    limit:
+        Optional semaphore used to limit the number of SNAPHU jobs running
+        at the same time.
+    cpus: int
+        Number of CPUs available for the job. Defaults to all CPUs.
+    trace: TraceWriter
+        Optional trace where the resources used by SNAPHU are written.
+    Returns
+    -------
+    str
+        Folder containing the unwrapped phase.
+    """
+    snaphu_target_data_dir = None
+    if product_name and os.path.isdir(os.path.join(snaphu_target_dir, product_name)):
+        snaphu_target_data_dir = os.path.join(snaphu_target_dir, product_name)
+    else:
+        data_dirs = glob(os.path.join(snaphu_target_dir, '*'))
+        if len(data_dirs) > 1:
+            raise RuntimeError(f"Cannot find Snaphu target data directory of {product_name} in {snaphu_target_dir}")
+        snaphu_target_data_dir = data_dirs[0] if data_dirs else None
+    if snaphu_target_data_dir is None:
+        raise RuntimeError("Cannot find Snaphu target data directory")
 
-def run_snaphu(snaphu_target_dir: str, parameters: str):
+    parameters = parameters or {}
+    executable = find_snaphu_executable(parameters.get("binFolder"))
+    conf_file = os.path.join(snaphu_target_data_dir, "snaphu.conf")
+    lines, samples = get_raster_size(snaphu_target_data_dir, conf_file)
+    options = get_tiling_options(lines, samples, cpus or cpu_count())
+    options.update({k: v for k, v in parameters.items() if k.isupper()})
+    print(f"INFO: SNAPHU options for {lines}x{samples} raster:", " ".join(f"{k}={v}" for k, v in options.items()))
+    # The conf file is rewritten once. The arguments are kept as a list so
+    # paths containing spaces are passed unchanged.
+    cmd_list = [executable] + prep_snaphu(conf_file, options)[1:]
+    with limit if limit is not None else nullcontext():
+        print("INFO: Running SNAPHU in", snaphu_target_data_dir)
+        record = run_command(cmd_list, "SnaphuUnwrapping", "snaphu", trace=trace, cwd=snaphu_target_data_dir)
+    if record["exit_status"] != 0:
+        raise SnaphuError(f"SNAPHU failed with exit code {record['exit_status']} in {snaphu_target_data_dir}")
 
-    snaphu_target_data_dir = glob(os.path.join(snaphu_target_dir, '*'))
-    if not snaphu_target_data_dir:
-        raise RuntimeError("Cannot find Snaphu target data directory")
-    snaphu_target_data_dir = snaphu_target_data_dir[0]
-    
-    if not parameters.get("binFolder"):
-        raise ValueError("Missing binFolder parameter for SnaphuUnwrapping")
-    
-    cmd = prep_snaphu(os.path.join(snaphu_target_data_dir, "snaphu.conf"))
-    cmd_list = cmd.split(' ')
-    transfer_snaphu_files(snaphu_target_data_dir, parameters["binFolder"])
-    use_shell = True if platform.system() == 'Windows' else False
-    subprocess.call(cmd_list, cwd=parameters["binFolder"])
-    transfer_snaphu_files(parameters["binFolder"], snaphu_target_data_dir)
-
-    return
+    return snaphu_target_data_dir
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -0,0 +1,187 @@
+from copy import deepcopy
+
+from .bursts import read_burst_footprints, select_bursts
+from .scheduler import build_dependency_graph, get_source_references, topological_order
+
+# Tools used to fan out a workflow into one branch per IW subswath and merge
+# the branches with TOPSAR-Merge
+
+SUBSWATHS = ["IW1", "IW2", "IW3"]
+
+# Subswaths can only be merged once their bursts are merged
+JOIN_OPERATOR = "TOPSAR-Deburst"
+
+def get_fanout_subswaths(step: dict, sources: dict = None, get_subswaths=None, aoi: list = None,
+                         get_footprints=read_burst_footprints) -> list:
+    """
+    Get the subswaths of a TOPSAR-Split step whose subswath parameter is a
+    list or "auto". Returns None for other steps.
+
+    Parameters
+    ----------
+    step: dict
+        First step of a workflow subtable.
+    sources: dict
+        Sources table of the TOML config used to resolve $ sources.
+    get_subswaths: callable
+        Function returning the subswaths of a scene path which are used for
+        "auto". All IW subswaths are used if it is None.
+    aoi: list
+        Optional AOI polygons. Subswaths that do not intersect it are left
+        out.
+    get_footprints: callable
+        Function returning the burst footprints of a scene path.
+    """
+    value = (step.get("parameters") or {}).get("subswath")
+    if step["operator"] != "TOPSAR-Split" or not (isinstance(value, list) or value == "auto"):
+        return None
+    source = step.get("source")
+    if isinstance(source, str) and source.startswith("$"):
+        source = (sources or {}).get(source[1:])
+    if isinstance(value, list):
+        subswaths = list(value)
+    else:
+        subswaths = (get_subswaths(source) if get_subswaths is not None else None) or SUBSWATHS
+    if aoi is not None:
+        bursts = select_bursts(get_footprints(source), aoi)
+        subswaths = [x for x in subswaths if x in bursts]
+    return subswaths
+
+def _rename_sources(steps: list, names: dict) -> None:
+    # Point $ sources to the branch of the same subswath
+    for step in steps:
+        source = step.get("source")
+        if isinstance(source, str) and source[1:] in names:
+            step["source"] = "$" + names[source[1:]]
+        elif isinstance(source, list):
+            step["source"] = ["$" + names[x[1:]] if x[1:] in names else x for x in source]
+
+def expand_subswaths(config: dict, get_subswaths=None, aoi: list = None, get_footprints=read_burst_footprints,
+                     outputs: dict = None) -> int:
+    """
+    Expand TOPSAR-Split steps with a list of subswaths or "auto" into one
+    branch per subswath. Subtables reading a branch are branched as well. In
+    each branched subtable the steps up to TOPSAR-Deburst are run once per
+    subswath in subtables named <name>_<subswath>, and a TOPSAR-Merge step is
+    inserted before the remaining steps which keep the original subtable
+    name. Subtables without TOPSAR-Deburst are replaced by their branches.
+    Subtables without any subswath, for example because none intersects the
+    AOI, are removed together with the subtables using them.
+
+    Parameters
+    ----------
+    config: dict
+        Loaded TOML config. The workflow is changed in place.
+    get_subswaths: callable
+        Function returning the subswaths of a scene path used for "auto".
+    aoi: list
+        Optional AOI polygons. Subswaths that do not intersect it are not
+        branched.
+    get_footprints: callable
+        Function returning the burst footprints of a scene path.
+    outputs: dict
+        Outputs of subtables that were processed elsewhere and can be used
+        as $ sources.
+
+    Returns
+    -------
+    int
+        Largest number of branches of a subtable, or 1 if nothing was expanded.
+    """
+    workflow = config["workflow"]
+    sources = config.get("sources") or {}
+    # Subswaths of the subtables that are replaced by their branches
+    branched = {}
+    removed = set()
+    expanded = {}
+    # Subswaths of each branched subtable read by other subtables
+    used = {}
+    width = 1
+    order = topological_order(build_dependency_graph(workflow, dict(sources, **(outputs or {}))))
+    for name in order:
+        steps = workflow[name]
+        references = get_source_references(steps)
+        if any(x in removed for x in references):
+            removed.add(name)
+            continue
+        subswaths = get_fanout_subswaths(steps[0], sources, get_subswaths, aoi, get_footprints)
+        inputs = [x for x in references if x in branched]
+        if subswaths is None and not inputs:
+            continue
+        if subswaths is None:
+            # Subswaths available in every branched input
+            subswaths = [x for x in branched[inputs[0]] if all(x in branched[y] for y in inputs)]
+        if not subswaths:
+            print(f"INFO: workflow.{name} has no subswath to process. Removing it")
+            removed.add(name)
+            continue
+        for x in inputs:
+            used.setdefault(x, {})[name] = subswaths
+
+        joins = [i for i, step in enumerate(steps) if step["operator"] == JOIN_OPERATOR]
+        branch_steps = steps[:joins[0] + 1] if joins else steps
+        branches = {}
+        for subswath in subswaths:
+            branch = deepcopy(branch_steps)
+            if branch[0]["operator"] == "TOPSAR-Split":
+                branch[0]["parameters"]["subswath"] = subswath
+            else:
+                # Used to tell the outputs of the branches apart
+                branch[0]["subswath"] = subswath
+            _rename_sources(branch, {x: f"{x}_{subswath}" for x in inputs})
+            branches[f"{name}_{subswath}"] = branch
+
+        if not joins:
+            branched[name] = subswaths
+            expanded[name] = branches
+        elif len(subswaths) == 1:
+            # A single subswath does not need to be merged
+            expanded[name] = {name: branches[f"{name}_{subswaths[0]}"] + deepcopy(steps[joins[0] + 1:])}
+        else:
+            merge = {"source": ["$" + x for x in branches], "operator": "TOPSAR-Merge", "parameters": {}}
+            polarisations = (branch_steps[0].get("parameters") or {}).get("selectedPolarisations")
+            if polarisations:
+                merge["parameters"]["selectedPolarisations"] = polarisations
+            expanded[name] = dict(branches, **{name: [merge] + deepcopy(steps[joins[0] + 1:])})
+        width = max(width, len(subswaths))
+
+    # Branches that are not read by any subtable using them are not run, such
+    # as IW2 of a scene paired with a scene that only covers IW1 and IW3
+    for name in reversed(order):
+        if name not in branched or name not in used:
+            continue
+        needed = {x for consumer, subswaths in used[name].items() if consumer not in removed for x in subswaths}
+        for subswath in [x for x in branched[name] if x not in needed]:
+            print(f"INFO: {subswath} of workflow.{name} is not used. Removing workflow.{name}_{subswath}")
+            del expanded[name][f"{name}_{subswath}"]
+        branched[name] = [x for x in branched[name] if x in needed]
+        for consumers in used.values():
+            if name in consumers:
+                consumers[name] = branched[name]
+
+    # Rebuild the workflow in its original order
+    names = list(workflow)
+    new_workflow = {}
+    for name in names:
+        if name in removed:
+            continue
+        new_workflow.update(expanded.get(name, {name: workflow[name]}))
+    workflow.clear()
+    workflow.update(new_workflow)
+    return width
+
+def get_merge_width(workflow: dict) -> int:
+    """
+    Get the largest number of products merged by a TOPSAR-Merge step, which
+    is the number of subswath branches that can run at the same time.
+    """
+    width = 1
+    for steps in workflow.values():
+        for step in steps:
+            if step["operator"] == "TOPSAR-Merge":
+                source = step.get("source")
+                width = max(width, len(source) if isinstance(source, list) else 1)
+    return width
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,281 @@
+from copy import deepcopy
+import math
+import xml.etree.ElementTree as ET
+
+# Tools used to split a product into overlapping tiles that are processed as
+# independent GPT jobs and mosaicked afterwards
+
+MOSAIC_OPERATOR = "SAR-Mosaic"
+# Part of the tile size added to each tile so the mosaic has no seams at the
+# tile borders
+DEFAULT_OVERLAP = 0.1
+TILE_MODES = ["pixel", "geographic"]
+
+# Corners of the raster in the Abstracted_Metadata of SNAP products as
+# (range, azimuth) position
+CORNER_ATTRIBUTES = {
+    (0, 0): ("first_near_long", "first_near_lat"),
+    (1, 0): ("first_far_long", "first_far_lat"),
+    (0, 1): ("last_near_long", "last_near_lat"),
+    (1, 1): ("last_far_long", "last_far_lat"),
+}
+
+def get_tile_grid(n: int) -> tuple:
+    """
+    Get the number of tile rows and columns of n tiles. The grid is as
+    square as possible with more columns than rows, such as 2 x 4 for 8 tiles.
+    """
+    rows = max(x for x in range(1, int(math.sqrt(n)) + 1) if n % x == 0)
+    return rows, n // rows
+
+def read_corners(dim_file: str) -> dict:
+    """
+    Read the (lon, lat) coordinates of the raster corners of a BEAM-DIMAP
+    product from its abstracted metadata.
+
+    Returns
+    -------
+    dict
+        Coordinates of each corner keyed by its (range, azimuth) position
+        where 0 is the first or near and 1 the last or far corner.
+    """
+    names = {x for attributes in CORNER_ATTRIBUTES.values() for x in attributes}
+    values = {}
+    for _, elem in ET.iterparse(dim_file, events=("end",)):
+        if elem.tag == "MDATTR" and elem.get("name") in names and elem.get("name") not in values:
+            values[elem.get("name")] = float(elem.text)
+        elem.clear()
+    if len(values) != len(names):
+        raise LookupError(f"Cannot find the corner coordinates of {dim_file} to compute the tiles")
+    return {corner: (values[lon], values[lat]) for corner, (lon, lat) in CORNER_ATTRIBUTES.items()}
+
+def bounding_corners(points: list) -> dict:
+    """
+    Get the corners of the bounding box of (lon, lat) points in the same
+    form as `read_corners`.
+    """
+    west, east = min(x[0] for x in points), max(x[0] for x in points)
+    south, north = min(x[1] for x in points), max(x[1] for x in points)
+    return {(0, 0): (west, north), (1, 0): (east, north), (0, 1): (west, south), (1, 1): (east, south)}
+
+def _interpolate(corners: dict, u: float, v: float) -> tuple:
+    # Bilinear interpolation between the corners of the raster
+    return tuple((1 - u) * (1 - v) * corners[0, 0][i] + u * (1 - v) * corners[1, 0][i]
+                 + (1 - u) * v * corners[0, 1][i] + u * v * corners[1, 1][i] for i in range(2))
+
+def to_wkt(polygon: list) -> str:
+    """
+    Get the WKT POLYGON of a list of (lon, lat) points.
+    """
+    points = list(polygon) + [polygon[0]]
+    return "POLYGON((" + ", ".join(f"{x:.6f} {y:.6f}" for x, y in points) + "))"
+
+def get_tile_windows(n: int, overlap: float = DEFAULT_OVERLAP) -> list:
+    """
+    Split the unit square into n tiles.
+
+    Returns
+    -------
+    list
+        (region, core) boxes of every tile in row major order as
+        (left, top, right, bottom) fractions of the raster. The region
+        includes the overlap and the cores cover the raster without
+        overlapping.
+    """
+    rows, cols = get_tile_grid(n)
+    windows = []
+    for row in range(rows):
+        for col in range(cols):
+            core = (col / cols, row / rows, (col + 1) / cols, (row + 1) / rows)
+            region = (max(0, core[0] - overlap / cols), max(0, core[1] - overlap / rows),
+                      min(1, core[2] + overlap / cols), min(1, core[3] + overlap / rows))
+            windows.append((region, core))
+    return windows
+
+def get_tiles(corners: dict, n: int, overlap: float = DEFAULT_OVERLAP) -> list:
+    """
+    Split the area between corners into n geographic tiles.
+
+    Parameters
+    ----------
+    corners: dict
+        Corners as returned by `read_corners` or `bounding_corners`.
+    n: int
+        Number of tiles.
+    overlap: float
+        Part of the tile size added on each side of a tile shared with
+        another tile.
+
+    Returns
+    -------
+    list
+        (region, core) WKT polygons of every tile in row major order.
+    """
+    return [tuple(to_wkt([_interpolate(corners, u, v) for u, v in
+                          [(x[0], x[1]), (x[2], x[1]), (x[2], x[3]), (x[0], x[3])]])
+                  for x in window)
+            for window in get_tile_windows(n, overlap)]
+
+def read_raster_size(dim_file: str) -> tuple:
+    """
+    Read the width and height in pixels of a BEAM-DIMAP product.
+    """
+    size = {}
+    for _, elem in ET.iterparse(dim_file, events=("end",)):
+        if elem.tag in ["NCOLS", "NROWS"] and elem.tag not in size:
+            size[elem.tag] = int(elem.text)
+        elem.clear()
+        if len(size) == 2:
+            break
+    if len(size) != 2:
+        raise LookupError(f"Cannot find the raster size of {dim_file} to compute the tiles")
+    return size["NCOLS"], size["NROWS"]
+
+def to_pixel_region(box: tuple, width: int, height: int) -> str:
+    """
+    Get the Subset region x,y,w,h of a (left, top, right, bottom) box given
+    in fractions of a raster of width x height pixels.
+    """
+    x0, x1 = round(box[0] * width), round(box[2] * width)
+    y0, y1 = round(box[1] * height), round(box[3] * height)
+    return f"{x0},{y0},{x1 - x0},{y1 - y0}"
+
+def get_pixel_tiles(width: int, height: int, n: int, overlap: float = DEFAULT_OVERLAP) -> list:
+    """
+    Split a raster of width x height pixels into n tiles.
+
+    Returns
+    -------
+    list
+        (region, core) of every tile in row major order. The region is the
+        Subset region x,y,w,h of the tile including the overlap. The core is
+        the (left, top, right, bottom) box of the tile without the overlap
+        in fractions of the region, so it can be cut from the processed tile
+        even if processing changed its size such as Multilook.
+    """
+    tiles = []
+    for region, core in get_tile_windows(n, overlap):
+        x0, y0, w, h = [int(x) for x in to_pixel_region(region, width, height).split(",")]
+        cx0, cx1 = round(core[0] * width), round(core[2] * width)
+        cy0, cy1 = round(core[1] * height), round(core[3] * height)
+        tiles.append((f"{x0},{y0},{w},{h}", ((cx0 - x0) / w, (cy0 - y0) / h, (cx1 - x0) / w, (cy1 - y0) / h)))
+    return tiles
+
+def get_tile_parameters(tile: dict, source: str) -> tuple:
+    """
+    Get the Subset parameters of a tile step created by `expand_tiles` from
+    the product it reads, and the core of the tile used to trim it with
+    `get_trim_parameters`. Pixel tiles use a pixel region and geographic
+    tiles a geoRegion.
+    """
+    if tile["mode"] == "geographic":
+        corners = bounding_corners(tile.get("bounds") or list(read_corners(source).values()))
+        region, core = get_tiles(corners, tile["count"], tile["overlap"])[tile["index"]]
+        return {"geoRegion": region}, core
+    width, height = read_raster_size(source)
+    region, core = get_pixel_tiles(width, height, tile["count"], tile["overlap"])[tile["index"]]
+    return {"region": region}, core
+
+def get_trim_parameters(tile: dict, core, source: str) -> dict:
+    """
+    Get the Subset parameters of a trim step that cuts the core of a
+    processed tile. The size of pixel tiles is read from the processed tile
+    so it has to be written before the trim step runs.
+    """
+    if tile["mode"] == "geographic":
+        return {"geoRegion": core}
+    width, height = read_raster_size(source)
+    return {"region": to_pixel_region(core, width, height)}
+
+def expand_tiles(config: dict, aoi: list = None) -> int:
+    """
+    Expand workflow subtables with a step where tiles is set into one
+    subtable per tile. The steps before it run once in <name>_full. Each
+    tile subtable <name>_T<n> subsets the product with some overlap, runs the
+    remaining steps, and trims the overlap. A generated SAR-Mosaic step keeps
+    the original subtable name so other subtables read the mosaic.
+
+    Tiles split the raster in pixels (tile_mode = "pixel", the default) or
+    split the bounding box in longitude and latitude (tile_mode =
+    "geographic"), which is the bounding box of the AOI if one is given. tile_overlap sets the
+    part of the tile size shared with the neighbouring tiles.
+
+    Parameters
+    ----------
+    config: dict
+        Loaded TOML config. The workflow is changed in place.
+    aoi: list
+        Optional AOI polygons used as bounds of geographic tiles.
+
+    Returns
+    -------
+    int
+        Largest number of tiles of a subtable, or 1 if nothing was expanded.
+    """
+    workflow = config["workflow"]
+    expanded = {}
+    width = 1
+    for name, steps in workflow.items():
+        starts = [i for i, step in enumerate(steps) if step.get("tiles")]
+        if not starts:
+            continue
+        k = starts[0]
+        tiled = deepcopy(steps[k:])
+        n = int(tiled[0].pop("tiles"))
+        mode = tiled[0].pop("tile_mode", "pixel")
+        overlap = float(tiled[0].pop("tile_overlap", DEFAULT_OVERLAP))
+        if mode not in TILE_MODES:
+            raise ValueError(f"Unknown tile_mode {mode} in workflow.{name}. Use one of {', '.join(TILE_MODES)}")
+        if n <= 1:
+            expanded[name] = {name: steps[:k] + tiled}
+            continue
+        if not any(step["operator"] == "Terrain-Correction" for x in workflow.values() for step in x):
+            print(f"WARNING: Tiles of workflow.{name} are mosaicked with {MOSAIC_OPERATOR} which needs map "
+                  "projected products but the workflow has no Terrain-Correction")
+
+        new_subtables = {}
+        if k > 0:
+            new_subtables[f"{name}_full"] = steps[:k]
+            source = f"${name}_full"
+        else:
+            source = tiled[0].pop("source")
+            if isinstance(source, list):
+                raise ValueError(f"Tiles of workflow.{name} can only be created from a single source")
+        tiled[0].pop("source", None)
+
+        spec = {"count": n, "mode": mode, "overlap": overlap}
+        if mode == "geographic" and aoi is not None:
+            spec["bounds"] = [point for polygon in aoi for point in polygon]
+        for i in range(n):
+            tile = dict(spec, index=i)
+            subset = {"source": source, "operator": "Subset", "parameters": {"copyMetadata": True}, "tile": tile}
+            trim = {"operator": "Subset", "parameters": {"copyMetadata": True}, "trim": tile}
+            new_subtables[f"{name}_T{i + 1}"] = [subset] + deepcopy(tiled) + [trim]
+        new_subtables[name] = [{"source": [f"${name}_T{i + 1}" for i in range(n)], "operator": MOSAIC_OPERATOR,
+                                "parameters": {}}]
+        expanded[name] = new_subtables
+        width = max(width, n)
+
+    # Rebuild the workflow in its original order
+    new_workflow = {}
+    for name in list(workflow):
+        new_workflow.update(expanded.get(name, {name: workflow[name]}))
+    workflow.clear()
+    workflow.update(new_workflow)
+    return width
+
+def get_tile_width(workflow: dict) -> int:
+    """
+    Get the largest number of tiles mosaicked by a step, which is the number
+    of tile subtables that can run at the same time.
+    """
+    width = 1
+    for steps in workflow.values():
+        for step in steps:
+            if step["operator"] == MOSAIC_OPERATOR:
+                source = step.get("source")
+                width = max(width, len(source) if isinstance(source, list) else 1)
+    return width
+
+if __name__ == "__main__":
+    pass
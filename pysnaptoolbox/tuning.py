@@ -0,0 +1,280 @@
+import json
+import math
+import os
+
+from .resources import available_memory, cpu_count, parse_size
+from .scratch import get_product_size
+
+# Tools used to choose the JVM heap (-Xmx), tile cache (-c), and thread count
+# (-q) of every GPT call
+
+# Memory of a GPT job that is given to the JVM heap. The rest is left for
+# memory outside of the heap such as native libraries and file buffers.
+HEAP_FRACTION = 0.8
+MIN_HEAP = 2 * 1024**3
+MIN_TILE_CACHE = 256 * 1024**2
+# Largest part of the heap used by the tile cache
+MAX_TILE_CACHE_FRACTION = 0.6
+# Margin added to the peak memory of previous runs
+LEARNED_MEMORY_MARGIN = 1.2
+
+# Memory used by operators besides the tile cache estimated as base plus a
+# multiple of the input size. Operators that do not benefit from many threads
+# have a maximum thread count.
+OPERATOR_PROFILES = {
+    "default": {"base": 1 * 1024**3, "per_input": 1.0, "max_threads": None},
+    "TOPSAR-Split": {"base": 512 * 1024**2, "per_input": 0.1, "max_threads": 4},
+    "Apply-Orbit-File": {"base": 512 * 1024**2, "per_input": 0.1, "max_threads": 4},
+    "Subset": {"base": 512 * 1024**2, "per_input": 0.2, "max_threads": 4},
+    "BandSelect": {"base": 512 * 1024**2, "per_input": 0.2, "max_threads": 4},
+    "TOPSAR-Deburst": {"base": 1 * 1024**3, "per_input": 0.5, "max_threads": None},
+    "Back-Geocoding": {"base": 2 * 1024**3, "per_input": 1.5, "max_threads": None},
+    "Interferogram": {"base": 1 * 1024**3, "per_input": 1.0, "max_threads": None},
+    "Coherence": {"base": 1 * 1024**3, "per_input": 1.0, "max_threads": None},
+    "TopoPhaseRemoval": {"base": 1 * 1024**3, "per_input": 1.0, "max_threads": None},
+    "GoldsteinPhaseFiltering": {"base": 1 * 1024**3, "per_input": 1.0, "max_threads": None},
+    "Multilook": {"base": 512 * 1024**2, "per_input": 0.5, "max_threads": None},
+    "Terrain-Correction": {"base": 2 * 1024**3, "per_input": 2.0, "max_threads": None},
+    "SnaphuExport": {"base": 1 * 1024**3, "per_input": 0.5, "max_threads": 4},
+    "SnaphuImport": {"base": 1 * 1024**3, "per_input": 0.5, "max_threads": 4},
+}
+
+def default_profiles_file() -> str:
+    """
+    Get the default path of the file of operator profiles learned from traces.
+    """
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "pysnaptoolbox", "operator_profiles.json")
+
+def load_learned_profiles(profiles_file: str = None) -> dict:
+    """
+    Load the profiles learned from traces. Returns an empty dict if the file
+    does not exist.
+    """
+    try:
+        with open(profiles_file or default_profiles_file()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def learn_profiles(summary: dict, profiles_file: str = None) -> dict:
+    """
+    Update the learned profiles with a trace summary and save them. The peak
+    memory, the peak memory besides the tile cache, and the number of cores
+    actually used are kept for every step name, which is the operator or the
+    operators of a graph joined with "+".
+
+    Parameters
+    ----------
+    summary: dict
+        Summary of trace files created by `summarize_traces`.
+    profiles_file: str
+        Path of the profiles file. Defaults to `default_profiles_file()`.
+
+    Returns
+    -------
+    dict
+        Learned profiles of every step name.
+    """
+    profiles_file = profiles_file or default_profiles_file()
+    profiles = load_learned_profiles(profiles_file)
+    for name, x in summary.items():
+        # Graph batches and SNAPHU runs do not describe a single GPT step
+        if " " in name or name == "snaphu" or x["runs"] == x["failed"] or not x["wall_time"]:
+            continue
+        profile = profiles.setdefault(name, {"peak_rss": 0, "parallelism": 0.0, "runs": 0})
+        profile["peak_rss"] = max(profile["peak_rss"], x["peak_rss"])
+        profile["working_memory"] = max(profile.get("working_memory", 0), x["peak_working"])
+        # Mean of the parallelism of all runs weighted by the number of runs
+        runs = profile["runs"] + x["runs"]
+        profile["parallelism"] = (profile["parallelism"] * profile["runs"] + x["cpu_time"] / x["wall_time"] * x["runs"]) / runs
+        profile["runs"] = runs
+
+    os.makedirs(os.path.dirname(os.path.abspath(profiles_file)), exist_ok=True)
+    tmp_file = f"{profiles_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(profiles, f, indent=1)
+    os.replace(tmp_file, profiles_file)
+    return profiles
+
+def get_input_size(sources: list) -> int:
+    """
+    Get the total size of the source products of a step.
+    """
+    return sum(get_product_size(x) for x in sources if x and not x.startswith("s3://"))
+
+
+class GptTuner:
+
+    def __init__(self, jobs: int = 1, resources: dict = None, learned: dict = None, memory: int = None,
+                 cores: int = None) -> None:
+        """
+        Chooses the JVM heap, tile cache, and thread count of every GPT call
+        from the memory and cores of the machine, the number of GPT jobs
+        sharing it, and the memory profile of the operators. Profiles learned
+        from traces of previous runs replace the built-in estimates.
+
+        Parameters
+        ----------
+        jobs: int
+            Number of GPT jobs running at the same time.
+        resources: dict
+            [resources] table of the TOML config. Supported keys are memory,
+            cores, heap, tile_cache, and threads. Sub-tables named after an
+            operator override the values for that operator such as
+            [resources."Back-Geocoding"] heap = "24G".
+        learned: dict
+            Profiles learned from traces by `learn_profiles`.
+        memory: int
+            Memory in bytes available to all jobs. Defaults to the available
+            memory of the machine.
+        cores: int
+            Cores available to all jobs. Defaults to the cores of the machine.
+        """
+        self.jobs = max(1, jobs)
+        self.resources = dict(resources or {})
+        self.learned = learned or {}
+        if "memory" in self.resources:
+            memory = parse_size(self.resources["memory"])
+        if "cores" in self.resources:
+            cores = int(self.resources["cores"])
+        self.memory = memory if memory is not None else available_memory()
+        self.cores = cores if cores is not None else cpu_count()
+
+    def split(self, n: int):
+        """
+        Get a tuner for n GPT calls running at the same time within one job,
+        such as the subswath branches of a workflow.
+        """
+        tuner = GptTuner.__new__(GptTuner)
+        tuner.__dict__.update(self.__dict__)
+        tuner.jobs = self.jobs * max(1, n)
+        return tuner
+
+    def gpt_slots(self) -> int:
+        """
+        Get the number of GPT calls that fit in the memory at the same time,
+        at most the number of jobs. Each call needs its heap, which is the
+        largest heap of the [resources] table or the heap of a job, and the
+        memory outside of the heap.
+        """
+        if self.memory is None:
+            return self.jobs
+        heaps = [parse_size(x["heap"]) for x in self.resources.values() if isinstance(x, dict) and "heap" in x]
+        if "heap" in self.resources:
+            heaps.append(parse_size(self.resources["heap"]))
+        heap = max(heaps) if heaps else max(MIN_HEAP, int(self.memory / self.jobs * HEAP_FRACTION))
+        return max(1, min(self.jobs, int(self.memory // (heap / HEAP_FRACTION))))
+
+    def _override(self, operators: list, key: str):
+        # Operator tables take precedence over the top level values
+        for operator in operators:
+            table = self.resources.get(operator)
+            if isinstance(table, dict) and key in table:
+                return table[key]
+        return self.resources.get(key)
+
+    def estimate_memory(self, operators: list, input_size: int) -> int:
+        """
+        Estimate the memory used by the operators of a step besides the tile
+        cache.
+        """
+        # The learned peak RSS includes the tile cache, so the memory used
+        # besides the tile cache is learned separately
+        learned = self.learned.get("+".join(operators))
+        if learned is not None and learned.get("working_memory"):
+            return int(learned["working_memory"] * LEARNED_MEMORY_MARGIN)
+        estimate = 0
+        for operator in operators:
+            profile = OPERATOR_PROFILES.get(operator, OPERATOR_PROFILES["default"])
+            estimate = max(estimate, profile["base"] + profile["per_input"] * input_size)
+        return int(estimate)
+
+    def tune(self, operators: list, sources: list) -> dict:
+        """
+        Choose the heap, tile cache, and thread count of a GPT call.
+
+        Parameters
+        ----------
+        operators: list
+            Operators run by the GPT call.
+        sources: list
+            Source products of the GPT call used to estimate its memory.
+
+        Returns
+        -------
+        dict
+            Heap and tile cache in bytes and number of threads. A value is
+            None if it cannot be determined and the GPT default is used.
+        """
+        # Threads: cores of the job, limited by operators that do not scale
+        threads = max(1, self.cores // self.jobs)
+        for operator in operators:
+            max_threads = OPERATOR_PROFILES.get(operator, OPERATOR_PROFILES["default"])["max_threads"]
+            if max_threads is not None:
+                threads = min(threads, max_threads)
+        learned = self.learned.get("+".join(operators))
+        if learned is not None and learned.get("parallelism"):
+            threads = min(threads, max(1, math.ceil(learned["parallelism"] * 1.5)))
+
+        override = self._override(operators, "threads")
+        if override is not None:
+            threads = int(override)
+
+        heap = self._override(operators, "heap")
+        heap = parse_size(heap) if heap is not None else None
+        if heap is None and self.memory is not None:
+            heap = max(MIN_HEAP, int(self.memory / self.jobs * HEAP_FRACTION))
+        tile_cache = self._override(operators, "tile_cache")
+        tile_cache = parse_size(tile_cache) if tile_cache is not None else None
+        if heap is not None:
+            working = self.estimate_memory(operators, get_input_size(sources))
+            if working > heap:
+                print(f"WARNING: Operators {', '.join(operators)} may need {working / 1024**3:.1f} GB but only "
+                      f"{heap / 1024**3:.1f} GB of heap is available to each of the {self.jobs} jobs")
+            # The tile cache gets the heap that is not needed by the operators
+            if tile_cache is None:
+                tile_cache = max(MIN_TILE_CACHE, min(int(heap * MAX_TILE_CACHE_FRACTION), heap - working))
+        return {"heap": heap, "tile_cache": tile_cache, "threads": threads}
+
+    def options(self, operators: list, sources: list) -> tuple:
+        """
+        Get the GPT options and environment variables of a GPT call. The heap
+        is set with INSTALL4J_ADD_VM_PARAMS which is read by the GPT launcher
+        and overrides the -Xmx of gpt.vmoptions.
+
+        Returns
+        -------
+        tuple
+            GPT options string such as "-q 8 -c 4096M" and a dict of
+            environment variables.
+        """
+        tuned = self.tune(operators, sources)
+        options = f"-q {tuned['threads']}"
+        if tuned["tile_cache"] is not None:
+            options += f" -c {tuned['tile_cache'] // 1024**2}M"
+        env = {}
+        if tuned["heap"] is not None:
+            vm_params = os.environ.get("INSTALL4J_ADD_VM_PARAMS", "")
+            env["INSTALL4J_ADD_VM_PARAMS"] = f"{vm_params} -Xmx{tuned['heap'] // 1024**2}m".strip()
+        return options, env
+
+if __name__ == "__main__":
+    import argparse
+    from glob import glob
+
+    from .profiling import summarize_traces
+
+    parser = argparse.ArgumentParser(description='Learn the memory and thread profiles of GPT steps from trace files')
+    parser.add_argument('traces', nargs='+', help='Trace files or directories containing trace files')
+    parser.add_argument('--profiles-file', help='Path of the learned profiles file', default=None)
+    args = parser.parse_args()
+
+    trace_files = []
+    for path in args.traces:
+        if os.path.isdir(path):
+            trace_files += sorted(glob(os.path.join(path, "**", "*.json*"), recursive=True))
+        else:
+            trace_files.append(path)
+    profiles = learn_profiles(summarize_traces(trace_files), args.profiles_file)
+    print(f"INFO: Saved profiles of {len(profiles)} steps to {args.profiles_file or default_profiles_file()}")